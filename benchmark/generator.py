@@ -0,0 +1,155 @@
+"""
+Synthetic STTM files for the benchmark.
+
+The columns of every report come from sttm-common/schemas.json, so
+the generated files follow the tables as they are defined. The generated
+columns, source_file_id and added_dttm, are left out as handler adds them. Values look like the AEMO
+reports: the three hubs, gas dates in "%d %b %Y", timestamps in
+"%d %b %Y %H:%M:%S", prices with two decimals.
+
+Usage:
+  python generator.py <directory> [--reports INT651,INT652] [--rows 1000] [--files 10] [--files-per-day 1]
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import sys
+from io import StringIO
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCHEMAS_FILE = os.path.join(HERE, "..", "sttm-common", "schemas.json")
+
+HUBS = (("SYD", "Sydney"), ("ADL", "Adelaide"), ("BRI", "Brisbane"))
+
+# file name of every report, the date and time stamp is appended
+FILE_PREFIXES = {
+    "INT651": "INT651_V1_ExAnteMarketPrice_",
+    "INT652": "INT652_V1_ExAnteScheduleQuantity_",
+    "INT654": "INT654_V1_ProvisionalMarketPrice_",
+    "INT690": "INT690_V1_DeviationPriceData_",
+}
+
+# rows per file of the size classes used by run.py
+SIZES = {
+    "small": 50,
+    "medium": 5000,
+    "large": 100000,
+}
+
+
+def load_schemas(path=SCHEMAS_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+def report_columns(schemas):
+    """
+    Columns of every report, by report code
+    Returns:
+      dict: "INT651" -> [(column name, schema type)]
+    """
+    columns = {}
+    for table_name, schema in schemas.items():
+        code = table_name.split("_")[1]
+        columns[code] = [(c["name"], c["type"]) for c in schema if not c.get("generated")]
+    return columns
+
+
+def column_value(name, schema_type, rng, gas_date, hub, row):
+    if name == "gas_date":
+        return gas_date.strftime("%d %b %Y")
+    if name == "hub_identifier":
+        return hub[0]
+    if name == "hub_name":
+        return hub[1]
+    if name == "schedule_identifier":
+        return str(100000 + row // len(HUBS))
+    if name == "facility_identifier":
+        return str(rng.randint(1, 60))
+    if name == "facility_name":
+        return "Facility %s" % rng.randint(1, 60)
+    if schema_type == "Timestamp":
+        stamp = datetime.datetime.combine(gas_date, datetime.time()) - datetime.timedelta(
+            minutes=rng.randint(0, 24 * 60))
+        return stamp.strftime("%d %b %Y %H:%M:%S")
+    if schema_type == "Int":
+        return str(rng.randint(0, 500000))
+    if schema_type == "Double":
+        return "%.2f" % rng.uniform(0, 40)
+    if schema_type.startswith("Char"):
+        return rng.choice(("R", "D"))
+    return rng.choice(("Y", "N"))
+
+
+def generate_report(code, columns, rows, gas_date, seed=0):
+    """
+    Content of one report
+    Args:
+      code (string): report code, "INT651"
+      columns (dict): the result of report_columns
+      rows (int): number of rows
+      gas_date (date): first gas date, it moves on a day every len(HUBS) * 48 rows
+      seed (int): seed of the values
+
+    Returns:
+      string: the csv content
+    """
+    rng = random.Random(seed)
+    out = StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow([name for name, _ in columns[code]])
+    for row in range(rows):
+        hub = HUBS[row % len(HUBS)]
+        day = gas_date + datetime.timedelta(days=row // (len(HUBS) * 48))
+        writer.writerow([column_value(name, schema_type, rng, day, hub, row)
+                         for name, schema_type in columns[code]])
+    return out.getvalue()
+
+
+def report_file_name(code, stamp):
+    return "%s%s.csv" % (FILE_PREFIXES[code], stamp.strftime("%Y%m%d%H%M%S"))
+
+
+def generate_files(codes, rows, files, start=datetime.date(2018, 7, 1), schemas=None, files_per_day=1):
+    """
+    Generate files of every report, files_per_day files per gas date, a
+    minute apart
+    Returns:
+      list: (file name, content as bytes)
+    """
+    columns = report_columns(schemas or load_schemas())
+    generated = []
+    for code in codes:
+        for i in range(files):
+            gas_date = start + datetime.timedelta(days=i // files_per_day)
+            stamp = datetime.datetime.combine(gas_date, datetime.time(12, 0)) + \
+                datetime.timedelta(minutes=i % files_per_day)
+            content = generate_report(code, columns, rows, gas_date, seed=i)
+            generated.append((report_file_name(code, stamp), content.encode("utf-8")))
+    return generated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic STTM reports to a directory")
+    parser.add_argument("directory")
+    parser.add_argument("--reports", default=",".join(sorted(FILE_PREFIXES)))
+    parser.add_argument("--rows", type=int, default=SIZES["medium"])
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--files-per-day", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.directory, exist_ok=True)
+    for file_name, content in generate_files(args.reports.split(","), args.rows, args.files,
+                                             files_per_day=args.files_per_day):
+        with open(os.path.join(args.directory, file_name), "wb") as f:
+            f.write(content)
+    print("Wrote %s file(s) to [%s]" % (len(args.reports.split(",")) * args.files, args.directory))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
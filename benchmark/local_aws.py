@@ -0,0 +1,254 @@
+"""
+In-memory stand-ins for the S3, Athena and SQS clients used by the lambdas.
+
+Only the calls the lambdas make are implemented, with the same arguments and
+response shapes as boto3. Every call is counted, and it can be delayed by a
+fixed latency to approximate the round trip to the real service. Missing
+objects raise botocore ClientError with code 404, as head_object does.
+"""
+import datetime
+import hashlib
+import io
+import itertools
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+
+from botocore.exceptions import ClientError
+
+
+class LocalClient(object):
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000.0
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def not_found(operation, key):
+    return ClientError({'Error': {'Code': '404', 'Message': 'Not Found', 'Key': key}}, operation)
+
+
+def etag(body):
+    return '"%s"' % (hashlib.md5(body).hexdigest(),)
+
+
+class LocalS3(LocalClient):
+    """
+    Objects are kept in a dict keyed by (bucket, key), their ETag is the md5
+    of their content. Objects set directly in objects were modified long ago.
+    """
+
+    def __init__(self, latency_ms=0):
+        super(LocalS3, self).__init__(latency_ms)
+        self.objects = {}
+        self.modified = {}
+        self.tags = {}
+        self.uploads = {}
+
+    def _put(self, bucket, key, body):
+        self.objects[(bucket, key)] = body
+        self.modified[(bucket, key)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def _get(self, operation, bucket, key):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise not_found(operation, key)
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self._call('PutObject')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif not isinstance(Body, bytes):
+            Body = Body.read()
+        self._put(Bucket, Key, Body)
+        return {'ETag': etag(Body)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._call('GetObject')
+        body = self._get('GetObject', Bucket, Key)
+        size = len(body)
+        response = {'ETag': etag(body)}
+        if Range:
+            first, _, last = Range[len("bytes="):].partition("-")
+            first, last = int(first), min(int(last or size - 1), size - 1)
+            body = body[first:last + 1]
+            response['ContentRange'] = "bytes %s-%s/%s" % (first, last, size)
+        response.update({'Body': io.BytesIO(body), 'ContentLength': len(body)})
+        return response
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject')
+        return {'ContentLength': len(self._get('HeadObject', Bucket, Key))}
+
+    def copy_object(self, Bucket, Key, CopySource, Tagging=None, **kwargs):
+        self._call('CopyObject')
+        self._put(Bucket, Key, self._get('CopyObject', CopySource['Bucket'], CopySource['Key']))
+        if Tagging:
+            self.tags[(Bucket, Key)] = Tagging
+        return {}
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        # the managed copy heads the source before copying it
+        self.head_object(CopySource['Bucket'], CopySource['Key'])
+        return self.copy_object(Bucket=Bucket, Key=Key, CopySource=CopySource)
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._call('DeleteObject')
+        self.objects.pop((Bucket, Key), None)
+        self.tags.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._call('DeleteObjects')
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+            self.tags.pop((Bucket, obj['Key']), None)
+        return {'Errors': []}
+
+    def put_object_tagging(self, Bucket, Key, Tagging, **kwargs):
+        self._call('PutObjectTagging')
+        self._get('PutObjectTagging', Bucket, Key)
+        self.tags[(Bucket, Key)] = Tagging
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('UploadPart')
+        self.uploads[UploadId][PartNumber] = Body if isinstance(Body, bytes) else Body.read()
+        return {'ETag': '"%s-%s"' % (UploadId, PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._call('CompleteMultipartUpload')
+        parts = self.uploads.pop(UploadId)
+        self._put(Bucket, Key, b"".join(parts[part['PartNumber']] for part in MultipartUpload['Parts']))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._call('AbortMultipartUpload')
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        self._call('ListObjectsV2')
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        oldest = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[(Bucket, key)]),
+                              'ETag': etag(self.objects[(Bucket, key)]),
+                              'LastModified': self.modified.get((Bucket, key), oldest)} for key in keys],
+                'IsTruncated': False}
+
+    def get_paginator(self, operation):
+        return LocalPaginator(getattr(self, operation))
+
+    def keys(self, bucket, prefix=""):
+        return sorted(key for b, key in self.objects if b == bucket and key.startswith(prefix))
+
+
+class LocalPaginator(object):
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        kwargs.pop('PaginationConfig', None)
+        yield self.method(**kwargs)
+
+
+class LocalAthena(LocalClient):
+    """
+    Every query succeeds once it has been polled, its sql is kept in queries.
+    The rows a query returns can be set in results, by sql.
+    """
+
+    def __init__(self, latency_ms=0, queue_ms=0, exec_ms=0):
+        super(LocalAthena, self).__init__(latency_ms)
+        self.queue_ms = queue_ms
+        self.exec_ms = exec_ms
+        self.queries = {}
+        self.results = {}
+        self.ids = itertools.count()
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self._call('StartQueryExecution')
+        query_id = "local-%s" % next(self.ids)
+        self.queries[query_id] = QueryString
+        return {'QueryExecutionId': query_id}
+
+    def _execution(self, query_id):
+        return {'QueryExecutionId': query_id,
+                'Query': self.queries[query_id],
+                'Status': {'State': 'SUCCEEDED'},
+                'Statistics': {'QueryQueueTimeInMillis': self.queue_ms,
+                               'EngineExecutionTimeInMillis': self.exec_ms}}
+
+    def get_query_execution(self, QueryExecutionId, **kwargs):
+        self._call('GetQueryExecution')
+        return {'QueryExecution': self._execution(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds, **kwargs):
+        self._call('BatchGetQueryExecution')
+        return {'QueryExecutions': [self._execution(query_id) for query_id in QueryExecutionIds],
+                'UnprocessedQueryExecutionIds': []}
+
+    def get_query_results(self, QueryExecutionId, MaxResults=1000, NextToken=None, **kwargs):
+        self._call('GetQueryResults')
+        rows = self.results.get(self.queries[QueryExecutionId], [])
+        first = int(NextToken or 0)
+        response = {'ResultSet': {'Rows': [{'Data': [{'VarCharValue': value} for value in row]}
+                                           for row in rows[first:first + MaxResults]],
+                                  'ResultSetMetadata': {'ColumnInfo': []}}}
+        if first + MaxResults < len(rows):
+            response['NextToken'] = str(first + MaxResults)
+        return response
+
+
+class LocalSQS(LocalClient):
+    """
+    Queues keyed by url. Received messages are held until they are deleted,
+    they never become visible again. receive_message does not long poll.
+    """
+
+    def __init__(self, latency_ms=0):
+        super(LocalSQS, self).__init__(latency_ms)
+        self.queues = defaultdict(deque)
+        self.inflight = {}
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._call('SendMessage')
+        message_id = uuid.uuid4().hex
+        self.queues[QueueUrl].append({'MessageId': message_id, 'Body': MessageBody})
+        return {'MessageId': message_id}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, **kwargs):
+        self._call('ReceiveMessage')
+        queue = self.queues[QueueUrl]
+        messages = []
+        with self.lock:
+            while queue and len(messages) < MaxNumberOfMessages:
+                message = dict(queue.popleft(), ReceiptHandle=uuid.uuid4().hex)
+                self.inflight[message['ReceiptHandle']] = message
+                messages.append(message)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message_batch(self, QueueUrl, Entries, **kwargs):
+        self._call('DeleteMessageBatch')
+        for entry in Entries:
+            self.inflight.pop(entry['ReceiptHandle'], None)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def depth(self, queue_url):
+        return len(self.queues[queue_url])
@@ -0,0 +1,337 @@
+"""
+End-to-end benchmark of the sttm and sttm_partition lambdas.
+
+Every scenario runs in a fresh process against the in-memory S3 and Athena
+of local_aws, with files made by generator. The input files are uploaded
+under input/<table>/. handler is then invoked with events of
+--records-per-event records, and the partition lambda with the athena/
+objects it wrote. With --micro-batch N the input events go to a local queue
+instead and batch.poll takes them N files at a time. A scenario reports:
+  - files/s and rows/s of handler
+  - the latency of every stage (mean and p95 per call)
+  - S3 requests per file
+  - peak RSS, also relative to the RSS once the input is loaded
+
+Results are compared with baselines.json. A scenario whose throughput drops,
+or whose peak RSS or p95 record latency grows, by more than --tolerance is
+flagged as a regression and the run exits with 1. A scenario without a
+baseline fails the run as well, nothing would be compared otherwise: run it
+once with --save-baseline on the machine the benchmark is compared on, which
+records the results as the new baselines.
+
+Usage:
+  python run.py [--reports INT651,INT652] [--sizes small,medium] [--files 20]
+                [--env StreamingMode=always ...] [--s3-latency-ms 0]
+                [--files-per-day 10] [--micro-batch 50]
+                [--save-baseline] [--tolerance 0.2] [--output results.json]
+"""
+import argparse
+import contextlib
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import generator
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES_FILE = os.path.join(HERE, "baselines.json")
+BUCKET = "sttm-benchmark"
+QUEUE_URL = "local://sttm-benchmark-batch"
+
+# handler functions timed as stages, process_record is the whole record
+HANDLER_STAGES = ("process_record", "move_file", "set_state", "get_object", "claim_content",
+                  "process_file", "stream_process_file", "put_file", "put_rollup", "archive_files")
+# batch functions timed in --micro-batch scenarios, process_batch is the whole batch
+BATCH_STAGES = ("process_batch", "load_file", "write_partition")
+
+
+class StageTimer(object):
+    """
+    Collects the duration of every call of the wrapped functions
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, name, function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                with self.lock:
+                    self.durations[name].append(elapsed)
+        return timed
+
+    def instrument(self, module, names):
+        for name in names:
+            if hasattr(module, name):
+                setattr(module, name, self.wrap(name, getattr(module, name)))
+
+    def summary(self):
+        stages = {}
+        for name, durations in self.durations.items():
+            durations = sorted(durations)
+            stages[name] = {"calls": len(durations),
+                            "mean_ms": round(sum(durations) / len(durations), 3),
+                            "p95_ms": round(durations[int(0.95 * (len(durations) - 1))], 3)}
+        return stages
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+def s3_event(bucket, keys):
+    return {"Records": [{"s3": {"bucket": {"name": bucket}, "object": {"key": key}}} for key in keys]}
+
+
+def run_pipeline(spec, handler, sttm_partition, s3, keys, batch=None, sqs=None):
+    """
+    Invoke handler for the input keys, or queue them for batch.poll, then the
+    partition lambda for the output
+    Returns:
+      (statuses, handler seconds, S3 requests of handler, partition seconds)
+    """
+    statuses = defaultdict(int)
+    start = time.perf_counter()
+    if batch is not None:
+        for key in keys:
+            sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(s3_event(BUCKET, [key])))
+        while sqs.depth(QUEUE_URL):
+            for result in batch.poll(QUEUE_URL, spec["micro_batch"], 0):
+                statuses[result["status"]] += 1
+    else:
+        for first in range(0, len(keys), spec["records_per_event"]):
+            for result in handler.handler(s3_event(BUCKET, keys[first:first + spec["records_per_event"]]), None):
+                statuses[result["status"]] += 1
+    handler_seconds = time.perf_counter() - start
+    handler_calls = sum(s3.calls.values())
+
+    written = s3.keys(BUCKET, handler.ATHENA_FOLDER + "/")
+    start = time.perf_counter()
+    for first in range(0, len(written), spec["records_per_event"]):
+        sttm_partition.handler(s3_event(BUCKET, written[first:first + spec["records_per_event"]]), None)
+    partition_seconds = time.perf_counter() - start
+    return statuses, handler_seconds, handler_calls, partition_seconds
+
+
+def run_scenario(spec):
+    """
+    Run one scenario, in its own process
+    Args:
+      spec (dict): name, report, rows, files, files_per_day, records_per_event,
+        micro_batch, env, s3_latency_ms, athena_latency_ms and verbose of the scenario
+
+    Returns:
+      dict: the measurements of the scenario
+    """
+    os.environ.update(spec["env"])
+    os.environ.setdefault("StackName", "benchmark")
+    os.environ.setdefault("DatabaseName", "benchmark")
+    os.environ.setdefault("BucketName", BUCKET)
+    for folder in ("sttm", "sttm-common", "sttm-partition"):
+        sys.path.insert(0, os.path.join(HERE, "..", folder))
+
+    from local_aws import LocalAthena, LocalS3, LocalSQS
+    import handler
+    import sttm_partition
+
+    s3 = LocalS3(spec["s3_latency_ms"])
+    athena = LocalAthena(spec["athena_latency_ms"])
+    handler.s3 = s3
+    sttm_partition.s3 = s3
+    sttm_partition.athena = athena
+    batch = sqs = None
+    if spec["micro_batch"]:
+        import batch
+        sqs = LocalSQS()
+        batch.sqs = sqs
+
+    table_name = handler.FILE_TYPES[spec["report"]]["table_name"]
+    keys = []
+    for file_name, content in generator.generate_files([spec["report"]], spec["rows"], spec["files"],
+                                                       files_per_day=spec["files_per_day"]):
+        key = "%s/%s/%s" % (handler.INPUT_FOLDER, table_name, file_name)
+        s3.objects[(BUCKET, key)] = content
+        keys.append(key)
+    input_bytes = sum(len(s3.objects[(BUCKET, key)]) for key in keys)
+    loaded_rss = current_rss_mb()
+
+    timer = StageTimer()
+    timer.instrument(handler, HANDLER_STAGES)
+    if batch is not None:
+        # batch imported these from handler before they were wrapped
+        timer.instrument(batch, HANDLER_STAGES + BATCH_STAGES)
+    timer.instrument(sttm_partition, ("partition",))
+
+    # the lambdas log every step, keep them quiet unless asked
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(sys.stdout if spec["verbose"] else devnull):
+            statuses, handler_seconds, handler_calls, partition_seconds = run_pipeline(
+                spec, handler, sttm_partition, s3, keys, batch, sqs)
+
+    peak = peak_rss_mb()
+    rows = spec["rows"] * spec["files"]
+    return {
+        "name": spec["name"],
+        "files": spec["files"],
+        "rows": rows,
+        "input_mb": round(input_bytes / (1024.0 * 1024.0), 3),
+        "statuses": dict(statuses),
+        "handler_seconds": round(handler_seconds, 4),
+        "files_per_s": round(spec["files"] / handler_seconds, 3),
+        "rows_per_s": round(rows / handler_seconds, 1),
+        "partition_seconds": round(partition_seconds, 4),
+        "s3_requests_per_file": round(handler_calls / float(spec["files"]), 2),
+        "athena_queries": len(athena.queries),
+        "athena_objects": len(s3.keys(BUCKET, handler.ATHENA_FOLDER + "/")),
+        "peak_rss_mb": round(peak, 1),
+        "pipeline_rss_mb": round(peak - loaded_rss, 1) if loaded_rss is not None else None,
+        "stages": timer.summary(),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    Regressions of a result against its baseline
+    Returns:
+      list: a description of every metric out of tolerance
+    """
+    regressions = []
+    for metric in ("files_per_s", "rows_per_s"):
+        if baseline.get(metric) and result[metric] < baseline[metric] * (1 - tolerance):
+            regressions.append("%s %s < %s" % (metric, result[metric], baseline[metric]))
+    if baseline.get("peak_rss_mb") and result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append("peak_rss_mb %s > %s" % (result["peak_rss_mb"], baseline["peak_rss_mb"]))
+    record = result["stages"].get("process_record", {}).get("p95_ms")
+    baseline_record = baseline.get("stages", {}).get("process_record", {}).get("p95_ms")
+    if record and baseline_record and record > baseline_record * (1 + tolerance):
+        regressions.append("process_record p95_ms %s > %s" % (record, baseline_record))
+    return regressions
+
+
+def load_baselines(path=BASELINES_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results, path=BASELINES_FILE):
+    baselines = load_baselines(path)
+    for result in results:
+        baselines[result["name"]] = result
+    with open(path, "w") as f:
+        json.dump(baselines, f, indent=4, sort_keys=True)
+    print("Saved %s baseline(s) to [%s]" % (len(results), path))
+
+
+def print_result(result, regressions, baseline=True):
+    print("%s: %s files/s, %s rows/s, %s S3 requests/file, %s athena/ objects, peak RSS %s MB (%s MB in pipeline)%s" % (
+        result["name"], result["files_per_s"], result["rows_per_s"], result["s3_requests_per_file"],
+        result["athena_objects"],
+        result["peak_rss_mb"], result["pipeline_rss_mb"],
+        " REGRESSION: " + "; ".join(regressions) if regressions else "" if baseline else " NO BASELINE"))
+    for stage, stats in sorted(result["stages"].items()):
+        print("    %-20s %6s calls  mean %9.3f ms  p95 %9.3f ms" % (
+            stage, stats["calls"], stats["mean_ms"], stats["p95_ms"]))
+
+
+def scenarios(args):
+    env = dict(pair.split("=", 1) for pair in args.env)
+    suffix = "".join("/%s=%s" % item for item in sorted(env.items()))
+    if args.micro_batch:
+        suffix += "/micro_batch=%s" % (args.micro_batch,)
+    if args.files_per_day > 1:
+        suffix += "/files_per_day=%s" % (args.files_per_day,)
+    specs = []
+    for report in args.reports.split(","):
+        for size in args.sizes.split(","):
+            specs.append({"name": "%s/%s%s" % (report, size, suffix),
+                          "report": report,
+                          "rows": generator.SIZES[size],
+                          "files": args.files,
+                          "records_per_event": args.records_per_event,
+                          "micro_batch": args.micro_batch,
+                          "files_per_day": args.files_per_day,
+                          "env": env,
+                          "s3_latency_ms": args.s3_latency_ms,
+                          "athena_latency_ms": args.athena_latency_ms,
+                          "verbose": args.verbose})
+    return specs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sttm lambdas against local S3 and Athena")
+    parser.add_argument("--reports", default=",".join(sorted(generator.FILE_PREFIXES)))
+    parser.add_argument("--sizes", default="small,medium", help="of " + ", ".join(generator.SIZES))
+    parser.add_argument("--files", type=int, default=20, help="files per scenario")
+    parser.add_argument("--records-per-event", type=int, default=1)
+    parser.add_argument("--files-per-day", type=int, default=1, help="input files sharing a partition")
+    parser.add_argument("--micro-batch", type=int, default=0,
+                        help="files per batch of the queue fed batch mode, 0 invokes handler per event")
+    parser.add_argument("--env", action="append", default=[], help="lambda environment variable, Key=Value")
+    parser.add_argument("--s3-latency-ms", type=float, default=0)
+    parser.add_argument("--athena-latency-ms", type=float, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the logs of the lambdas")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--output", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    baselines = load_baselines()
+    results = []
+    regressed = 0
+    missing = []
+    # spawn, so the peak RSS of a scenario is its own
+    context = multiprocessing.get_context("spawn")
+    for spec in scenarios(args):
+        with context.Pool(1) as pool:
+            result = pool.apply(run_scenario, (spec,))
+        results.append(result)
+        regressions = []
+        if spec["name"] in baselines:
+            regressions = compare(result, baselines[spec["name"]], args.tolerance)
+        else:
+            missing.append(spec["name"])
+        regressed += bool(regressions)
+        print_result(result, regressions, spec["name"] in baselines)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.save_baseline:
+        save_baselines(results)
+    print("%s scenario(s), %s regression(s)" % (len(results), regressed))
+    if missing and not args.save_baseline:
+        print("No baseline in [%s] for %s scenario(s), record them with --save-baseline: %s"
+              % (BASELINES_FILE, len(missing), ", ".join(missing)))
+    return 1 if (regressed or missing) and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,29 +5,27 @@
 # Modified by: Dex
 
 import json
-import boto3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import botocore
 from botocore.vendored import requests
-import time
 
-s3 = boto3.resource('s3')
-athena = boto3.client('athena')
+from athena_executor import query_rows, run_queries, run_query
+from aws_clients import lazy_client, lazy_resource
+from metrics import MetricsRecorder
 
+DELETE_WORKERS = 16
+# delete_objects accepts at most 1000 keys per call
+DELETE_BATCH_SIZE = 1000
+# stop deleting this long before the lambda times out and resume in a new invocation
+TIME_MARGIN_MS = 30000
+MAX_RESUMES = 10
 
-def check_result(queryid):
-    """
-    Make sure an athena query finishes
-    Args:
-        ueryid (string): the id of a query
-    """
-    while True:
-        response = athena.get_query_execution(QueryExecutionId=queryid)
-        state = response['QueryExecution']['Status']['State']
-        if state in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            return
-        else:
-            print('wait...')
-            time.sleep(0.5)
+# the listing and the deleting pools run side by side
+s3 = lazy_resource('s3', pool_connections=2 * DELETE_WORKERS)
+athena = lazy_client('athena')
+lambda_client = lazy_client('lambda')
 
 
 def can_access_bucket(bucket):
@@ -45,17 +43,134 @@ def can_access_bucket(bucket):
         return False
 
 
-def delete_bucket(bucket_del):
+def list_prefixes(bucket_name):
+    """
+    Split a bucket into prefixes that can be listed in parallel, two levels
+    deep (athena/<table>/, done/<table>/, ...). Top level objects come back
+    as their own key.
+    """
+    client = s3.meta.client
+    prefixes = []
+    top = client.list_objects_v2(Bucket=bucket_name, Delimiter='/')
+    prefixes.extend(obj['Key'] for obj in top.get('Contents', []))
+    for common in top.get('CommonPrefixes', []):
+        sub = client.list_objects_v2(Bucket=bucket_name, Prefix=common['Prefix'], Delimiter='/')
+        prefixes.extend(obj['Key'] for obj in sub.get('Contents', []))
+        prefixes.extend(c['Prefix'] for c in sub.get('CommonPrefixes', []))
+        if sub.get('IsTruncated'):
+            # too many children to split further, list it as a whole
+            prefixes.append(common['Prefix'])
+    # a prefix listed whole already covers its children
+    return [p for p in sorted(set(prefixes))
+            if not any(p != other and p.startswith(other) for other in prefixes if other.endswith('/'))]
+
+
+class BulkDeleter(object):
+    """
+    Lists the prefixes of a bucket in parallel and sends the delete_objects
+    batches concurrently, until the bucket is empty or the deadline passes.
+    Deleting is idempotent so an interrupted run is resumed by running it again.
+    """
+
+    def __init__(self, bucket_name, deadline=None):
+        self.bucket_name = bucket_name
+        self.deadline = deadline
+        self.deleted = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def delete_batch(self, keys):
+        response = s3.meta.client.delete_objects(
+            Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+        errors = response.get('Errors', [])
+        with self.lock:
+            self.deleted += len(keys) - len(errors)
+            self.failed += len(errors)
+            print(f"[{self.bucket_name}] {self.deleted} objects deleted")
+
+    def delete_prefix(self, prefix, executor):
+        paginator = s3.meta.client.get_paginator('list_objects_v2')
+        futures = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix,
+                                       PaginationConfig={'PageSize': DELETE_BATCH_SIZE}):
+            if self.out_of_time():
+                break
+            keys = [obj['Key'] for obj in page.get('Contents', [])]
+            if keys:
+                futures.append(executor.submit(self.delete_batch, keys))
+        for future in futures:
+            future.result()
+
+    def run(self):
+        """
+        Returns:
+          True when the bucket has been emptied, False when the deadline stopped it
+        """
+        prefixes = list_prefixes(self.bucket_name)
+        print(f"[{self.bucket_name}] deleting {len(prefixes)} prefixes")
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as delete_executor:
+            with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as list_executor:
+                list(list_executor.map(lambda prefix: self.delete_prefix(prefix, delete_executor), prefixes))
+        if self.failed:
+            print(f"[{self.bucket_name}] {self.failed} objects could not be deleted")
+        return not self.out_of_time() and self.failed == 0
+
+
+def deadline_of(context):
+    """
+    Time after which work should stop so the lambda can hand over before its timeout
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + (context.get_remaining_time_in_millis() - TIME_MARGIN_MS) / 1000.0
+
+
+def delete_bucket(bucket_del, context=None):
     """
     Deletes a bucket
     Args:
         bucket_del(object): the bucket to be deleted
+        context(object): the lambda context, used to stop before the timeout
+
+    Returns:
+        True when the bucket is gone, False when emptying it has to be resumed
     """
     if bucket_del and can_access_bucket(bucket_del):
         print("Start deleting test bucket")
-        bucket_del.objects.all().delete()
+        deleter = BulkDeleter(bucket_del.name, deadline_of(context))
+        recorder = MetricsRecorder(dimension_sets=[[]])
+        try:
+            with recorder.stage("empty_bucket"):
+                emptied = deleter.run()
+        finally:
+            recorder.count("ObjectsDeleted", deleter.deleted)
+            recorder.count("ObjectsNotDeleted", deleter.failed)
+            recorder.flush()
+        if not emptied:
+            print("Bucket not empty yet")
+            return False
         bucket_del.delete()
         print("Bucket cleaned")
+    return True
+
+
+def resume(event, context):
+    """
+    Invoke this lambda again with the same event to carry on the cleaning
+    Returns:
+        False when the resume limit is reached
+    """
+    resumes = event.get('ResumeCount', 0) + 1
+    if resumes > MAX_RESUMES:
+        return False
+    print(f"Out of time, resuming cleaning ({resumes}/{MAX_RESUMES})")
+    payload = dict(event, ResumeCount=resumes)
+    lambda_client.invoke(FunctionName=context.function_name, InvocationType='Event',
+                         Payload=json.dumps(payload).encode("utf8"))
+    return True
 
 
 def delete_db(database_name, bucketName):
@@ -66,35 +181,35 @@ def delete_db(database_name, bucketName):
         bucketName(string): the name of the bucket that stores athena log
     """
 
+    recorder = MetricsRecorder(dimension_sets=[[]])
     sql_show = f'SHOW TABLES IN {database_name}'
     config = {'OutputLocation': f's3://{bucketName}/cleanDB', 'EncryptionConfiguration': {'EncryptionOption': 'SSE_S3'}}
-    queryid = athena.start_query_execution(
-        QueryString=sql_show, ResultConfiguration=config)['QueryExecutionId']
-    check_result(queryid)
 
     try:
-        # show the tables in the database
-        results = athena.get_query_results(QueryExecutionId=queryid)
+        # show the tables in the database, every page of them, never from the
+        # cache as the tables are created by other lambdas
+        with recorder.stage("show_tables"):
+            tablenames = [row[0] for row in query_rows(athena, sql_show, config, cache=None) if row and row[0]]
     except Exception as e:
         print(f"Cannot find the db: {e}")
     else:
         # if the database contains tables, delete all of them
-        if 'ResultSet' in results:
-            if 'Rows' in results['ResultSet']:
-                print(f"Start cleaning DB {database_name}")
-                for i in results['ResultSet']['Rows']:
-                    tablename = i['Data'][0]['VarCharValue']
-                    sql_table = f"DROP TABLE {database_name}.{tablename}"
-                    queryid_table = athena.start_query_execution(
-                        QueryString=sql_table, ResultConfiguration=config)['QueryExecutionId']
-                    check_result(queryid_table)
+        if tablenames:
+            print(f"Start cleaning DB {database_name}")
+            sqls = [f"DROP TABLE {database_name}.{tablename}" for tablename in tablenames]
+            recorder.count("Tables", len(sqls))
+            with recorder.stage("drop_tables"):
+                outcomes = run_queries(athena, sqls, config)
+            for tablename, outcome_table in zip(tablenames, outcomes):
+                if outcome_table.succeeded:
                     print(f"TABLE {tablename} cleaned")
 
     sql_db = f"DROP DATABASE IF EXISTS {database_name}"
-    queryid_db = athena.start_query_execution(
-        QueryString=sql_db, ResultConfiguration=config)['QueryExecutionId']
-    check_result(queryid_db)
-    print(f"Database {database_name} cleaned")
+    with recorder.stage("drop_database"):
+        outcome_db = run_query(athena, sql_db, config)
+    recorder.flush()
+    if outcome_db.succeeded:
+        print(f"Database {database_name} cleaned")
 
 
 def handler(event, context):
@@ -121,11 +236,18 @@ def handler(event, context):
 
             # delete the main test bucket
             print("bucketName: " + bucketName)
-            delete_bucket(bucket)
+            done = delete_bucket(bucket, context)
 
             # delete the test bucket for stroing athena logs
-            print("logbucketName: " + logbucketName)
-            delete_bucket(logbucket)
+            if done:
+                print("logbucketName: " + logbucketName)
+                done = delete_bucket(logbucket, context)
+
+            if not done:
+                # the resumed invocation sends the response to cloudformation
+                if resume(event, context):
+                    return
+                raise RuntimeError("Unable to empty the test buckets in time")
         # this lambda will be triggered when it's deleted in the cloudformation
         sendResponseCfn(event, context, "SUCCESS")
     except Exception as e:
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Athena query executor shared by the sttm lambdas, the buildspec of every
+lambda that needs it copies this file next to the handler.
+
+Queries are submitted together, up to max_in_flight at a time, and polled
+together with batch_get_query_execution. The polling delay starts at
+initial_delay and doubles up to max_delay. Every query gets a QueryOutcome,
+failures included, so callers decide what a FAILED state means for them.
+The queue and execution time of every query are emitted as metrics, see
+metrics.emit_query.
+
+The rows of a query are read with iter_rows, which follows NextToken over
+every page of get_query_results. query_rows also keeps the rows of read-only
+queries (SHOW, DESCRIBE, SELECT) in RESULT_CACHE, keyed on the normalised sql
+and the database, so the same metadata query in a warm lambda costs nothing
+until its entry expires. Any other statement run through run_queries clears
+the cache, as it may have changed what the cached queries return.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from metrics import emit_query
+
+
+TERMINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+
+# batch_get_query_execution accepts at most 50 ids per call
+BATCH_SIZE = 50
+# get_query_results returns at most 1000 rows per page
+RESULTS_PAGE_SIZE = 1000
+
+# seconds a cached result is reused for, 0 disables the cache
+RESULT_CACHE_TTL_SECONDS = float(os.environ.get('ResultCacheTtlSeconds', '300'))
+# most results kept, the least recently used is evicted first
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('ResultCacheMaxEntries', '64'))
+# results with more rows than this are streamed but not kept
+RESULT_CACHE_MAX_ROWS = int(os.environ.get('ResultCacheMaxRows', '10000'))
+
+READ_ONLY_STATEMENTS = ('show', 'describe', 'select', 'with')
+# quoted literals and identifiers, left as they are by normalise_sql
+QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`)""")
+
+
+class QueryOutcome(namedtuple('QueryOutcome',
+                              ['query_id', 'sql', 'state', 'reason', 'queue_ms', 'exec_ms'])):
+    """
+    Final state of one query, queue_ms and exec_ms come from the athena statistics
+    """
+    __slots__ = ()
+
+    @property
+    def succeeded(self):
+        return self.state == 'SUCCEEDED'
+
+
+def start_query(athena, sql, config, database=None):
+    """
+    Submit a query and return its id
+    Args:
+      athena (client): boto3 athena client
+      sql (string): the query
+      config (dict): athena ResultConfiguration
+      database (string): database of the QueryExecutionContext, if any
+    """
+    params = {'QueryString': sql, 'ResultConfiguration': config}
+    if database:
+        params['QueryExecutionContext'] = {'Database': database}
+    return athena.start_query_execution(**params)['QueryExecutionId']
+
+
+def outcome_of(execution, sql):
+    status = execution['Status']
+    statistics = execution.get('Statistics', {})
+    return QueryOutcome(query_id=execution['QueryExecutionId'],
+                        sql=sql,
+                        state=status['State'],
+                        reason=status.get('StateChangeReason'),
+                        queue_ms=statistics.get('QueryQueueTimeInMillis'),
+                        exec_ms=statistics.get('EngineExecutionTimeInMillis'))
+
+
+def normalise_sql(sql):
+    """
+    Case and whitespace insensitive form of a query, quoted parts are kept as
+    they are and a trailing semicolon is dropped
+    """
+    parts = QUOTED.split(sql.strip().rstrip(';'))
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i].lower())
+    return ''.join(parts).strip()
+
+
+def is_read_only(sql):
+    words = normalise_sql(sql).split(None, 1)
+    return bool(words) and words[0] in READ_ONLY_STATEMENTS
+
+
+class ResultCache(object):
+    """
+    Rows of read-only queries by (normalised sql, database), each entry kept
+    ttl seconds, at most max_entries entries of at most max_rows rows
+    """
+
+    def __init__(self, ttl=RESULT_CACHE_TTL_SECONDS, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 max_rows=RESULT_CACHE_MAX_ROWS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(sql, database=None):
+        return normalise_sql(sql), (database or '').lower()
+
+    def get(self, sql, database=None):
+        """
+        Returns:
+          list: the cached rows, None when missing or expired
+        """
+        key = self.key(sql, database)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, sql, database, rows):
+        if self.ttl <= 0 or self.max_entries <= 0 or len(rows) > self.max_rows:
+            return
+        key = self.key(sql, database)
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, rows)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# shared by the queries of the lambda, kept across warm invocations
+RESULT_CACHE = ResultCache()
+
+
+def run_queries(athena, queries, config, database=None, max_in_flight=20,
+                initial_delay=0.2, max_delay=5.0):
+    """
+    Run several queries concurrently and wait for all of them
+    Args:
+      athena (client): boto3 athena client
+      queries (list): the sql of every query
+      config (dict): athena ResultConfiguration
+      database (string): database of the QueryExecutionContext, if any
+      max_in_flight (int): most queries running at the same time
+      initial_delay (float): first polling delay in seconds
+      max_delay (float): longest polling delay in seconds
+
+    Returns:
+      list: a QueryOutcome per query, in the order of queries
+    """
+    if not all(is_read_only(sql) for sql in queries):
+        RESULT_CACHE.clear()
+    outcomes = [None] * len(queries)
+    waiting = list(enumerate(queries))
+    running = {}
+    started = {}
+    wall_ms = [None] * len(queries)
+    delay = initial_delay
+
+    while waiting or running:
+        while waiting and len(running) < max_in_flight:
+            index, sql = waiting.pop(0)
+            try:
+                started[index] = time.perf_counter()
+                running[start_query(athena, sql, config, database)] = index
+            except Exception as e:
+                print(f"Unable to start query: {e}")
+                outcomes[index] = QueryOutcome(None, sql, 'FAILED', str(e), None, None)
+
+        if not running:
+            continue
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+        ids = list(running)
+        for start in range(0, len(ids), BATCH_SIZE):
+            response = athena.batch_get_query_execution(QueryExecutionIds=ids[start:start + BATCH_SIZE])
+            for execution in response['QueryExecutions']:
+                if execution['Status']['State'] in TERMINAL_STATES:
+                    index = running.pop(execution['QueryExecutionId'])
+                    outcomes[index] = outcome_of(execution, queries[index])
+                    wall_ms[index] = (time.perf_counter() - started[index]) * 1000
+                    if waiting:
+                        # a slot freed up for the next queries, poll them eagerly
+                        delay = initial_delay
+            for failure in response.get('UnprocessedQueryExecutionIds', []):
+                print(f"Unable to poll query {failure.get('QueryExecutionId')}: {failure.get('ErrorMessage')}")
+
+    for outcome, elapsed in zip(outcomes, wall_ms):
+        emit_query(outcome, elapsed)
+        if not outcome.succeeded:
+            print(f"Query {outcome.state}: {outcome.sql} - {outcome.reason}")
+    return outcomes
+
+
+def run_query(athena, sql, config, database=None, **kwargs):
+    """
+    Run one query and wait for it, see run_queries
+    """
+    return run_queries(athena, [sql], config, database, **kwargs)[0]
+
+
+def iter_rows(athena, query_id, skip_header=False, page_size=RESULTS_PAGE_SIZE):
+    """
+    Rows of a query that succeeded, read one page at a time
+    Args:
+      athena (client): boto3 athena client
+      query_id (string): the QueryExecutionId
+      skip_header (bool): drop the first row, the column names of a SELECT
+      page_size (int): rows asked per get_query_results call
+
+    Returns:
+      generator: a list of values per row, None for NULL
+    """
+    params = {'QueryExecutionId': query_id, 'MaxResults': page_size}
+    first = True
+    while True:
+        response = athena.get_query_results(**params)
+        rows = response['ResultSet'].get('Rows', [])
+        if first and skip_header:
+            rows = rows[1:]
+        first = False
+        for row in rows:
+            yield [datum.get('VarCharValue') for datum in row.get('Data', [])]
+        if not response.get('NextToken'):
+            return
+        params['NextToken'] = response['NextToken']
+
+
+def query_rows(athena, sql, config, database=None, skip_header=False, cache=RESULT_CACHE):
+    """
+    Run a query and stream its rows, see iter_rows. The rows of read-only
+    queries come from the cache when it has them, and are added to it once
+    they have all been read.
+    Args:
+      athena (client): boto3 athena client
+      sql (string): the query
+      config (dict): athena ResultConfiguration
+      database (string): database of the QueryExecutionContext, if any
+      skip_header (bool): drop the first row, the column names of a SELECT
+      cache (ResultCache): None to always run the query
+
+    Returns:
+      generator: a list of values per row
+    """
+    cacheable = cache is not None and is_read_only(sql)
+    if cacheable:
+        rows = cache.get(sql, database)
+        if rows is not None:
+            print(f"Result reused: {sql}")
+            for row in rows:
+                yield list(row)
+            return
+
+    outcome = run_query(athena, sql, config, database)
+    if not outcome.succeeded:
+        raise RuntimeError(f"Query {outcome.state}: {sql} - {outcome.reason}")
+    rows = [] if cacheable else None
+    for row in iter_rows(athena, outcome.query_id, skip_header):
+        if rows is not None:
+            rows.append(list(row))
+            if len(rows) > cache.max_rows:
+                rows = None
+        yield row
+    if rows is not None:
+        cache.put(sql, database, rows)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+AWS clients shared by the sttm lambdas, the buildspec of every lambda copies
+this file next to the handler.
+
+A lambda declares its clients at module level with lazy_client, as it used to
+with boto3.client:
+
+    s3 = lazy_client('s3', pool_connections=MAX_WORKERS)
+
+Nothing is imported or built until the first call goes through the client,
+so a cold start only pays for the clients it uses. The clients are created
+once per process and kept across warm invocations, with their connection
+pools: keep-alive connections to S3 and Athena are reused from one invocation
+to the next. Every client gets the same Config: adaptive retry, TCP
+keep-alive and a connection pool sized for the largest thread pool that
+declared it. The region comes from the lambda environment (AWS_REGION).
+
+Tests and the benchmark still replace the module attribute (handler.s3 = ...)
+to run against a stand-in.
+"""
+import os
+import threading
+
+
+# connections of every pooled client, raised to the pool_connections declared for it
+MAX_POOL_CONNECTIONS = int(os.environ.get('MaxPoolConnections', '10'))
+# standard retries with a client side rate limiter that backs off on throttling
+RETRY_MODE = os.environ.get('RetryMode', 'adaptive')
+MAX_ATTEMPTS = int(os.environ.get('MaxAttempts', '5'))
+CONNECT_TIMEOUT_SECONDS = float(os.environ.get('ConnectTimeoutSeconds', '5'))
+READ_TIMEOUT_SECONDS = float(os.environ.get('ReadTimeoutSeconds', '60'))
+
+# service name -> client, and the pool size declared for it
+_clients = {}
+_resources = {}
+_pool_connections = {}
+_lock = threading.Lock()
+
+
+def client_config(pool_connections=MAX_POOL_CONNECTIONS):
+    """
+    botocore Config of the pooled clients
+    Args:
+      pool_connections (int): connections kept in the pool of the client
+
+    Returns:
+      botocore.config.Config
+    """
+    from botocore.config import Config
+
+    options = {'max_pool_connections': max(MAX_POOL_CONNECTIONS, pool_connections),
+               'connect_timeout': CONNECT_TIMEOUT_SECONDS,
+               'read_timeout': READ_TIMEOUT_SECONDS,
+               'retries': {'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS},
+               'tcp_keepalive': True}
+    try:
+        return Config(**options)
+    except TypeError:
+        # tcp_keepalive came after adaptive retry, older botocore keeps the
+        # pooled connections alive at the HTTP level only
+        options.pop('tcp_keepalive')
+        return Config(**options)
+
+
+def declare(service_name, pool_connections=0):
+    """
+    Record the pool size a caller needs for a service, before its client is created
+    """
+    with _lock:
+        _pool_connections[service_name] = max(_pool_connections.get(service_name, 0), pool_connections)
+
+
+def client(service_name):
+    """
+    The shared client of a service, created on first use
+    """
+    found = _clients.get(service_name)
+    if found is not None:
+        return found
+    with _lock:
+        # boto3 sessions are not thread safe, clients are created one at a time
+        if service_name not in _clients:
+            import boto3
+
+            config = client_config(_pool_connections.get(service_name, 0))
+            _clients[service_name] = boto3.client(service_name, config=config)
+        return _clients[service_name]
+
+
+def resource(service_name):
+    """
+    The shared resource of a service, created on first use with the pooled Config
+    """
+    found = _resources.get(service_name)
+    if found is not None:
+        return found
+    with _lock:
+        if service_name not in _resources:
+            import boto3
+
+            config = client_config(_pool_connections.get(service_name, 0))
+            _resources[service_name] = boto3.resource(service_name, config=config)
+        return _resources[service_name]
+
+
+def reset():
+    """
+    Forget the clients created so far, a forked process builds its own
+    """
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+
+
+class LazyClient(object):
+    """
+    Stand-in for a module level client, every attribute is looked up on the
+    shared client, see client
+    """
+
+    def __init__(self, service_name, factory=client):
+        self.service_name = service_name
+        self.factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self.factory(self.service_name), name)
+
+    def __repr__(self):
+        return "LazyClient(%r)" % (self.service_name,)
+
+
+def lazy_client(service_name, pool_connections=0):
+    """
+    Module level client of a service, see LazyClient
+    Args:
+      service_name (string): s3, athena, sqs...
+      pool_connections (int): calls the caller makes at the same time
+    """
+    declare(service_name, pool_connections)
+    return LazyClient(service_name)
+
+
+def lazy_resource(service_name, pool_connections=0):
+    """
+    Module level resource of a service, see lazy_client
+    """
+    declare(service_name, pool_connections)
+    return LazyClient(service_name, factory=resource)
+
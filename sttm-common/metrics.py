@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timing and volume metrics shared by the sttm lambdas, the buildspec of
+every lambda copies this file next to the handler.
+
+Metrics are printed as CloudWatch embedded metric format (EMF) JSON lines.
+CloudWatch Logs turns them into metrics of the METRICS_NAMESPACE namespace,
+without any API call from the lambda. Every record carries the Function
+dimension, plus whatever dimensions the caller adds (FileType, Stage,
+QueryType...). The metrics are aggregated over each dimension set given, so
+p50/p99 can be graphed per stage and per file type.
+
+    recorder = MetricsRecorder(FileType="STTM_INT651_ExAnteMarketPrice")
+    with recorder.stage("get_object"):
+        ...
+    recorder.count("BytesIn", size, "Bytes")
+    recorder.flush()
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+METRICS_ENABLED = os.environ.get("Metrics", "true").lower() == "true"
+METRICS_NAMESPACE = os.environ.get("MetricsNamespace", "STTM")
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+
+def emf_record(metrics, dimensions, dimension_sets=None, properties=None, timestamp=None):
+    """
+    Build one EMF record
+    Args:
+      metrics (dict): metric name -> (value, unit)
+      dimensions (dict): dimension name -> value, Function is added
+      dimension_sets (list): lists of dimension names to aggregate over,
+        all the dimensions together when None
+      properties (dict): extra fields, searchable in the logs but not metrics
+      timestamp (int): milliseconds since epoch, now when None
+
+    Returns:
+      dict: the record
+    """
+    dimensions = dict(dimensions, Function=FUNCTION_NAME)
+    if dimension_sets is None:
+        dimension_sets = [sorted(dimensions)]
+    else:
+        dimension_sets = [["Function"] + [name for name in names if name != "Function"]
+                          for names in dimension_sets]
+    record = dict(properties or {})
+    record.update(dimensions)
+    record["_aws"] = {
+        "Timestamp": timestamp or int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": METRICS_NAMESPACE,
+            "Dimensions": dimension_sets,
+            "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in sorted(metrics.items())],
+        }],
+    }
+    for name, (value, _) in metrics.items():
+        record[name] = value
+    return record
+
+
+def emit(metrics, dimensions=None, dimension_sets=None, properties=None):
+    """
+    Print one EMF record, see emf_record
+    """
+    if not METRICS_ENABLED or not metrics:
+        return
+    # a single write, print would send the newline apart and let other threads in between
+    sys.stdout.write(json.dumps(emf_record(metrics, dimensions or {}, dimension_sets, properties)) + "\n")
+
+
+class MetricsRecorder(object):
+    """
+    Collects the stage durations and the counts of one unit of work, a file
+    or an invocation, and emits them as a single EMF record. Durations of a
+    stage run several times are added up.
+    """
+
+    def __init__(self, dimension_sets=None, **dimensions):
+        self.dimensions = dimensions
+        self.dimension_sets = dimension_sets
+        self.metrics = {}
+        self.properties = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value, unit="Count"):
+        with self.lock:
+            current = self.metrics.get(name, (0, unit))[0]
+            self.metrics[name] = (current + value, unit)
+
+    def count(self, name, value=1, unit="Count"):
+        self.add(name, value, unit)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the block as stage name, its duration goes to the <name>Time metric
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage_metric(name), (time.perf_counter() - start) * 1000, "Milliseconds")
+
+    def set_dimension(self, name, value):
+        self.dimensions[name] = value
+
+    def set_property(self, name, value):
+        self.properties[name] = value
+
+    def flush(self):
+        with self.lock:
+            metrics, self.metrics = self.metrics, {}
+        emit(metrics, self.dimensions, self.dimension_sets, self.properties)
+
+
+def stage_metric(name):
+    """
+    get_object -> GetObjectTime
+    """
+    return "".join(part.capitalize() for part in name.split("_")) + "Time"
+
+
+def query_type(sql):
+    """
+    Kind of an athena query, its first keywords: ALTER TABLE, CREATE EXTERNAL TABLE, MSCK...
+    """
+    words = [word.upper() for word in re.findall(r"[A-Za-z]+", sql or "")]
+    if not words:
+        return "UNKNOWN"
+    if words[0] == "MSCK":
+        return "MSCK"
+    return " ".join(words[:3] if words[1:2] == ["EXTERNAL"] else words[:2])
+
+
+def emit_query(outcome, wall_ms=None):
+    """
+    Queue and execution time of one athena query, see athena_executor.QueryOutcome.
+    wall_ms is the time the lambda waited for it, polling included
+    """
+    metrics = {"Queries": (1, "Count")}
+    if wall_ms is not None:
+        metrics["QueryWaitTime"] = (wall_ms, "Milliseconds")
+    if outcome.queue_ms is not None:
+        metrics["QueryQueueTime"] = (outcome.queue_ms, "Milliseconds")
+    if outcome.exec_ms is not None:
+        metrics["QueryExecutionTime"] = (outcome.exec_ms, "Milliseconds")
+    if not outcome.succeeded:
+        metrics["QueryFailures"] = (1, "Count")
+    emit(metrics, {"QueryType": query_type(outcome.sql)}, [["QueryType"]],
+         {"QueryId": outcome.query_id, "State": outcome.state})
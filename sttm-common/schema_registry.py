@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Schema registry of the STTM tables, shared by the sttm lambdas. The buildspec
+of every lambda that needs it copies this file and schemas.json next to the
+handler.
+
+schemas.json is the only description of the tables. Both the parser of the
+sttm lambda (read_csv dtype, usecols, timestamp formats) and the CREATE TABLE
+statements of sttm_create_database are generated from it. Each column has:
+  - name and type, the athena type
+  - format: strptime format of a timestamp column in the AEMO reports
+  - category: low cardinality string, parsed as a pandas categorical
+  - generated: added by the sttm lambda, not part of the reports
+  - rollup: numeric measure summarised in the daily rollup table of the table
+
+A table with rollup columns gets a <table>_Daily rollup table: one row per
+gas_date and hub of every ingested file, with the row count and the min, max,
+sum and count of each measure. The rows of several files are combined at
+query time, GROUP BY gas_date, hub_identifier with MIN(<measure>_min),
+MAX(<measure>_max) and SUM(<measure>_sum) / SUM(<measure>_count) as average.
+
+Most queries select a hub, so the sorted output of the sttm lambda orders the
+rows by SORT_KEYS, the rows of a hub stay together and every parquet row group
+holds a single hub.
+"""
+import json
+import os
+
+
+SCHEMAS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas.json")
+
+# grouping columns of the rollup tables, and the suffix of their name
+ROLLUP_KEYS = ("gas_date", "hub_identifier", "hub_name")
+ROLLUP_SUFFIX = "_Daily"
+ROLLUP_STATISTICS = (("min", "Double"), ("max", "Double"), ("sum", "Double"), ("count", "BigInt"))
+
+# order of the rows of the sorted output, the keys a table lacks are skipped
+SORT_KEYS = ("hub_identifier", "gas_date", "schedule_identifier")
+# column the parquet row groups of the sorted output are split on
+CLUSTER_KEY = "hub_identifier"
+
+_schemas = None
+
+
+def load_schemas():
+    """
+    Load schemas.json once per container
+    Returns:
+      dict: table name -> list of columns, in table order
+    """
+    global _schemas
+    if _schemas is None:
+        with open(SCHEMAS_FILE) as f:
+            _schemas = json.load(f)
+    return _schemas
+
+
+def table_names():
+    return list(load_schemas())
+
+
+def report_code(table_name):
+    """
+    STTM_INT651_ExAnteMarketPrice -> INT651, the prefix of the report files
+    """
+    return table_name.split("_")[1].upper()
+
+
+def columns(table_name):
+    return load_schemas()[table_name]
+
+
+def input_columns(table_name):
+    """
+    Columns found in the reports, the generated ones left out
+    """
+    return [column for column in columns(table_name) if not column.get("generated")]
+
+
+def date_formats(table_name):
+    """
+    Returns:
+      dict: column name -> strptime format of the timestamp columns of the reports
+    """
+    return {column["name"]: column["format"] for column in input_columns(table_name) if column.get("format")}
+
+
+def is_numeric(column):
+    return column["type"].lower() in ("int", "integer", "bigint", "double", "float")
+
+
+def pandas_dtype(column, int_dtype="int64"):
+    """
+    dtype read_csv gives a column, timestamps stay strings for parse_timestamps
+    """
+    kind = column["type"].lower()
+    if column.get("category"):
+        return "category"
+    if kind in ("int", "integer", "bigint"):
+        return int_dtype
+    if kind in ("double", "float"):
+        return "float64"
+    return "object"
+
+
+def read_csv_params(table_name, int_dtype="int64"):
+    """
+    read_csv parameters of the reports of a table: every column gets an
+    explicit dtype so nothing is inferred, and columns unknown to the table
+    are skipped.
+    Args:
+      table_name (string): the table
+      int_dtype (string): dtype of integer columns, int64 cannot hold nulls so
+        float64 or object (the text as is) suit columns with missing values
+
+    Returns:
+      dict: dtype and usecols
+    """
+    report_columns = input_columns(table_name)
+    return {
+        "dtype": {column["name"]: pandas_dtype(column, int_dtype) for column in report_columns},
+        "usecols": frozenset(column["name"] for column in report_columns).__contains__,
+    }
+
+
+def file_types(int_dtype="int64"):
+    """
+    Parsing configuration of every report, by report code
+    Args:
+      int_dtype (string): dtype of integer columns, see read_csv_params
+
+    Returns:
+      dict: "INT651" -> {"table_name", "params", "date_formats"}
+    """
+    return {report_code(table_name): {"table_name": table_name,
+                                      "params": read_csv_params(table_name, int_dtype),
+                                      "date_formats": date_formats(table_name)}
+            for table_name in table_names()}
+
+
+def sort_columns(table_name):
+    """
+    SORT_KEYS found in a table, in sort order
+    """
+    names = set(column["name"] for column in columns(table_name))
+    return [name for name in SORT_KEYS if name in names]
+
+
+def column_type(schema_type, output_format):
+    """
+    Athena type of a column for the given storage format, char(n) is only
+    kept for text tables
+    """
+    if output_format == 'parquet' and schema_type.lower().startswith('char'):
+        return 'String'
+    return schema_type
+
+
+def ddl_columns(table_columns, output_format='csv'):
+    """
+    Column list of the CREATE TABLE statement of a table
+    Args:
+      table_columns (list): the columns of the table, see columns
+      output_format (string): csv or parquet
+    """
+    return ", ".join(" ".join((column['name'], column_type(column['type'], output_format)))
+                     for column in table_columns)
+
+
+def rollup_measures(table_name):
+    """
+    Names of the rollup columns of a table, empty when it has no rollup table
+    """
+    return [column["name"] for column in input_columns(table_name) if column.get("rollup")]
+
+
+def rollup_table_name(table_name):
+    """
+    STTM_INT651_ExAnteMarketPrice -> STTM_INT651_ExAnteMarketPrice_Daily
+    """
+    return table_name + ROLLUP_SUFFIX
+
+
+def rollup_columns(table_name):
+    """
+    Columns of the rollup table of a table, in table order
+    """
+    table_columns = dict((column["name"], column) for column in columns(table_name))
+    rollup = [{"name": "gas_date", "type": "Date"}]
+    rollup.extend({"name": name, "type": table_columns[name]["type"]} for name in ROLLUP_KEYS[1:])
+    rollup.append({"name": "row_count", "type": "BigInt"})
+    for measure in rollup_measures(table_name):
+        rollup.extend({"name": "%s_%s" % (measure, statistic), "type": kind}
+                      for statistic, kind in ROLLUP_STATISTICS)
+    rollup.extend(column for column in columns(table_name) if column.get("generated"))
+    return rollup
+
+
+def rollup_tables():
+    """
+    Returns:
+      dict: rollup table name -> its columns, for every table with rollup columns
+    """
+    return {rollup_table_name(table_name): rollup_columns(table_name)
+            for table_name in table_names() if rollup_measures(table_name)}
+
@@ -3,19 +3,27 @@
 # @Email: foamdino@gmail.com
 # Modified by: Dex
 
-import boto3
 import os
 import json
 import cfnresponse3
 import cfnresponse
 import botocore
 from botocore.vendored import requests
-import time
 
-s3 = boto3.client('s3')
-athena = boto3.client('athena', region_name='ap-southeast-2')
+from athena_executor import run_queries, run_query
+from aws_clients import lazy_client
+from metrics import MetricsRecorder
+from schema_registry import ddl_columns, load_schemas, rollup_tables
 
-json_file = "schemas.json"
+s3 = lazy_client('s3')
+athena = lazy_client('athena')
+
+# must match the OutputFormat of the sttm lambda writing to athena/
+OUTPUT_FORMAT = os.environ.get('OutputFormat', 'csv').lower()
+PARQUET_COMPRESSION = os.environ.get('ParquetCompression', 'snappy').upper()
+# let athena compute the year/month/day partitions instead of registering them
+PARTITION_PROJECTION = os.environ.get('PartitionProjection', 'false').lower() == 'true'
+PROJECTION_YEAR_RANGE = os.environ.get('ProjectionYearRange', '2010,2099')
 
 
 def sendResponseCfn(event, context, responseStatus):
@@ -31,22 +39,6 @@ def sendResponseCfn(event, context, responseStatus):
         response_body).encode("utf8"))
 
 
-def check_result(queryid):
-    """
-    Make sure an athena query finishes
-    Args:
-        ueryid (string): the id of a query
-    """
-    while True:
-        response = athena.get_query_execution(QueryExecutionId=queryid)
-        state = response['QueryExecution']['Status']['State']
-        if state in ['SUCCEEDED', 'FAILED', 'CANCELLED']:
-            return
-        else:
-            print('wait...')
-            time.sleep(0.5)
-
-
 def check_msck_file(stack_name, db_bucket, msck_key):
     """
     Check if the msck_file for this bucket already exists
@@ -70,102 +62,184 @@ def check_msck_file(stack_name, db_bucket, msck_key):
         return ('ok', True)
 
 
-def msck_repair(db_bucket, table_name, database_name, msck_key, config):
+def msck_repair(db_bucket, tables, database_name, config):
     """
-    Load partition
+    Load partition of several tables at once
     Args:
       db_bucket (string): the name of the database that stores athena logs
-      table_name (string): the name of the table that needs partition
-      stack_name (string): the name of the cloudformation stack
-      msck_key (string): the key of the msck file
+      tables (list): (table_name, msck_key) of the tables that need partition
+      database_name (string): the name of the athena database
       config (dict): athena config
     """
-
-    sql = 'MSCK REPAIR TABLE ' + table_name
-    context = {'Database': database_name}
-    print(f"MSCK: {sql}")
-    queryid = athena.start_query_execution(
-        QueryString=sql, QueryExecutionContext=context, ResultConfiguration=config)['QueryExecutionId']
-    check_result(queryid)
+    sqls = ['MSCK REPAIR TABLE ' + table_name for table_name, _ in tables]
+    print(f"MSCK: {sqls}")
+    outcomes = run_queries(athena, sqls, config, database=database_name)
     print("msck finished")
-    # write msck file to db bucket
-    try:
-        s3.put_object(Bucket=db_bucket, Key=msck_key,
-                      Body="MSCK completed for %s" % (db_bucket,))
-    except Exception as e:
-        print(f"Error: {e} Unable to write msck file - msck command will run again")
+    for (table_name, msck_key), outcome in zip(tables, outcomes):
+        if not outcome.succeeded:
+            print(f"msck of {table_name} {outcome.state} - msck command will run again")
+            continue
+        # write msck file to db bucket
+        try:
+            s3.put_object(Bucket=db_bucket, Key=msck_key,
+                          Body="MSCK completed for %s" % (db_bucket,))
+        except Exception as e:
+            print(f"Error: {e} Unable to write msck file - msck command will run again")
+
+
+def projection_properties(from_bucket, pre):
+    """
+    TBLPROPERTIES projecting the year=/month=/day= layout written by the sttm lambda
+    """
+    return ["'projection.enabled'='true'",
+            "'projection.year.type'='integer'",
+            f"'projection.year.range'='{PROJECTION_YEAR_RANGE}'",
+            "'projection.month.type'='integer'",
+            "'projection.month.range'='1,12'",
+            "'projection.month.digits'='2'",
+            "'projection.day.type'='integer'",
+            "'projection.day.range'='1,31'",
+            "'projection.day.digits'='2'",
+            f"'storage.location.template'='s3://{from_bucket}/athena/{pre}/"
+            "year=${year}/month=${month}/day=${day}/'"]
 
 
-def create_table(database_name, from_bucket, stack_name, pre, schemas, config):
+def table_sql(database_name, from_bucket, stack_name, pre, schemas, output_format='csv',
+              partition_projection=False):
     """
-    Use athena to create tables, then check if the msck_file exits, if not, load partition
+    Build the CREATE TABLE statement of one table
     Args:
       database_name (string): the name of the database
       from_bucket (string): the name of the main bucket
       stack_name (string): the name of the cloudformation stack
       pre (string): one of the four output names
       schemas (list): schemas and their types
-      config (dict): athena config
-    """
+      output_format (string): csv for delimited text tables, parquet for STORED AS PARQUET tables
+      partition_projection (bool): declare partition projection
 
-    db_bucket = from_bucket + ".log"
-    print(f"Creating table in {database_name}")
+    Returns:
+      (table_name, sql)
+    """
 
-    schemas_type = [" ".join((schema['name'], schema['type']))
-                    for schema in schemas]
-    sql_schemas_type = ", ".join(schemas_type)
+    sql_schemas_type = ddl_columns(schemas, output_format)
     table_name = f"{pre}_{stack_name.replace('-','_')}"
+    properties = ["'has_encrypted_data'='false'"]
+    if output_format == 'parquet':
+        storage = "STORED AS PARQUET "
+        properties.append(f"'parquet.compression'='{PARQUET_COMPRESSION}'")
+    else:
+        storage = "ROW FORMAT DELIMITED FIELDS TERMINATED BY ','ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'"
+        properties.append("'skip.header.line.count'='1'")
+    if partition_projection:
+        properties.extend(projection_properties(from_bucket, pre))
     sql = (f"CREATE EXTERNAL TABLE IF NOT EXISTS {database_name}.{table_name} ({sql_schemas_type})"
-                   "PARTITIONED BY (retailer string)"
-                   "ROW FORMAT DELIMITED FIELDS TERMINATED BY ','ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'"
+                   "PARTITIONED BY (year string, month string, day string)"
+                   f"{storage}"
                    f"LOCATION 's3://{from_bucket}/athena/{pre}/'"
-                   "TBLPROPERTIES ('has_encrypted_data'='false','skip.header.line.count'='1')")
-    print(f"sql: {sql}")
-    queryid = athena.start_query_execution(QueryString=sql,
-                                           ResultConfiguration=config)['QueryExecutionId']
- 
-    check_result(queryid)
-    print(f"Table created: {database_name}.{table_name}")
-
-    msck_key = f"msck-completed-files/{stack_name}-msck-completed-{table_name}.txt"
-    # check if msck file exists
-    msck_result = check_msck_file(stack_name, db_bucket, msck_key)
-    if msck_result[0] == 'ok' and not msck_result[1]:
+                   f"TBLPROPERTIES ({','.join(properties)})")
+    return table_name, sql
+
+
+def create_tables(database_name, from_bucket, stack_name, data, config, output_format='csv',
+                  partition_projection=False):
+    """
+    Use athena to create all the tables concurrently, then load partition of the
+    tables whose msck_file doesn't exist yet
+    Args:
+      database_name (string): the name of the database
+      from_bucket (string): the name of the main bucket
+      stack_name (string): the name of the cloudformation stack
+      data (dict): output name -> schemas and their types
+      config (dict): athena config
+      output_format (string): csv for delimited text tables, parquet for STORED AS PARQUET tables
+      partition_projection (bool): declare partition projection, msck is then skipped
+    """
+
+    db_bucket = from_bucket + ".log"
+    print(f"Creating tables in {database_name}")
+
+    statements = [table_sql(database_name, from_bucket, stack_name, pre, data[pre], output_format,
+                            partition_projection)
+                  for pre in data]
+    for _, sql in statements:
+        print(f"sql: {sql}")
+    outcomes = run_queries(athena, [sql for _, sql in statements], config)
+
+    failed = [table_name for (table_name, _), outcome in zip(statements, outcomes) if not outcome.succeeded]
+    if failed:
+        raise RuntimeError(f"Unable to create tables {failed}")
+    print(f"Tables created: {[table_name for table_name, _ in statements]}")
+
+    if partition_projection:
+        print("Partition projection enabled, no msck needed")
+        return
+
+    to_repair = []
+    for table_name, _ in statements:
+        msck_key = f"msck-completed-files/{stack_name}-msck-completed-{table_name}.txt"
+        # check if msck file exists
+        msck_result = check_msck_file(stack_name, db_bucket, msck_key)
+        if msck_result[0] == 'ok' and not msck_result[1]:
+            to_repair.append((table_name, msck_key))
+        elif msck_result[0] == 'ok' and msck_result[1]:
+            print("Msck file exists")
+        elif msck_result[0] == 'fail':
+            print(
+                "unable to msck/partition due to error checking if msck file exists")
+    if to_repair:
         # do the partition
-        msck_repair(db_bucket, table_name,
-                    database_name, msck_key, config)
-    elif msck_result[0] == 'ok' and msck_result[1]:
-        print("Msck file exists")
-    elif msck_result[0] == 'fail':
-        print(
-            "unable to msck/partition due to error checking if msck file exists")
+        msck_repair(db_bucket, to_repair, database_name, config)
 
 
-def create_db(from_bucket, database_name, stack_name):
+def create_table(database_name, from_bucket, stack_name, pre, schemas, config, output_format='csv',
+                 partition_projection=False):
+    """
+    Create a single table, see create_tables
+    """
+    create_tables(database_name, from_bucket, stack_name, {pre: schemas}, config, output_format,
+                  partition_projection)
+
+
+def create_db(from_bucket, database_name, stack_name, output_format=OUTPUT_FORMAT,
+              partition_projection=PARTITION_PROJECTION):
     """
     Use athena to create database and triggers the function to create tables
     Args:
       from_bucket (string): the name of the main bucket
       database_name (string): the name of the database
       stack_name (string): the name of the cloudformation stack
+      output_format (string): storage format of the tables, csv or parquet
+      partition_projection (bool): use partition projection instead of msck/ALTER TABLE
     """
     db_bucket = from_bucket + ".log"
     config = {
         'OutputLocation': 's3://' + db_bucket + '/' + database_name.replace('_', '-'),
         'EncryptionConfiguration': {'EncryptionOption': 'SSE_S3'}
     }
+    recorder = MetricsRecorder(dimension_sets=[[]])
     sql = 'CREATE DATABASE IF NOT EXISTS ' + database_name
-    queryid = athena.start_query_execution(QueryString=sql,
-                                           ResultConfiguration=config)['QueryExecutionId']
-    check_result(queryid)
+    with recorder.stage("create_database"):
+        outcome = run_query(athena, sql, config)
+    if not outcome.succeeded:
+        recorder.flush()
+        raise RuntimeError(f"Unable to create database {database_name}: {outcome.reason}")
     print("DATABASE created, start creating TABLES")
 
-    # load the schemas and the schema types from a json config file
-    with open(json_file) as f:
-        data = json.load(f)
+    # the schemas and the schema types come from the schema registry
+    data = load_schemas()
+    # the daily rollups handler writes next to the raw output, always csv
+    rollups = rollup_tables()
+    recorder.count("Tables", len(data) + len(rollups))
     # create tables based on json info
-    for pre in data:
-        create_table(database_name, from_bucket, stack_name, pre, data[pre], config)
+    try:
+        with recorder.stage("create_tables"):
+            create_tables(database_name, from_bucket, stack_name, data, config, output_format,
+                          partition_projection)
+            if rollups:
+                create_tables(database_name, from_bucket, stack_name, rollups, config, 'csv',
+                              partition_projection)
+    finally:
+        recorder.flush()
     print("All TABLES created")
 
 
@@ -3,12 +3,14 @@
 # @Email: foamdino@gmail.com
 # Modified by: Dex
 import json
-import boto3
 import botocore
 from botocore.vendored import requests
 
-s3 = boto3.resource('s3')
-client = boto3.client('s3')
+from aws_clients import lazy_client, lazy_resource
+from metrics import MetricsRecorder
+
+s3 = lazy_resource('s3')
+client = lazy_client('s3')
 
 
 def can_access_bucket(bucket):
@@ -33,6 +35,17 @@ def can_access_bucket(bucket):
         return False
 
 
+def bucket_configuration():
+    """
+    CreateBucketConfiguration of a bucket in the region of the lambda,
+    us-east-1 takes none
+    """
+    region = client.meta.region_name
+    if region == 'us-east-1':
+        return {}
+    return {'CreateBucketConfiguration': {'LocationConstraint': region}}
+
+
 def createfolders(bucketName):
     """
     Create folders under a bucket
@@ -100,8 +113,7 @@ def handler(event, context):
 
             if not log_bucket or not can_access_bucket(log_bucket):
                 # create the bucket for storing athena logs
-                s3.create_bucket(Bucket=logbucketName, CreateBucketConfiguration={
-                    'LocationConstraint': 'ap-southeast-2'})
+                s3.create_bucket(Bucket=logbucketName, **bucket_configuration())
 
             if bucket and can_access_bucket(bucket):
                 print("Bucket %s already exists, skipping creation" %
@@ -110,9 +122,10 @@ def handler(event, context):
                 return
 
             print("start creating bucket")
+            recorder = MetricsRecorder(dimension_sets=[[]])
             # create the main bucket
-            s3.create_bucket(Bucket=bucketName, CreateBucketConfiguration={
-                             'LocationConstraint': 'ap-southeast-2'})
+            with recorder.stage("create_bucket"):
+                s3.create_bucket(Bucket=bucketName, **bucket_configuration())
 
             # set lambda NotificationConfiguration
             config = {
@@ -152,11 +165,22 @@ def handler(event, context):
                 ]
             }
 
-            client.put_bucket_notification_configuration(
-                Bucket=bucketName, NotificationConfiguration=config)
+            # batch ingest mode: the input events go to a queue read by the batch lambda
+            input_queue = event['ResourceProperties'].get('InputQueue')
+            if input_queue:
+                input_config = config['LambdaFunctionConfigurations'].pop(0)
+                config['QueueConfigurations'] = [{'QueueArn': input_queue,
+                                                  'Events': input_config['Events'],
+                                                  'Filter': input_config['Filter']}]
+
+            with recorder.stage("put_bucket_notification"):
+                client.put_bucket_notification_configuration(
+                    Bucket=bucketName, NotificationConfiguration=config)
 
             # create folders, please set the directories accordingly
-            createfolders(bucketName)
+            with recorder.stage("create_folders"):
+                createfolders(bucketName)
+            recorder.flush()
 
         # this lambda will be triggered when it's deleted in the cloudformation
         sendResponseCfn(event, context, "SUCCESS")
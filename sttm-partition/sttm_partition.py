@@ -2,70 +2,163 @@
 # @Email: foamdino@gmail.com
 # Modified by Dex
 """
-This lambda handles the CREATE TABLE command, the initial MSCK command
-and the ALTER TABLE ADD PARTITION command.
+This lambda handles the ALTER TABLE ADD PARTITION command.
+
+Partitions already registered are remembered in a registry made of an
+in-memory set, kept across warm invocations, backed by one marker object per
+partition in the log bucket. Only partitions missing from both are added, all
+the new partitions of a table in a single ALTER TABLE statement.
 """
-import time
-import boto3
 import botocore
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+from athena_executor import run_queries
+from aws_clients import lazy_client
+from metrics import MetricsRecorder
 
-s3 = boto3.client('s3')
-athena = boto3.client('athena', region_name='ap-southeast-2')
 
+MARKER_FOLDER = "partition-markers"
+# partition markers checked at the same time
+MARKER_WORKERS = 16
+# tables created with partition projection need no ALTER TABLE at all
+PARTITION_PROJECTION = os.environ.get('PartitionProjection', 'false').lower() == 'true'
 
-def check_partition(func):
-    def _decorator(stack_name, database_name, from_bucket, file_key):
-        file_path = '/'.join(file_key.split('/')[0:-1])
-        result = client.list_objects(Bucket=from_bucket, Prefix=file_path)
-        file_nums = len(result['Contents'])
-        print(f"Amount of files under {file_path}: {file_nums}")
-        if file_nums == 1:
-            partition(stack_name, database_name, from_bucket, file_key)
-        else:
-            print("No need for partition")
+s3 = lazy_client('s3', pool_connections=MARKER_WORKERS)
+athena = lazy_client('athena')
 
-    return _decorator
+# (table_name, year, month, day) of the partitions known to be registered
+_known_partitions = set()
 
 
-@check_partition
-def partition(stack_name, database_name, from_bucket, file_key):
+def parse_partition(file_key):
     """
-    Run ALTER TABLE command
+    Extract the partition of an object written by the sttm lambda
     Args:
-      stack_name (string): name of the cloud formation stack to differentiate between test and production
-      database_name (string): name of the athena database
-      from_bucket (string): name of the bucket which the input file originated from
-      parsed_time (datetime): datetime created by parsing the input filename, used in the partition command
+      file_key (string): athena/<table>/year=<y>/month=<m>/day=<d>/<file>
 
     Returns:
-      nothing
+      (table_name, year, month, day), None when the key is not partitioned
     """
-    print("Adding partition...")
     key_parts = file_key.split("/")
-    table_name = key_parts[1]
-    day = key_parts[-2]
-    month = key_parts[-3]
-    year = key_parts[-4]
+    if len(key_parts) < 6 or key_parts[0] != "athena":
+        return None
+    values = []
+    for name, part in zip(("year", "month", "day"), key_parts[-4:-1]):
+        if not part.startswith(name + "="):
+            return None
+        values.append(part[len(name) + 1:])
+    return (key_parts[1],) + tuple(values)
+
+
+def marker_key(partition):
+    table_name, year, month, day = partition
+    return f"{MARKER_FOLDER}/{table_name}/year={year}/month={month}/day={day}"
+
+
+def has_marker(logbucket_name, partition):
+    """
+    Check the durable marker of a partition
+    """
+    try:
+        s3.head_object(Bucket=logbucket_name, Key=marker_key(partition))
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != "404":
+            print(e)
+        return False
 
+
+def write_marker(logbucket_name, partition):
+    try:
+        s3.put_object(Bucket=logbucket_name, Key=marker_key(partition), Body="partition added")
+    except Exception as e:
+        print(f"Error: {e} Unable to write partition marker - partition will be added again")
+
+
+def new_partitions(logbucket_name, partitions):
+    """
+    Filter out the partitions known to the registry, looking at the in-memory
+    cache first and at the markers for the rest
+    """
+    unknown = [p for p in partitions if p not in _known_partitions]
+    if not unknown:
+        return []
+    with ThreadPoolExecutor(max_workers=min(MARKER_WORKERS, len(unknown))) as executor:
+        markers = list(executor.map(lambda p: has_marker(logbucket_name, p), unknown))
+    for partition, marked in zip(unknown, markers):
+        if marked:
+            _known_partitions.add(partition)
+    return [p for p, marked in zip(unknown, markers) if not marked]
+
+
+def partition_sql(database_name, table_name, stack_name, from_bucket, partitions):
+    """
+    Build one ALTER TABLE statement adding several partitions of a table
+    """
+    clauses = [f"PARTITION (year='{year}', month='{month}', day='{day}') "
+               f"LOCATION 's3://{from_bucket}/athena/{table_name}/year={year}/month={month}/day={day}/'"
+               for _, year, month, day in partitions]
+    return (f"ALTER TABLE {database_name}.{table_name}_{stack_name.replace('-','_')} "
+            f"ADD IF NOT EXISTS {' '.join(clauses)}")
+
+
+def partition(stack_name, database_name, from_bucket, partitions):
+    """
+    Run ALTER TABLE command, once per table, for the partitions missing from the registry
+    Args:
+      stack_name (string): name of the cloud formation stack to differentiate between test and production
+      database_name (string): name of the athena database
+      from_bucket (string): name of the bucket which the input files originated from
+      partitions (list): (table_name, year, month, day) of the partitions written to
+
+    Returns:
+      list: the partitions added
+    """
     logbucket_name = from_bucket.replace("_", "-") + '.log'
     print("using: " + logbucket_name)
 
+    recorder = MetricsRecorder(dimension_sets=[[]])
+    recorder.count("Partitions", len(set(partitions)))
+    with recorder.stage("check_registry"):
+        missing = new_partitions(logbucket_name, sorted(set(partitions)))
+    if not missing:
+        print("No need for partition")
+        recorder.flush()
+        return []
+
     config = {
-        'OutputLocation': 's3://' + logbucket_name + '/' + database_name.replace('_', '-'), ,
+        'OutputLocation': 's3://' + logbucket_name + '/' + database_name.replace('_', '-'),
         'EncryptionConfiguration': {'EncryptionOption': 'SSE_S3'}
     }
 
-    # Query Execution Parameters
-    sql = f"ALTER TABLE {database_name}.{table_name}_{stack_name.replace('-','_')} ADD PARTITION ({year},{month},{day})"
-    print(f'Partition sql: {sql}')
-    context = {'Database': database_name}
-    s3.start_query_execution(QueryString=sql,
-                             QueryExecutionContext=context,
-                             ResultConfiguration=config)
+    by_table = {}
+    for p in missing:
+        by_table.setdefault(p[0], []).append(p)
+
+    sqls = []
+    for table_name, table_partitions in by_table.items():
+        print(f"Adding {len(table_partitions)} partition(s) to {table_name}...")
+        sqls.append(partition_sql(database_name, table_name, stack_name, from_bucket, table_partitions))
+        print(f'Partition sql: {sqls[-1]}')
+    with recorder.stage("add_partitions"):
+        outcomes = run_queries(athena, sqls, config, database=database_name)
+
+    added = []
+    with recorder.stage("write_markers"):
+        for (table_name, table_partitions), outcome in zip(by_table.items(), outcomes):
+            if not outcome.succeeded:
+                print(f"Partition of {table_name} failed")
+                continue
+            for p in table_partitions:
+                write_marker(logbucket_name, p)
+                _known_partitions.add(p)
+            added.extend(table_partitions)
+    recorder.count("PartitionsAdded", len(added))
+    recorder.flush()
     print("Partition added")
+    return added
 
 
 def handler(event, context):
@@ -76,16 +169,23 @@ def handler(event, context):
       event (dict): the aws event that triggered the lambda
       context (dict): the aws context the lambda runs under
     """
-    print(event['Records'][0]['s3']['object']['key'])
+    if PARTITION_PROJECTION:
+        print("Partition projection enabled, nothing to add")
+        return
+
     stack_name = os.environ['StackName']
     database_name = os.environ['DatabaseName'].replace('-', '_')
     print("stack_name: %s" % (stack_name),)
-    from_bucket = event['Records'][0]['s3']['bucket']['name']
-    print("from_bucket: %s" % (from_bucket,))
-    filekey = event['Records'][0]['s3']['object']['key'].replace("%3D", "=")
-    print("filekey: %s" % (filekey,))
-    filename = filekey.split('/')[-1]
-    print("filename: %s" % (filename,))
-
-    # need to add partition no matter it's the first input file or not
-    partition(stack_name, database_name, from_bucket, filekey)
+
+    partitions_by_bucket = {}
+    for record in event['Records']:
+        from_bucket = record['s3']['bucket']['name']
+        filekey = record['s3']['object']['key'].replace("%3D", "=")
+        print("filekey: %s" % (filekey,))
+        p = parse_partition(filekey)
+        if p is not None:
+            partitions_by_bucket.setdefault(from_bucket, []).append(p)
+
+    for from_bucket, partitions in partitions_by_bucket.items():
+        print("from_bucket: %s" % (from_bucket,))
+        partition(stack_name, database_name, from_bucket, partitions)
@@ -0,0 +1,213 @@
+"""
+Bulk backfill of STTM history.
+
+Reprocesses every STTM file of a local directory or an S3 prefix with the
+same transform as handler, spread over a process pool. The partitioned output,
+split by gas_date with PartitionBy "gas_date", is written straight under
+athena/ of the destination bucket, without the input/processing/done moves.
+All the partitions touched are registered once at the end.
+
+Usage:
+  python backfill.py <directory | s3://bucket/prefix> --bucket <bucket>
+                     [--workers N] [--register --stack-name S --database-name D]
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# the shared modules are only copied next to handler in the lambda bundle
+if not os.path.exists(os.path.join(HERE, "metrics.py")):
+    sys.path.append(os.path.join(HERE, "..", "sttm-common"))
+
+import aws_clients
+import handler
+from schema_registry import rollup_table_name
+from handler import FILE_TYPES, file_partition, output_file_name, process_file, put_output, \
+    s3_key_partition, select_engine
+
+
+# at most this many partitions per ALTER TABLE, athena caps the length of a statement
+PARTITIONS_PER_STATEMENT = 500
+
+# process the aws_clients were last set up in
+_clients_pid = None
+
+
+def list_sources(source):
+    """
+    List the STTM files of a local directory or of an s3://bucket/prefix
+    Returns:
+      list: local paths or (bucket, key) tuples
+    """
+    if source.startswith("s3://"):
+        bucket, _, prefix = source[len("s3://"):].partition("/")
+        paginator = aws_clients.client('s3').get_paginator('list_objects_v2')
+        sources = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith("/"):
+                    sources.append((bucket, obj['Key']))
+        return sources
+
+    sources = []
+    for root, _, files in os.walk(source):
+        for name in sorted(files):
+            sources.append(os.path.join(root, name))
+    return sources
+
+
+def init_worker():
+    """
+    Set the clients of a worker up on its first file: boto3 clients must not
+    be shared with the parent process. Not an initializer of the pool, those
+    need python 3.7
+    """
+    global _clients_pid
+    if _clients_pid != os.getpid():
+        aws_clients.reset()
+        handler.s3 = aws_clients.lazy_client('s3')
+        _clients_pid = os.getpid()
+
+
+def backfill_file(source, bucket):
+    """
+    Transform one file and write it to its partition
+    Args:
+      source: local path or (bucket, key)
+      bucket (string): destination bucket
+
+    Returns:
+      dict: the source, its status and the (table_name, year, month, day)
+        partitions written, the rollup one included
+    """
+    init_worker()
+    result = {"source": source, "status": None, "partitions": [], "error": None}
+    try:
+        if isinstance(source, tuple):
+            file_name = source[1].split("/")[-1]
+        else:
+            file_name = os.path.basename(source)
+
+        file_type_conf = FILE_TYPES.get(file_name[:6].upper())
+        if file_type_conf is None:
+            result["status"] = "wrong_format"
+            return result
+        table_name = file_type_conf["table_name"]
+
+        year, month, day = file_partition(file_name)
+        key = s3_key_partition(table_name, year, month, day, output_file_name(file_name))
+        rollup = handler.new_rollup(table_name)
+
+        if isinstance(source, tuple):
+            obj = handler.get_object(source[0], source[1])
+            size = obj.get('ContentLength', 0)
+            if handler.use_spool(size):
+                # large history files: ranged download, parsed from the map straight into a multipart upload
+                spool = handler.SpooledDownload(source[0], source[1], size, obj['Body'], obj.get('ETag'))
+                try:
+                    written = handler.stream_process_file(
+                        file_name, spool.download(), file_type_conf["params"], bucket, key, table_name,
+                        file_type_conf["date_formats"], select_engine(size), rollup=rollup,
+                        partition=(year, month, day))
+                finally:
+                    spool.close()
+                raw = None
+            else:
+                raw = obj['Body'].read()
+        else:
+            with open(source, "rb") as f:
+                raw = f.read()
+
+        if raw is not None:
+            engine = select_engine(len(raw))
+            data = StringIO(raw.decode('utf-8', 'ignore'))
+            outputs = process_file(file_name, data, file_type_conf["params"], table_name,
+                                   file_type_conf["date_formats"], engine, rollup=rollup, partition=(year, month, day))
+            written = []
+            for partition, output in outputs or []:
+                put_output(bucket, s3_key_partition(table_name, partition[0], partition[1], partition[2],
+                                                    output_file_name(file_name)), output)
+                written.append(partition)
+        if not written:
+            result["status"] = "error"
+            return result
+
+        result["partitions"].extend((table_name,) + tuple(partition) for partition in written)
+        if rollup is not None and len(rollup):
+            result["partitions"].extend((rollup_table_name(table_name),) + tuple(partition) for partition in
+                                        handler.put_rollup(bucket, rollup, year, month, day, file_name))
+        result["status"] = "done"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+    return result
+
+
+def register_partitions(partitions, bucket, stack_name, database_name):
+    """
+    Register the partitions touched by the backfill with the sttm_partition registry
+    """
+    # the shared lambda modules sit next to this folder in a checkout
+    for folder in ("sttm-common", "sttm-partition"):
+        path = os.path.join(HERE, "..", folder)
+        if path not in sys.path:
+            sys.path.append(path)
+    import sttm_partition
+
+    partitions = sorted(partitions)
+    for start in range(0, len(partitions), PARTITIONS_PER_STATEMENT):
+        sttm_partition.partition(stack_name, database_name.replace('-', '_'), bucket,
+                                 partitions[start:start + PARTITIONS_PER_STATEMENT])
+
+
+def backfill(source, bucket, workers=None):
+    """
+    Backfill every file of source into bucket
+    Returns:
+      list: the result of backfill_file for every file
+    """
+    sources = list_sources(source)
+    print("Backfilling %s file(s) from [%s] to [%s]" % (len(sources), source, bucket))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, result in enumerate(executor.map(backfill_file, sources, [bucket] * len(sources),
+                                                chunksize=8)):
+            results.append(result)
+            if result["status"] != "done":
+                print("[%s] %s %s" % (result["status"], result["source"], result["error"] or ""))
+            if (i + 1) % 100 == 0:
+                print("%s/%s files processed" % (i + 1, len(sources)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocess STTM history into the athena/ partitions")
+    parser.add_argument("source", help="local directory or s3://bucket/prefix holding STTM files")
+    parser.add_argument("--bucket", required=True, help="bucket the athena/ output is written to")
+    parser.add_argument("--workers", type=int, default=None, help="size of the process pool")
+    parser.add_argument("--register", action="store_true", help="add the touched partitions to athena")
+    parser.add_argument("--stack-name", help="stack of the tables, needed with --register")
+    parser.add_argument("--database-name", help="athena database, needed with --register")
+    args = parser.parse_args(argv)
+    if args.register and not (args.stack_name and args.database_name):
+        parser.error("--register needs --stack-name and --database-name")
+
+    results = backfill(args.source, args.bucket, args.workers)
+    partitions = set(partition for result in results for partition in result["partitions"])
+    done = sum(1 for result in results if result["status"] == "done")
+    failed = sum(1 for result in results if result["status"] in ("error", "failed"))
+    print("Backfill finished: %s/%s files written to %s partition(s), %s failed" %
+          (done, len(results), len(partitions), failed))
+
+    if args.register and partitions:
+        register_partitions(partitions, args.bucket, args.stack_name, args.database_name)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
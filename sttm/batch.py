@@ -0,0 +1,560 @@
+"""
+Micro-batching mode of the sttm lambda.
+
+Instead of one invocation per file, the S3 events of the input folder go to
+a queue and the files are taken from it in batches, up to BATCH_MAX_FILES
+files or BATCH_WINDOW_SECONDS. On AWS the SQS event source mapping of the
+batch lambda does the collecting (BatchSize and MaximumBatchingWindowInSeconds),
+poll does the same against any queue, the local stand-in of the benchmark
+included.
+
+Every file of a batch is read and parsed like in handler.process_record, then
+the outputs of the same (table, year, month, day) partition are written as a
+single object, and the rollups of the files of a partition as a single rollup.
+With PartitionBy "gas_date" a file contributes to the partition of every gas
+day it holds. The object is named after the files it holds, so a batch
+delivered again rewrites the same keys. Files too big for
+memory (handler.use_streaming) still go through process_record on their own.
+
+ZIP bundles of reports are batches delivered as one object: handler hands
+them to ingest_bundle, which runs their members through the same steps.
+"""
+import collections
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+from aws_clients import lazy_client
+from handler import (DEDUPLICATE, DONE_FOLDER, ERROR_FOLDER, FILE_TYPES, MAX_WORKERS, OUTPUT_FORMAT,
+                     PARQUET_COMPRESSION, PROCESSING_FOLDER, SORT_OUTPUT, STATE_TRACKING, STREAM_CHUNK_ROWS,
+                     archive_files, claim_content, content_hash, file_partition, frame_to_parquet, get_object,
+                     get_s3_key, is_bundle, move_file, new_rollup, output_file_name, output_writer, process_file,
+                     process_record, put_output, put_rollup, record_file, release_content, row_sort_key,
+                     s3_key_partition, select_engine, set_state, sort_frame, stream_content_hash,
+                     stream_process_file, use_streaming)
+from metrics import MetricsRecorder
+from rollup import DailyRollup
+
+
+sqs = lazy_client('sqs')
+
+BATCH_QUEUE_URL = os.environ.get("BatchQueueUrl", "")
+BATCH_MAX_FILES = int(os.environ.get("BatchMaxFiles", "100"))
+BATCH_WINDOW_SECONDS = float(os.environ.get("BatchWindowSeconds", "30"))
+# SQS hands out at most 10 messages per receive and long polls at most 20 seconds
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT_SECONDS = 20
+
+
+def s3_records(body):
+    """
+    S3 event records of a queue message, sent by S3 itself or through SNS
+    """
+    message = json.loads(body)
+    if "Message" in message and "Records" not in message:
+        message = json.loads(message["Message"])
+    # s3:TestEvent and other messages without records are ignored
+    return message.get("Records", [])
+
+
+def receive_batch(queue_url=BATCH_QUEUE_URL, max_files=BATCH_MAX_FILES, window_seconds=BATCH_WINDOW_SECONDS):
+    """
+    Collect S3 event records from a queue until max_files files or the end of the window
+    Returns:
+      (records, receipt handles of the messages they came from)
+    """
+    deadline = time.time() + window_seconds
+    records = []
+    receipts = []
+    while len(records) < max_files:
+        wait = int(max(0, min(SQS_MAX_WAIT_SECONDS, deadline - time.time())))
+        requested = min(SQS_MAX_MESSAGES, max_files - len(records))
+        messages = sqs.receive_message(QueueUrl=queue_url, WaitTimeSeconds=wait,
+                                       MaxNumberOfMessages=requested).get('Messages', [])
+        for message in messages:
+            records.extend(s3_records(message['Body']))
+            receipts.append(message['ReceiptHandle'])
+        # the window bounds the wait, messages already there are still taken
+        if time.time() >= deadline and len(messages) < requested:
+            break
+    return records, receipts
+
+
+def delete_messages(queue_url, receipts):
+    for start in range(0, len(receipts), SQS_MAX_MESSAGES):
+        entries = [{'Id': str(i), 'ReceiptHandle': receipt}
+                   for i, receipt in enumerate(receipts[start:start + SQS_MAX_MESSAGES])]
+        response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        for failed in response.get('Failed', []):
+            print("Unable to delete message %s: %s" % (failed['Id'], failed.get('Message')))
+
+
+def new_entry(bucket, key, file_name, table_name):
+    return {"bucket": bucket, "key": key, "status": None, "error": None, "archive": None,
+            "file_name": file_name, "table_name": table_name, "partition": None, "outputs": None,
+            "digest": None, "rollup": None}
+
+
+def parse_entry(entry, raw, recorder):
+    """
+    Claim the content of a file and parse it, the (partition, output) pairs and
+    the rollup are kept in the entry, or its status is set to duplicate or error
+    Args:
+      entry (dict): see new_entry, with bucket, file_name and table_name set
+      raw (bytes): content of the file
+      recorder (MetricsRecorder): gets the time of every step
+    """
+    file_name = entry["file_name"]
+    table_name = entry["table_name"]
+    size = len(raw)
+    if DEDUPLICATE:
+        digest = content_hash(raw)
+        with recorder.stage("claim_content"):
+            if not claim_content(entry["bucket"], table_name, digest):
+                print("Duplicate content, skipped ", file_name)
+                entry["status"] = "duplicate"
+                return entry
+        entry["digest"] = digest
+
+    file_type_conf = FILE_TYPES[file_name[:6].upper()]
+    rollup = new_rollup(table_name)
+    data = StringIO(raw.decode('utf-8', 'ignore'))
+    del raw
+    partition = file_partition(file_name)
+    with recorder.stage("process_file"):
+        outputs = process_file(file_name, data, file_type_conf["params"], table_name,
+                               file_type_conf["date_formats"], select_engine(size),
+                               recorder, rollup, partition)
+    if not outputs:
+        print("Error empty output ", file_name)
+        entry["status"] = "error"
+        return entry
+    entry.update(outputs=[((table_name,) + tuple(key), output) for key, output in outputs], rollup=rollup,
+                 partition=(table_name,) + partition)
+    return entry
+
+
+def load_file(record, recorder):
+    """
+    First half of process_record for one file of a batch: move or tag it,
+    read it, claim its content and parse it. The outputs are kept in the entry
+    until write_entries.
+    Returns:
+      dict: the result fields of process_record, plus the file name, table,
+        partition, outputs, claimed digest and rollup of the file
+    """
+    entry = new_entry(None, None, None, None)
+    tracked = STATE_TRACKING == "tags"
+    try:
+        bucket, key, file_name, file_type = record_file(record)
+        entry.update(bucket=bucket, key=key, file_name=file_name, table_name=file_type)
+        if file_name == "":
+            entry["status"] = "skipped"
+            return entry
+        if file_type is None:
+            print("wrong_format")
+            move_file(bucket, key, bucket, bucket + "/wrong_format/" + key)
+            entry["status"] = "wrong_format"
+            return entry
+
+        if tracked:
+            processing_key = key
+            set_state(bucket, key, "processing")
+        else:
+            processing_key = get_s3_key(PROCESSING_FOLDER, file_type, file_name)
+            move_file(bucket, key, bucket, processing_key)
+        # archived in one go once the batch is written, the state is set then
+        entry["archive"] = (processing_key, get_s3_key(DONE_FOLDER, file_type, file_name), None)
+
+        with recorder.stage("get_object"):
+            raw = get_object(bucket, processing_key)['Body'].read()
+        recorder.count("BytesIn", len(raw), "Bytes")
+        parse_entry(entry, raw, recorder)
+    except Exception as e:
+        print(e)
+        entry["status"] = "failed"
+        entry["error"] = str(e)
+        entry["archive"] = None
+        if tracked and entry["key"]:
+            try:
+                set_state(entry["bucket"], entry["key"], "failed")
+            except Exception as tag_error:
+                print(tag_error)
+    return entry
+
+
+def batch_name(entries):
+    """
+    Name of the object of a partition, a digest of the files it holds so a
+    batch processed again rewrites the same object
+    """
+    names = "\n".join(sorted(entry["file_name"] for entry in entries))
+    return "batch-%s.csv" % (hashlib.sha1(names.encode('utf-8')).hexdigest()[:16],)
+
+
+def combine_parquet(outputs, table_name=None):
+    """
+    Concatenate the parquet outputs of one table into a single file, sorted
+    again with SORT_OUTPUT
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.concat_tables([pq.read_table(pa.BufferReader(output)) for output in outputs])
+    if SORT_OUTPUT and table_name:
+        return frame_to_parquet(sort_frame(table.to_pandas(), table_name), table_name)
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer, compression=PARQUET_COMPRESSION, use_deprecated_int96_timestamps=True)
+    return buffer.getvalue().to_pybytes()
+
+
+def write_partition(bucket, partition, pieces, recorder):
+    """
+    Write the outputs of the files of one partition as one object
+    Args:
+      bucket (string): destination bucket
+      partition (tuple): (table_name, year, month, day)
+      pieces (list): [entry, output] of every file with rows in the partition,
+        same header for csv
+      recorder (MetricsRecorder): gets the bytes written
+    """
+    table_name, year, month, day = partition
+    name = batch_name([entry for entry, _ in pieces])
+    key = s3_key_partition(table_name, year, month, day, output_file_name(name))
+    if OUTPUT_FORMAT == "parquet":
+        written = put_output(bucket, key, combine_parquet([output for _, output in pieces], table_name))
+    else:
+        writer = output_writer(bucket, key)
+        try:
+            header = pieces[0][1].partition("\n")[0]
+            sort_key = row_sort_key(next(csv.reader([header])), table_name) if len(pieces) > 1 else None
+            if sort_key is not None:
+                merge_sorted(writer, header, pieces, sort_key)
+            else:
+                writer.write(header + "\n")
+                for piece in pieces:
+                    rows = piece[1].partition("\n")[2]
+                    if rows:
+                        writer.write(rows if rows.endswith("\n") else rows + "\n")
+                    # free each output as soon as it is shipped
+                    piece[1] = None
+            writer.close()
+        except Exception:
+            writer.abort()
+            raise
+        written = writer.bytes_written
+    recorder.count("BytesOut", written, "Bytes")
+    print("Wrote %s file(s) to [%s]" % (len(pieces), key))
+    return key
+
+
+def merge_sorted(writer, header, pieces, sort_key):
+    """
+    Write the rows of sorted csv outputs with one header, merged in order of
+    sort_key
+    """
+    def rows_of(piece):
+        output, piece[1] = piece[1], None
+        return csv.reader(StringIO(output.partition("\n")[2]))
+
+    buffer = StringIO()
+    rows = csv.writer(buffer, lineterminator="\n")
+    writer.write(header + "\n")
+    for i, row in enumerate(heapq.merge(*[rows_of(piece) for piece in pieces], key=sort_key), 1):
+        rows.writerow(row)
+        if i % STREAM_CHUNK_ROWS == 0:
+            writer.write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+    writer.write(buffer.getvalue())
+
+
+def partition_groups(entries):
+    """
+    Group the outputs of the parsed entries by bucket and partition, csv
+    outputs also by header so a report whose columns changed gets its own
+    object. The outputs are handed over to the groups.
+    Returns:
+      dict: (bucket, partition, header) -> [entry, output] pieces
+    """
+    groups = {}
+    for entry in entries:
+        if not entry["outputs"]:
+            continue
+        for partition, output in entry["outputs"]:
+            header = output.partition("\n")[0] if OUTPUT_FORMAT == "csv" else None
+            groups.setdefault((entry["bucket"], partition, header), []).append([entry, output])
+        entry["outputs"] = None
+    return groups
+
+
+def write_group(bucket, partition, pieces, recorder):
+    """
+    write_partition, an entry is done once all of its outputs are written and
+    failed as soon as one of them is not
+    """
+    try:
+        write_partition(bucket, partition, pieces, recorder)
+        status, error = "done", None
+    except Exception as e:
+        print("Unable to write [%s]: %s" % (partition, e))
+        status, error = "failed", str(e)
+    for entry, _ in pieces:
+        if entry["status"] != "failed":
+            entry["status"] = status
+            entry["error"] = error
+
+
+def write_rollups(entries):
+    """
+    Merge the rollups of the files written by partition of their name and
+    write them, put_rollup splits them by gas day with PartitionBy "gas_date".
+    The files whose rollup cannot be written are failed.
+    """
+    groups = {}
+    for entry in entries:
+        if entry["status"] == "done" and entry["rollup"] is not None and len(entry["rollup"]):
+            groups.setdefault((entry["bucket"], entry["partition"]), []).append(entry)
+    for (bucket, (table_name, year, month, day)), group in groups.items():
+        rollup = DailyRollup(table_name)
+        for entry in group:
+            rollup.merge(entry["rollup"])
+        try:
+            put_rollup(bucket, rollup, year, month, day, batch_name(group))
+        except Exception as e:
+            print("Unable to write the rollup of [%s]: %s" % ((table_name, year, month, day), e))
+            for entry in group:
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+
+
+def write_entries(entries, recorder, executor=None):
+    """
+    Write the outputs of the parsed entries, one object per partition, then
+    their rollups, and set the status of every entry written
+    Args:
+      entries (list): see new_entry
+      recorder (MetricsRecorder): gets the time of every step and the counts
+      executor (ThreadPoolExecutor): writes the partitions concurrently, if any
+    """
+    groups = partition_groups(entries)
+    recorder.count("Partitions", len(groups))
+    mapper = executor.map if executor is not None else map
+    with recorder.stage("write_partitions"):
+        list(mapper(lambda item: write_group(item[0][0], item[0][1], item[1], recorder), groups.items()))
+    with recorder.stage("write_rollups"):
+        write_rollups(entries)
+
+
+def process_batch(records):
+    """
+    Process the files of a batch of S3 event records, one object per partition
+    Returns:
+      list: one result per record, see handler.process_record
+    """
+    recorder = MetricsRecorder(dimension_sets=[[]])
+    recorder.count("Records", len(records))
+    if not records:
+        return []
+    # files too big to hold in memory are streamed on their own, bundles are batches already
+    direct = []
+    batched = []
+    for record in records:
+        if use_streaming(record['s3']['object'].get('size', 0)) or is_bundle(record['s3']['object']['key']):
+            direct.append(record)
+        else:
+            batched.append(record)
+
+    workers = max(1, min(MAX_WORKERS, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        with recorder.stage("load_files"):
+            entries = list(executor.map(lambda record: load_file(record, recorder), batched))
+        write_entries(entries, recorder, executor)
+        results = list(executor.map(process_record, direct))
+
+    archives = {}
+    for entry in entries:
+        if entry["digest"] is not None:
+            release_content(entry["bucket"], entry["table_name"], entry["digest"], entry["file_name"],
+                            entry["status"] == "done")
+        if entry["archive"] is None:
+            continue
+        if entry["status"] == "failed":
+            # the batch object was not written, the file stays in processing or is tagged failed
+            entry["archive"] = None
+            if STATE_TRACKING == "tags":
+                try:
+                    set_state(entry["bucket"], entry["key"], "failed")
+                except Exception as tag_error:
+                    print(tag_error)
+            continue
+        processing_key, done_key, _ = entry["archive"]
+        if entry["status"] == "error":
+            entry["archive"] = (processing_key, get_s3_key(ERROR_FOLDER, entry["table_name"], entry["file_name"]),
+                                "error")
+        else:
+            entry["archive"] = (processing_key, done_key, "done")
+        archives.setdefault(entry["bucket"], []).append(entry["archive"])
+    for result in results:
+        if result["archive"]:
+            archives.setdefault(result["bucket"], []).append(result["archive"])
+
+    for bucket, bucket_archives in archives.items():
+        with recorder.stage("archive_files"):
+            unarchived = set(archive_files(bucket, bucket_archives))
+        for entry in entries + results:
+            if entry["bucket"] == bucket and entry["archive"] and entry["archive"][0] in unarchived:
+                entry["error"] = "not archived"
+
+    results = [{name: entry[name] for name in ("bucket", "key", "status", "error", "archive")}
+               for entry in entries] + results
+    for result in results:
+        print("[%s] %s %s" % (result["status"], result["key"], result["error"] or ""))
+        if result["status"] in ("duplicate", "error", "failed"):
+            recorder.count(result["status"].capitalize() + "Files")
+    recorder.count("Files", len(results))
+    recorder.flush()
+    return results
+
+
+def stream_member(bundle, info, entry, recorder):
+    """
+    Stream a member too big for memory straight to its own object, like
+    process_record streams big files
+    """
+    bucket, file_name, table_name = entry["bucket"], entry["file_name"], entry["table_name"]
+    year, month, day = file_partition(file_name)
+    file_type_conf = FILE_TYPES[file_name[:6].upper()]
+    rollup = new_rollup(table_name)
+    key = s3_key_partition(table_name, year, month, day, output_file_name(file_name))
+    if DEDUPLICATE:
+        # claimed before the member is parsed, it is decompressed a second time for the transform
+        with bundle.open(info) as member, recorder.stage("content_hash"):
+            digest = stream_content_hash(member)
+        with recorder.stage("claim_content"):
+            if not claim_content(bucket, table_name, digest):
+                entry["status"] = "duplicate"
+                return
+        entry["digest"] = digest
+    with bundle.open(info) as member:
+        written = stream_process_file(file_name, member, file_type_conf["params"], bucket, key, table_name,
+                                      file_type_conf["date_formats"], select_engine(info.file_size),
+                                      recorder, rollup, (year, month, day))
+    if written and rollup is not None and len(rollup):
+        put_rollup(bucket, rollup, year, month, day, file_name)
+    entry["status"] = "done" if written else "error"
+
+
+def load_member(bundle, info, entry, recorder):
+    """
+    Parse one member of a bundle into its entry, see parse_entry
+    """
+    try:
+        recorder.count("BytesIn", info.file_size, "Bytes")
+        if use_streaming(info.file_size):
+            stream_member(bundle, info, entry, recorder)
+        else:
+            with bundle.open(info) as member:
+                raw = member.read()
+            parse_entry(entry, raw, recorder)
+    except Exception as e:
+        print("Unable to ingest member [%s]: %s" % (entry["key"], e))
+        entry["status"] = "failed"
+        entry["error"] = str(e)
+    return entry
+
+
+def ingest_bundle(bucket, body, recorder):
+    """
+    Ingest every STTM report of a ZIP bundle. Members are routed through
+    FILE_TYPES by the prefix of their name, others are skipped. The members
+    whose names share a (table, year, month, day) partition are parsed together
+    on the worker pool and written with write_entries, then the next partition
+    is taken, so only the outputs of one partition are held in memory. Members are decompressed
+    as they are read, the archive is never extracted.
+    Args:
+      bucket (string): bucket the outputs are written to
+      body (file object): seekable content of the archive
+      recorder (MetricsRecorder): gets the time of every step and the counts
+
+    Returns:
+      Counter: member status -> number of members
+    """
+    statuses = collections.Counter()
+    with zipfile.ZipFile(body) as bundle:
+        members = []
+        for info in bundle.infolist():
+            file_name = info.filename.rsplit("/", 1)[-1]
+            if not file_name:
+                continue
+            file_type_conf = FILE_TYPES.get(file_name[:6].upper())
+            if file_type_conf is None:
+                print("Skipping member [%s]" % (info.filename,))
+                statuses["skipped"] += 1
+                continue
+            table_name = file_type_conf["table_name"]
+            members.append(((table_name,) + tuple(file_partition(file_name)), info,
+                            new_entry(bucket, info.filename, file_name, table_name)))
+        print("Bundle of %s report(s), %s other member(s)" % (len(members), statuses["skipped"]))
+        recorder.count("Members", len(members))
+
+        members.sort(key=lambda member: (member[0], member[1].filename))
+        workers = max(1, min(MAX_WORKERS, len(members)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for partition, group in itertools.groupby(members, key=lambda member: member[0]):
+                entries = list(executor.map(lambda member: load_member(bundle, member[1], member[2], recorder),
+                                            group))
+                write_entries(entries, recorder, executor)
+                for entry in entries:
+                    if entry["digest"] is not None:
+                        release_content(bucket, entry["table_name"], entry["digest"], entry["file_name"],
+                                        entry["status"] == "done")
+                    statuses[entry["status"]] += 1
+                    if entry["status"] in ("error", "failed"):
+                        print("[%s] %s %s" % (entry["status"], entry["key"], entry["error"] or ""))
+    return statuses
+
+
+def poll(queue_url=BATCH_QUEUE_URL, max_files=BATCH_MAX_FILES, window_seconds=BATCH_WINDOW_SECONDS):
+    """
+    Take one batch from the queue and process it, its messages are deleted
+    once every file has a final status
+    Returns:
+      list: the results of process_batch
+    """
+    records, receipts = receive_batch(queue_url, max_files, window_seconds)
+    print("Received %s record(s) in %s message(s)" % (len(records), len(receipts)))
+    results = process_batch(records)
+    delete_messages(queue_url, receipts)
+    return results
+
+
+def handler(event, context):
+    """
+    Lambda handler of the batch mode. Invoked by the SQS event source mapping
+    with the messages of a batch, or on a schedule with no records to poll
+    BATCH_QUEUE_URL itself
+
+    Args:
+      event (dict): the aws event that triggered the lambda
+      context (dict): the aws context the lambda runs under
+
+    Returns:
+      list: one result per S3 record, see process_batch
+    """
+    messages = (event or {}).get('Records')
+    if not messages:
+        return poll()
+    records = []
+    for message in messages:
+        records.extend(s3_records(message['body']))
+    print("Received %s record(s) in %s message(s)" % (len(records), len(messages)))
+    # the event source mapping deletes the messages when the invocation succeeds
+    return process_batch(records)
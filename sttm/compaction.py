@@ -0,0 +1,313 @@
+"""
+This lambda merges the small csv objects of the athena/ partitions written by
+handler into size-targeted files.
+
+Only objects older than COMPACT_MIN_AGE_SECONDS are picked up, so files that
+handler is still writing are left alone. A merged object keeps a single header
+line to match 'skip.header.line.count'='1'.
+
+The merged object is staged under a hidden "_" key, which athena ignores, and
+swapped in for its sources: the sources are deleted, then the staged object
+is copied into place. S3 cannot replace several objects at once, and
+publishing first would have every row of the batch read twice until the
+sources are gone, so a query running between the delete and the copy,
+usually well under a second, misses the rows of the batch instead. If any
+source changed in the meantime, the staged object is deleted and the sources
+are kept. Sources delete_objects fails to remove are retried, and if some are
+still there the published object only holds the rows of the sources that are
+gone, the others stay as they are. A publish that still fails after its
+retries writes the deleted sources back from the staged object.
+
+Only objects with the extension of the current OutputCompression are merged,
+they are decompressed to strip their header and the merged object is written
+with the same codec.
+"""
+import datetime
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aws_clients
+from handler import s3, ATHENA_FOLDER, CSV_EXTENSION, ROLLUP_TABLES, TABLES_NAME, decompress_output, \
+    output_writer
+
+
+# objects at least this big are already fine for athena
+COMPACT_SMALL_OBJECT_BYTES = int(os.environ.get("CompactSmallObjectBytes", str(8 * 1024 * 1024)))
+COMPACT_TARGET_BYTES = int(os.environ.get("CompactTargetBytes", str(128 * 1024 * 1024)))
+COMPACT_MIN_AGE_SECONDS = int(os.environ.get("CompactMinAgeSeconds", "900"))
+COMPACT_WORKERS = int(os.environ.get("CompactWorkers", "8"))
+COMPACTED_PREFIX = "compacted-"
+# athena skips objects whose name starts with _
+STAGING_PREFIX = "_"
+COMPACT_DELETE_ATTEMPTS = int(os.environ.get("CompactDeleteAttempts", "3"))
+COMPACT_PUBLISH_ATTEMPTS = int(os.environ.get("CompactPublishAttempts", "3"))
+
+aws_clients.declare('s3', COMPACT_WORKERS)
+
+
+def list_objects(bucket, prefix):
+    """
+    List every object under a prefix
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def list_partitions(bucket, table_name):
+    """
+    Find the year=/month=/day= prefixes of a table that hold objects
+    """
+    partitions = set()
+    for obj in list_objects(bucket, "%s/%s/" % (ATHENA_FOLDER, table_name)):
+        partitions.add(obj['Key'].rsplit("/", 1)[0] + "/")
+    return sorted(partitions)
+
+
+def list_candidates(bucket, prefix, now=None):
+    """
+    Small, settled csv objects sitting directly in a partition, the size
+    compared with COMPACT_SMALL_OBJECT_BYTES is the compressed one
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    oldest = now - datetime.timedelta(seconds=COMPACT_MIN_AGE_SECONDS)
+    candidates = []
+    for obj in list_objects(bucket, prefix):
+        name = obj['Key'][len(prefix):]
+        # athena ignores hidden files, leave them and sub folders alone
+        if "/" in name or name.startswith(("_", ".")) or not name.endswith(CSV_EXTENSION):
+            continue
+        if obj['Size'] >= COMPACT_SMALL_OBJECT_BYTES or obj['LastModified'] > oldest:
+            continue
+        candidates.append(obj)
+    return sorted(candidates, key=lambda obj: obj['Key'])
+
+
+def plan_batches(objects, target_bytes=COMPACT_TARGET_BYTES):
+    """
+    Group objects into batches of about target_bytes, batches of a single
+    object are dropped as there is nothing to merge
+    """
+    batches = []
+    batch = []
+    size = 0
+    for obj in objects:
+        if batch and size + obj['Size'] > target_bytes:
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(obj)
+        size += obj['Size']
+    if batch:
+        batches.append(batch)
+    return [batch for batch in batches if len(batch) > 1]
+
+
+def delete_sources(bucket, prefix, keys):
+    """
+    Delete the sources of a merged object, retrying the keys delete_objects
+    reports in Errors
+    Returns:
+      list: the keys still in the partition after the last attempt
+    """
+    remaining = list(keys)
+    for attempt in range(COMPACT_DELETE_ATTEMPTS):
+        if attempt:
+            time.sleep(0.2 * 2 ** attempt)
+        try:
+            response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in remaining],
+                                                                'Quiet': True})
+            errors = response.get('Errors', [])
+            remaining = [error['Key'] for error in errors]
+            if errors:
+                print("Unable to delete %s source(s) of [%s]: %s" % (len(errors), prefix, errors[0].get('Message')))
+        except Exception as e:
+            print("Unable to delete the sources of [%s]: %s" % (prefix, e))
+        if not remaining:
+            return []
+    # a failed call may still have deleted some of them, the listing tells
+    present = set(obj['Key'] for obj in list_objects(bucket, prefix))
+    return [key for key in keys if key in present]
+
+
+def write_rows(bucket, key, header, body, sections):
+    """
+    Write an object from some of the sections of an uncompressed staged object
+    Args:
+      sections (list): (start, end) offsets of the rows to keep in body
+    """
+    upload = output_writer(bucket, key)
+    try:
+        upload.write(header + b"\n")
+        for start, end in sections:
+            upload.write(body[start:end])
+        upload.close()
+    except Exception:
+        upload.abort()
+        raise
+
+
+def read_staged(bucket, staged_key):
+    return decompress_output(staged_key, s3.get_object(Bucket=bucket, Key=staged_key)['Body'].read())
+
+
+def publish(bucket, staged_key, merged_key, header, sections=None):
+    """
+    Copy the staged object into place, or only some of its sections, retried
+    COMPACT_PUBLISH_ATTEMPTS times
+    Returns:
+      bool: True once the merged object is written
+    """
+    for attempt in range(COMPACT_PUBLISH_ATTEMPTS):
+        if attempt:
+            time.sleep(0.2 * 2 ** attempt)
+        try:
+            if sections is None:
+                s3.copy({'Bucket': bucket, 'Key': staged_key}, bucket, merged_key)
+            else:
+                write_rows(bucket, merged_key, header, read_staged(bucket, staged_key), sections)
+            return True
+        except Exception as e:
+            print("Unable to publish [%s]: %s" % (merged_key, e))
+    return False
+
+
+def restore_sources(bucket, staged_key, header, sources):
+    """
+    Write deleted sources back from the staged object, their rows must not
+    stay out of the partition when the merged object cannot be published
+    Args:
+      sources (list): (key, (start, end)) of every source to write back
+    """
+    body = read_staged(bucket, staged_key)
+    for key, section in sources:
+        write_rows(bucket, key, header, body, [section])
+
+
+def merge_batch(bucket, prefix, batch):
+    """
+    Merge a batch of objects into one, then swap it in for the sources
+    Args:
+      bucket (string): name of the bucket
+      prefix (string): the partition prefix, ending with /
+      batch (list): list_objects entries of the objects to merge
+
+    Returns:
+      dict: the merged key, the number of objects it replaced and the keys
+        of the sources that could not be deleted, left out of it. The key is
+        None when nothing was replaced.
+    """
+    stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    merged_name = "%s%s-%s%s" % (COMPACTED_PREFIX, stamp, uuid.uuid4().hex[:8], CSV_EXTENSION)
+    merged_key = prefix + merged_name
+    staged_key = prefix + STAGING_PREFIX + merged_name
+    upload = output_writer(bucket, staged_key)
+    header = None
+    merged = []
+    # (start, end) of the rows of every merged source in the uncompressed staged object
+    sections = []
+    offset = 0
+    try:
+        for obj in batch:
+            body = s3.get_object(Bucket=bucket, Key=obj['Key'], IfMatch=obj['ETag'])['Body'].read()
+            body = decompress_output(obj['Key'], body)
+            first_line, _, rows = body.partition(b"\n")
+            if header is None:
+                header = first_line
+                upload.write(header + b"\n")
+                offset = len(header) + 1
+            elif first_line != header:
+                print("Header of [%s] differs, left out of [%s]" % (obj['Key'], merged_key))
+                continue
+            if rows and not rows.endswith(b"\n"):
+                rows += b"\n"
+            if rows:
+                upload.write(rows)
+            sections.append((offset, offset + len(rows)))
+            offset += len(rows)
+            merged.append(obj)
+        if len(merged) < 2:
+            upload.abort()
+            return {"key": None, "replaced": 0, "kept": []}
+        upload.close()
+    except Exception:
+        upload.abort()
+        raise
+
+    # a source rewritten since it was read would be lost, roll back instead
+    current = {obj['Key']: obj['ETag'] for obj in list_objects(bucket, prefix)}
+    changed = [obj['Key'] for obj in merged if current.get(obj['Key']) != obj['ETag']]
+    if changed:
+        print("Sources changed during compaction %s, dropping [%s]" % (changed, merged_key))
+        s3.delete_object(Bucket=bucket, Key=staged_key)
+        return {"key": None, "replaced": 0, "kept": []}
+
+    kept = set(delete_sources(bucket, prefix, [obj['Key'] for obj in merged]))
+    if len(kept) == len(merged):
+        print("No source of [%s] deleted, dropping it" % (merged_key,))
+        s3.delete_object(Bucket=bucket, Key=staged_key)
+        return {"key": None, "replaced": 0, "kept": sorted(kept)}
+    deleted = [(obj['Key'], section) for obj, section in zip(merged, sections) if obj['Key'] not in kept]
+    if kept:
+        # the sources still there must not be read twice
+        print("Sources %s not deleted, left out of [%s]" % (sorted(kept), merged_key))
+    if not publish(bucket, staged_key, merged_key, header, [section for _, section in deleted] if kept else None):
+        try:
+            restore_sources(bucket, staged_key, header, deleted)
+        except Exception:
+            # the rows of the deleted sources are only left in the staged object
+            print("Unable to restore the sources of [%s], their rows are kept in [%s]" % (merged_key, staged_key))
+            raise
+        print("Restored %s source(s) of [%s]" % (len(deleted), merged_key))
+        s3.delete_object(Bucket=bucket, Key=staged_key)
+        return {"key": None, "replaced": 0, "kept": sorted(kept)}
+    s3.delete_object(Bucket=bucket, Key=staged_key)
+    print("Compacted %s objects into [%s]" % (len(merged) - len(kept), merged_key))
+    return {"key": merged_key, "replaced": len(merged) - len(kept), "kept": sorted(kept)}
+
+
+def compact_partition(bucket, prefix):
+    """
+    Compact every batch of small objects in one partition
+    Returns:
+      list: the result of merge_batch for every batch
+    """
+    results = []
+    for batch in plan_batches(list_candidates(bucket, prefix)):
+        try:
+            results.append(merge_batch(bucket, prefix, batch))
+        except Exception as e:
+            print("Unable to compact a batch of [%s]: %s" % (prefix, e))
+    return results
+
+
+def handler(event, context):
+    """
+    Standard aws lambda handler function, compacts the partitions given in
+    the event ("partitions": list of prefixes) or every partition of the
+    tables given ("tables", all tables when missing)
+
+    Args:
+      event (dict): the aws event that triggered the lambda
+      context (dict): the aws context the lambda runs under
+    """
+    event = event or {}
+    bucket = event.get('bucket') or os.environ['BucketName']
+    partitions = event.get('partitions')
+    if not partitions:
+        partitions = []
+        for table_name in event.get('tables') or TABLES_NAME + ROLLUP_TABLES:
+            partitions.extend(list_partitions(bucket, table_name))
+    print("Compacting %s partition(s) of [%s]" % (len(partitions), bucket))
+
+    with ThreadPoolExecutor(max_workers=max(1, COMPACT_WORKERS)) as executor:
+        results = list(executor.map(lambda prefix: compact_partition(bucket, prefix), partitions))
+
+    merged = sum(1 for result in results for batch in result if batch["key"])
+    replaced = sum(batch["replaced"] for result in results for batch in result)
+    kept = sum(len(batch["kept"]) for result in results for batch in result)
+    print("Compaction finished: %s objects merged into %s, %s not deleted" % (replaced, merged, kept))
+    return {"merged": merged, "replaced": replaced, "kept": kept}
@@ -5,57 +5,136 @@ if sys.version_info[0] < 3:
 else:
     from io import StringIO
 
+import bz2
+import codecs
+import collections
 import csv
 import datetime
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
 import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-import pandas as pd
-from dateutil.parser import parse
+import botocore
 
+import schema_registry
+from aws_clients import lazy_client
+from metrics import MetricsRecorder
+from rollup import DailyRollup
 
+# pandas is imported inside the functions that need it, the csv engine
+# handles typical few-KB files without paying for its import
 
-s3 = boto3.client('s3')
 
 INPUT_FOLDER = "input"
 PROCESSING_FOLDER = "processing"
 DONE_FOLDER = "done"
 ERROR_FOLDER = "error"
 ATHENA_FOLDER = "athena"
+# ZIP bundles of reports go through processing/, done/ and error/ under this folder
+BUNDLE_FOLDER = "bundle"
+HASH_INDEX_FOLDER = "hash-index"
 
+# upper bound on the number of records of one event processed at the same time
+MAX_WORKERS = int(os.environ.get("MaxWorkers", "8"))
 
-FILE_TYPES = {
-    "INT651": {
-        "table_name": "STTM_INT651_ExAnteMarketPrice",
-        "params": {
-            "parse_dates": ["gas_date", "approval_datetime", "report_datetime"],
-            "dayfirst": True
-        }
-    },
-    "INT652": {
-        "table_name": "STTM_INT652_ExAnteScheduleQuantity",
-        "params": {
-            "parse_dates": ["gas_date", "approval_datetime", "report_datetime"],
-            "dayfirst": True
-        }
-    },
-    "INT654": {
-        "table_name": "STTM_INT654_ProvisionalMarketPrice",
-        "params": {
-            "parse_dates": ["gas_date", "report_datetime"],
-            "dayfirst": True
-        }
-    },
-    "INT690": {
-        "table_name": "STTM_INT690_DeviationPriceData",
-        "params": {
-            "parse_dates": ["gas_date", "last_update_datetime", "report_datetime"],
-            "dayfirst": True
-        }
-    },
-}
+# "auto" streams files bigger than STREAM_THRESHOLD_BYTES, "always" and "never" force it
+STREAMING_MODE = os.environ.get("StreamingMode", "auto")
+STREAM_THRESHOLD_BYTES = int(os.environ.get("StreamThresholdBytes", str(32 * 1024 * 1024)))
+STREAM_CHUNK_ROWS = int(os.environ.get("StreamChunkRows", "50000"))
+# S3 requires every part but the last one to be at least 5MB
+MULTIPART_PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get("MultipartPartSize", str(8 * 1024 * 1024))))
+
+# files of at least SPOOL_THRESHOLD_BYTES are downloaded as concurrent byte-range
+# GETs into a spool file of SPOOL_DIR and parsed through a memory map, 0 turns it off
+SPOOL_THRESHOLD_BYTES = int(os.environ.get("SpoolThresholdBytes", str(64 * 1024 * 1024)))
+SPOOL_PART_SIZE = int(os.environ.get("SpoolPartSize", str(16 * 1024 * 1024)))
+SPOOL_WORKERS = int(os.environ.get("SpoolWorkers", "8"))
+
+# every record of an event may be spooling at the same time
+s3 = lazy_client('s3', pool_connections=MAX_WORKERS * SPOOL_WORKERS)
+SPOOL_DIR = os.environ.get("SpoolDir", tempfile.gettempdir())
+
+# "csv" writes text objects, "parquet" writes typed columnar objects (needs pyarrow)
+OUTPUT_FORMAT = os.environ.get("OutputFormat", "csv").lower()
+PARQUET_COMPRESSION = os.environ.get("ParquetCompression", "snappy").lower()
+# codec of the csv output, "none", "gzip" or "bzip2". Athena picks the codec of a
+# text object from its extension, so compressed objects are named .csv.gz or .csv.bz2
+OUTPUT_COMPRESSION = os.environ.get("OutputCompression", "none").lower()
+OUTPUT_COMPRESSION_LEVEL = int(os.environ.get("OutputCompressionLevel", "6"))
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "bzip2": ".bz2"}
+if OUTPUT_COMPRESSION not in COMPRESSION_EXTENSIONS:
+    raise ValueError("Unknown OutputCompression [%s], expected one of %s"
+                     % (OUTPUT_COMPRESSION, sorted(COMPRESSION_EXTENSIONS)))
+CSV_EXTENSION = ".csv" + COMPRESSION_EXTENSIONS[OUTPUT_COMPRESSION]
+
+# "csv" (standard library) or "pandas" for every file, "auto" picks by size,
+# files up to CSV_ENGINE_MAX_BYTES go through csv
+INGEST_ENGINE = os.environ.get("IngestEngine", "auto").lower()
+CSV_ENGINE_MAX_BYTES = int(os.environ.get("CsvEngineMaxBytes", str(1024 * 1024)))
+
+# skip files whose normalised content has already been ingested for the same table
+DEDUPLICATE = os.environ.get("Deduplicate", "true").lower() == "true"
+
+# "move" walks every file through processing/ then done/ or error/, "tags" leaves
+# it in place with its state in the STATE_TAG object tag and archives it to
+# done/ or error/ once, in a batch at the end of the invocation
+STATE_TRACKING = os.environ.get("StateTracking", "move").lower()
+STATE_TAG = "sttm-state"
+# delete_objects accepts at most 1000 keys per call
+ARCHIVE_BATCH_SIZE = 1000
+
+# write the daily rollup of every file of a table with rollup columns to
+# athena/<table>_Daily/, see rollup.DailyRollup
+ROLLUPS = os.environ.get("Rollups", "true").lower() == "true"
+
+# "file_name" writes the output of a file to the year/month/day partition of the
+# 14 digit timestamp of its name, "gas_date" splits the rows of a file by their
+# gas_date, one object per gas day, so athena filters on gas_date prune the
+# partitions. Rows without a valid gas_date stay in the partition of the file name.
+PARTITION_BY = os.environ.get("PartitionBy", "file_name").lower()
+if PARTITION_BY not in ("file_name", "gas_date"):
+    raise ValueError("Unknown PartitionBy [%s], expected file_name or gas_date" % (PARTITION_BY,))
+PARTITION_COLUMN = "gas_date"
+
+# order the rows of every output by hub_identifier, gas_date and
+# schedule_identifier (schema_registry.SORT_KEYS), parquet outputs then get a
+# row group per hub, so hub filters skip most of an object. Streamed files are
+# sorted STREAM_CHUNK_ROWS rows at a time, batch objects are merged in order.
+SORT_OUTPUT = os.environ.get("SortOutput", "false").lower() == "true"
+# format of added_dttm, and of every timestamp the csv engine writes
+ADDED_DTTM_FORMAT = "%Y-%m-%d %H:%M:%S"
+# gas_date as written by both engines, "%Y-%m-%d" with or without a time
+PARTITION_DATE_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})")
+
+
+# read_csv parameters and timestamp formats of every report come from the
+# schema registry. date_formats gives the exact strptime format of every
+# timestamp column, values that do not match it are parsed with dayfirst
+# inference instead. Integer columns are kept as text for csv output so a
+# missing value cannot turn them into floats, parquet output casts them anyway
+FILE_TYPES = schema_registry.file_types(int_dtype="object" if OUTPUT_FORMAT == "csv" else "float64")
 
 TABLES_NAME = [FILE_TYPES[key]["table_name"] for key in FILE_TYPES]
+ROLLUP_TABLES = list(schema_registry.rollup_tables()) if ROLLUPS else []
+
+_pandas_available = None
+
+# (table name, column) -> number of values that missed the declared date format,
+# kept for the life of the container
+DATE_FALLBACK_COUNTS = collections.Counter()
+_fallback_lock = threading.Lock()
+
+# (table name, content hash) ingested, and being ingested, by this container
+_known_hashes = set()
+_inflight_hashes = set()
+_hash_lock = threading.Lock()
 
 
 
@@ -71,21 +150,513 @@ def copy_file(src_bucket, src_key, dst_bucket, dst_key):
     s3.copy({'Bucket': src_bucket, 'Key': src_key}, dst_bucket, dst_key)
 
 
+def set_state(bucket, key, state):
+    """
+    Record the lifecycle state of a file in its STATE_TAG tag, without rewriting it
+    """
+    s3.put_object_tagging(Bucket=bucket, Key=key,
+                          Tagging={'TagSet': [{'Key': STATE_TAG, 'Value': state}]})
+
+
+def archive_files(bucket, archives):
+    """
+    Move files to their archive folder in one go: the copies, which carry the
+    final state tag, run on a thread pool and the sources are then removed
+    with as few delete_objects calls as possible
+    Args:
+      bucket (string): name of the bucket
+      archives (list): (src_key, dst_key, state) of every file
+
+    Returns:
+      list: the src_key of the files that could not be archived
+    """
+    if not archives:
+        return []
+
+    def archive(entry):
+        src_key, dst_key, state = entry
+        try:
+            s3.copy_object(Bucket=bucket, Key=dst_key, CopySource={'Bucket': bucket, 'Key': src_key},
+                           TaggingDirective='REPLACE', Tagging="%s=%s" % (STATE_TAG, state))
+            return True
+        except Exception as e:
+            print("Unable to archive [%s]: %s" % (src_key, e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(archives)))) as executor:
+        copied = list(executor.map(archive, archives))
+
+    failed = [src_key for (src_key, _, _), ok in zip(archives, copied) if not ok]
+    sources = [src_key for (src_key, _, _), ok in zip(archives, copied) if ok]
+    for start in range(0, len(sources), ARCHIVE_BATCH_SIZE):
+        batch = sources[start:start + ARCHIVE_BATCH_SIZE]
+        response = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch],
+                                                            'Quiet': True})
+        for error in response.get('Errors', []):
+            print("Unable to remove archived [%s]: %s" % (error['Key'], error.get('Message')))
+            failed.append(error['Key'])
+    print("Archived %s file(s) of [%s]" % (len(sources), bucket))
+    return failed
+
+
 def get_object(bucket, key):
     return s3.get_object(Bucket=bucket, Key=key)
 
 
+def reopen_body(bucket, key, obj, spooled=False):
+    """
+    Body of a get_object response read again from the start: the spool map is
+    rewound, otherwise the same version of the object is fetched again
+    """
+    if spooled:
+        obj['Body'].seek(0)
+        return obj['Body']
+    obj['Body'].close()
+    params = {'Bucket': bucket, 'Key': key}
+    if obj.get('ETag'):
+        params['IfMatch'] = obj['ETag']
+    return s3.get_object(**params)['Body']
+
+
+def use_spool(size):
+    """
+    Decide whether a file of the given size is downloaded with SpooledDownload,
+    only when the spool directory has room for it
+    """
+    if not SPOOL_THRESHOLD_BYTES or size < SPOOL_THRESHOLD_BYTES:
+        return False
+    try:
+        return shutil.disk_usage(SPOOL_DIR).free > size + SPOOL_PART_SIZE
+    except OSError:
+        return False
+
+
+class SpooledDownload(object):
+    """
+    Download of an object as concurrent byte-range GETs written straight to
+    their offset of a spool file, which is then memory mapped read-only. The
+    parser reads the map through the page cache, so neither the download nor
+    the parse holds the file on the heap. The spool file is removed on close.
+    """
+
+    def __init__(self, bucket, key, size, body=None, etag=None, part_size=None, workers=None):
+        """
+        Args:
+          body (StreamingBody): Body of a get_object response already open on
+            the object, it is used for the first range instead of a new GET
+          etag (string): ETag of the object, the ranges fail if it changes meanwhile
+        """
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.body = body
+        self.etag = etag
+        self.part_size = part_size or SPOOL_PART_SIZE
+        self.workers = workers or SPOOL_WORKERS
+        self.path = None
+        self.map = None
+
+    def _fetch(self, fd, first, last):
+        if first == 0 and self.body is not None:
+            stream = self.body
+        else:
+            params = {'Bucket': self.bucket, 'Key': self.key, 'Range': "bytes=%s-%s" % (first, last)}
+            if self.etag:
+                params['IfMatch'] = self.etag
+            stream = s3.get_object(**params)['Body']
+        try:
+            offset = first
+            while offset <= last:
+                data = stream.read(min(1024 * 1024, last + 1 - offset))
+                if not data:
+                    raise IOError("Short read of [%s] at %s" % (self.key, offset))
+                os.pwrite(fd, data, offset)
+                offset += len(data)
+        finally:
+            stream.close()
+
+    def download(self):
+        """
+        Returns:
+          mmap: the content of the object, a read-only file object
+        """
+        fd, self.path = tempfile.mkstemp(prefix="sttm-", suffix=".spool", dir=SPOOL_DIR)
+        try:
+            os.ftruncate(fd, self.size)
+            ranges = [(first, min(first + self.part_size, self.size) - 1)
+                      for first in range(0, self.size, self.part_size)]
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(ranges)))) as executor:
+                list(executor.map(lambda r: self._fetch(fd, *r), ranges))
+            self.map = mmap.mmap(fd, self.size, access=mmap.ACCESS_READ)
+        except Exception:
+            self.close()
+            raise
+        finally:
+            os.close(fd)
+        print("Spooled %s bytes of [%s] in %s ranges" % (self.size, self.key, len(ranges)))
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
 def put_file(bucket, key, body):
     print("Put file [%s] to [%s]" % (key, bucket))
     return s3.put_object(Bucket=bucket, Key=key, Body=body)
     print("Finish put file [%s] to [%s]" % (key, bucket))
 
 
+class MultipartUpload(object):
+    """
+    Write-only file object that ships what it is given to S3 as a multipart
+    upload, holding at most one part in memory at a time. Output that never
+    fills a part is sent with a single put_object on close.
+    """
+
+    def __init__(self, bucket, key, part_size=MULTIPART_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.buffer.extend(data)
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+            print("Started multipart upload of [%s]" % (self.key,))
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                  PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.upload_id is None:
+            put_file(self.bucket, self.key, bytes(self.buffer))
+            self.buffer = bytearray()
+            return
+        if self.buffer:
+            self._upload_part()
+        s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                     MultipartUpload={'Parts': self.parts})
+        print("Finish multipart upload of [%s] in %s parts" % (self.key, len(self.parts)))
+
+    def tell(self):
+        return self.bytes_written
+
+    @property
+    def closed(self):
+        return False
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+
+
+class CompressedWriter(object):
+    """
+    Write-only file object that compresses what it is given on the fly into
+    another one, a MultipartUpload. Only the compressor state and the
+    compressed bytes not yet shipped are held, never the whole output.
+    """
+
+    def __init__(self, out, codec=OUTPUT_COMPRESSION, level=OUTPUT_COMPRESSION_LEVEL):
+        self.out = out
+        if codec == "gzip":
+            # wbits 16 + 15 writes the gzip header and trailer around the deflate stream
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif codec == "bzip2":
+            self.compressor = bz2.BZ2Compressor(max(1, level))
+        else:
+            raise ValueError("Unknown compression codec [%s]" % (codec,))
+        self.uncompressed_bytes = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.uncompressed_bytes += len(data)
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.out.write(compressed)
+        return len(data)
+
+    def close(self):
+        self.out.write(self.compressor.flush())
+        self.out.close()
+
+    def abort(self):
+        self.out.abort()
+
+    @property
+    def bytes_written(self):
+        # what ends up in S3, the uncompressed size is in uncompressed_bytes
+        return self.out.bytes_written
+
+
+def output_writer(bucket, key, output_format=OUTPUT_FORMAT):
+    """
+    File object writing an athena/ object, compressed with OUTPUT_COMPRESSION
+    when the output is csv. Parquet compresses its pages itself.
+    Returns:
+      MultipartUpload or CompressedWriter: close ships the object, abort drops it
+    """
+    upload = MultipartUpload(bucket, key)
+    if output_format == "csv" and OUTPUT_COMPRESSION != "none":
+        return CompressedWriter(upload)
+    return upload
+
+
+def put_output(bucket, key, output, output_format=OUTPUT_FORMAT):
+    """
+    Write the output of process_file through output_writer, one part size
+    slice at a time so compression never holds a second copy of it
+    Returns:
+      int: bytes stored in S3
+    """
+    if output_format != "csv" or OUTPUT_COMPRESSION == "none":
+        put_file(bucket, key, output)
+        return len(output)
+    writer = output_writer(bucket, key, output_format)
+    try:
+        for start in range(0, len(output), MULTIPART_PART_SIZE):
+            writer.write(output[start:start + MULTIPART_PART_SIZE])
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    return writer.bytes_written
+
+
+class PartitionedOutput(object):
+    """
+    Outputs of one file by (year, month, day) partition, each opened on first
+    use. With PARTITION_BY "gas_date" the rows go to the partition of their
+    gas_date, otherwise, or when they have none, to the default partition, the
+    one of the file name.
+    """
+
+    def __init__(self, default, open_output=None, split=None):
+        """
+        Args:
+          default (tuple): (year, month, day) partition of the file name
+          open_output (callable): partition -> file object of its output, a
+            StringIO when None
+          split (bool): split by gas_date, PARTITION_BY decides when None
+        """
+        self.default = default
+        self.open_output = open_output or (lambda partition: StringIO())
+        self.split = PARTITION_BY == "gas_date" if split is None else split
+        self.outputs = collections.OrderedDict()
+
+    def output(self, partition=None):
+        partition = partition or self.default
+        out = self.outputs.get(partition)
+        if out is None:
+            out = self.outputs[partition] = self.open_output(partition)
+        return out
+
+    def partition_of(self, gas_date):
+        """
+        Partition of a row from its gas_date, as written in the csv output
+        """
+        match = PARTITION_DATE_PATTERN.match(gas_date) if self.split else None
+        return match.groups() if match else self.default
+
+    def split_frame(self, df):
+        """
+        Returns:
+          list: (partition, frame) of the rows of every partition of a parsed frame
+        """
+        if not self.split or PARTITION_COLUMN not in df.columns or not len(df):
+            return [(self.default, df)]
+        gas_date = df[PARTITION_COLUMN]
+        if hasattr(gas_date, "dt"):
+            gas_date = gas_date.dt.strftime("%Y-%m-%d")
+        days = gas_date.astype(object).fillna("").astype(str)
+        return [(self.partition_of(day), part) for day, part in df.groupby(days, sort=True)]
+
+    def close(self):
+        for out in self.outputs.values():
+            out.close()
+
+    def abort(self):
+        for out in self.outputs.values():
+            out.abort()
+
+    @property
+    def bytes_written(self):
+        return sum(out.bytes_written for out in self.outputs.values())
+
+
+def decompress_output(key, body):
+    """
+    Content of an athena/ csv object, decompressed according to its extension
+    """
+    if key.endswith(".gz"):
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if key.endswith(".bz2"):
+        return bz2.decompress(body)
+    return body
+
+
+class ContentHasher(object):
+    """
+    sha256 of a file body normalised line by line: line endings and trailing
+    whitespace are dropped as well as blank lines, so republished copies of a
+    report hash the same. Can be fed in chunks of any size.
+    """
+
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.carry = b""
+
+    def update(self, data):
+        lines = (self.carry + data).split(b"\n")
+        self.carry = lines.pop()
+        for line in lines:
+            self._add(line)
+
+    def _add(self, line):
+        line = line.rstrip()
+        if line:
+            self.hash.update(line + b"\n")
+
+    def hexdigest(self):
+        if self.carry:
+            self._add(self.carry)
+            self.carry = b""
+        return self.hash.hexdigest()
+
+
+def content_hash(raw):
+    hasher = ContentHasher()
+    hasher.update(raw)
+    return hasher.hexdigest()
+
+
+def stream_content_hash(body, chunk_size=1024 * 1024):
+    """
+    content_hash of a body read chunk_size bytes at a time, for the files
+    too big to be read at once
+    """
+    hasher = ContentHasher()
+    for data in iter(lambda: body.read(chunk_size), b""):
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def hash_index_key(table_name, digest):
+    return "%s/%s/%s" % (HASH_INDEX_FOLDER, table_name, digest)
+
+
+def claim_content(bucket, table_name, digest):
+    """
+    Check the content hash index before a file is ingested, looking at the
+    in-memory cache first and at the index objects of the bucket for the rest.
+    Content another file is still ingesting is not a duplicate yet, that file
+    may fail: the claim raises so the caller fails its file and keeps it.
+    Any error reading the index raises as well, it never passes as new content.
+    Returns:
+      True when the content is new and now claimed by the caller, False for a duplicate
+    """
+    entry = (table_name, digest)
+    with _hash_lock:
+        if entry in _known_hashes:
+            return False
+        if entry in _inflight_hashes:
+            raise RuntimeError("Content %s of %s is being ingested by another file" % (digest, table_name))
+        _inflight_hashes.add(entry)
+    try:
+        s3.head_object(Bucket=bucket, Key=hash_index_key(table_name, digest))
+    except Exception as e:
+        if isinstance(e, botocore.exceptions.ClientError) and \
+                e.response['Error']['Code'] in ("404", "NoSuchKey", "NotFound"):
+            return True
+        with _hash_lock:
+            _inflight_hashes.discard(entry)
+        raise
+    with _hash_lock:
+        _inflight_hashes.discard(entry)
+        _known_hashes.add(entry)
+    return False
+
+
+def release_content(bucket, table_name, digest, file_name, ingested):
+    """
+    Record the outcome of a claimed content hash, only ingested content is indexed
+    """
+    entry = (table_name, digest)
+    if ingested:
+        try:
+            s3.put_object(Bucket=bucket, Key=hash_index_key(table_name, digest), Body=file_name)
+        except Exception as e:
+            print("Unable to index [%s]: %s" % (file_name, e))
+    with _hash_lock:
+        _inflight_hashes.discard(entry)
+        if ingested:
+            _known_hashes.add(entry)
+
+
 def s3_key_partition(file_type, year, month, day, file_name):
     key = "%s/%s/year=%s/month=%s/day=%s/%s" % (ATHENA_FOLDER, file_type, year, month, day, file_name)
     return key
 
 
+def output_file_name(file_name, output_format=OUTPUT_FORMAT):
+    """
+    Name of the object written under athena/ for a given input file
+    """
+    if output_format == "parquet":
+        return os.path.splitext(file_name)[0] + ".parquet"
+    return file_name + COMPRESSION_EXTENSIONS[OUTPUT_COMPRESSION]
+
+
+def new_rollup(table_name):
+    """
+    DailyRollup of a file of the table, None when the table has no rollup
+    """
+    if ROLLUPS and schema_registry.rollup_measures(table_name):
+        return DailyRollup(table_name)
+    return None
+
+
+def put_rollup(bucket, rollup, year, month, day, file_name):
+    """
+    Write the rollup of a file under athena/<table>_Daily/, in the partition of
+    its raw output, or with PARTITION_BY "gas_date" in the partition of every
+    gas day. Rollups are always csv, compressed like the csv output.
+    Returns:
+      list: the (year, month, day) partitions written
+    """
+    table_name = schema_registry.rollup_table_name(rollup.table_name)
+    parts = rollup.split(PartitionedOutput((year, month, day)).partition_of)
+    for partition, part in parts.items():
+        key = s3_key_partition(table_name, partition[0], partition[1], partition[2],
+                               output_file_name(file_name, "csv"))
+        put_output(bucket, key, part.to_csv(file_name), "csv")
+    return list(parts)
+
+
 def get_s3_key(state, file_type, file_name):
     key = "%s/%s/%s" % (state, file_type, file_name)
     return key
@@ -97,6 +668,8 @@ def parse_date(s, text=True, format="%Y-%m-%d"):
     103	 dd/mm/yyyy
     """
     s = s.strip()
+    # no usable date, the partition of today
+    date = datetime.datetime.now().strftime(format)
 
     if len(s) < 8:
         return date.split("-")
@@ -112,49 +685,627 @@ def parse_date(s, text=True, format="%Y-%m-%d"):
     if re.search("^\d{2}/\d{2}/\d{4}$", s):
         return (s[6:], s[3:5], s[:2])
 
-    date = datetime.datetime.now().strftime(format)
-
     return date.split("-")
 
 
-def process_file(file_name, data, params):
+def file_partition(file_name):
+    """
+    (year, month, day) partition of a file, from the first 14 digit timestamp of its name
+    """
+    try:
+        date_filename = re.findall("\d{14}", file_name)
+        date_found = date_filename[0][:8]
+    except:
+        print("No timestamp in [%s], partition of today" % (file_name,))
+        date_found = ""
+    return tuple(parse_date(date_found))
+
+
+def arrow_type(athena_type):
+    """
+    Map a schemas.json column type to the matching pyarrow type
+    """
+    import pyarrow as pa
+
+    name = athena_type.lower()
+    if name == "timestamp":
+        return pa.timestamp("ms")
+    if name == "date":
+        return pa.date32()
+    if name in ("int", "integer"):
+        return pa.int32()
+    if name == "bigint":
+        return pa.int64()
+    if name == "double":
+        return pa.float64()
+    if name == "float":
+        return pa.float32()
+    if name == "boolean":
+        return pa.bool_()
+    # string, char(n) and varchar(n)
+    return pa.string()
+
+
+def arrow_schema(table_name):
+    """
+    Build the pyarrow schema of a table from the schema registry
+    """
+    import pyarrow as pa
+
+    return pa.schema([pa.field(column['name'], arrow_type(column['type']))
+                      for column in schema_registry.columns(table_name)])
+
+
+def conform_frame(df, table_name):
+    """
+    Cast the columns of a parsed frame to the types declared in schemas.json,
+    values that do not fit the declared type become nulls. Timestamp columns
+    parse_timestamps already parsed are kept, text ones are parsed with their
+    declared format first, see parse_timestamp_column. added_dttm only ever
+    has ADDED_DTTM_FORMAT and is never inferred.
+    """
+    import pandas as pd
+    from pandas.api.types import is_datetime64_any_dtype
+
+    columns = schema_registry.columns(table_name)
+    out = pd.DataFrame(index=df.index)
+    for column in columns:
+        name = column['name']
+        kind = column['type'].lower()
+        values = df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if kind in ("timestamp", "date"):
+            if is_datetime64_any_dtype(values):
+                pass
+            elif column.get("generated"):
+                values = pd.to_datetime(values, format=ADDED_DTTM_FORMAT, errors="coerce")
+            elif column.get("format"):
+                values, _ = parse_timestamp_column(values, column["format"])
+            else:
+                values = pd.to_datetime(values, errors="coerce", dayfirst=True)
+        elif kind in ("int", "integer", "bigint", "double", "float"):
+            values = pd.to_numeric(values, errors="coerce")
+        elif kind != "boolean":
+            values = values.where(values.isnull(), values.astype(str))
+        out[name] = values
+    return out
+
+
+def sort_frame(df, table_name):
+    """
+    Order the rows of a frame by the sort columns of its table, when SORT_OUTPUT
+    """
+    if not SORT_OUTPUT or table_name not in schema_registry.load_schemas():
+        return df
+    keys = [name for name in schema_registry.sort_columns(table_name) if name in df.columns]
+    if not keys:
+        return df
+    return df.sort_values(keys, kind="mergesort", na_position="last")
+
+
+def numeric_sort_value(value):
+    """
+    Sort value of a numeric csv field, numbers in order then blank or
+    unparsable fields last, like the NaN of sort_frame
+    """
+    try:
+        return (0, float(value), "")
+    except ValueError:
+        return (1, 0.0, value)
+
+
+def row_sort_key(header, table_name):
+    """
+    Sort key of the csv rows of a table, see sort_frame. Numeric columns
+    compare as numbers, the others as text.
+    Returns:
+      callable: row -> key, None when the rows are not sorted
+    """
+    if not SORT_OUTPUT or table_name not in schema_registry.load_schemas():
+        return None
+    numeric = set(column["name"] for column in schema_registry.columns(table_name)
+                  if schema_registry.is_numeric(column))
+    fields = [(header.index(name), name in numeric)
+              for name in schema_registry.sort_columns(table_name) if name in header]
+    if not fields:
+        return None
+
+    def key(row):
+        values = [row[i] if i < len(row) else "" for i, _ in fields]
+        return tuple(numeric_sort_value(value) if number else value
+                     for value, (_, number) in zip(values, fields))
+    return key
+
+
+def write_row_groups(writer, df, table_name):
+    """
+    Write a frame to a ParquetWriter, one row group per CLUSTER_KEY value when
+    SORT_OUTPUT so the statistics of a row group name a single hub
+    """
+    import pyarrow as pa
+
+    parts = [df]
+    cluster_key = schema_registry.CLUSTER_KEY
+    if SORT_OUTPUT and cluster_key in df.columns and len(df):
+        parts = [part for _, part in df.groupby(df[cluster_key].astype(object).fillna(""), sort=True)]
+    for part in parts:
+        writer.write_table(pa.Table.from_pandas(conform_frame(part, table_name), schema=arrow_schema(table_name),
+                                                preserve_index=False))
+
+
+def frame_to_parquet(df, table_name):
     """
+    Serialise a frame to Parquet using the schema of its table
+    Args:
+      df (DataFrame): the parsed frame, including source_file_id and added_dttm
+      table_name (string): key of the table in schemas.json
+
+    Returns:
+      bytes of the Parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    buffer = pa.BufferOutputStream()
+    if SORT_OUTPUT:
+        writer = pq.ParquetWriter(buffer, arrow_schema(table_name), compression=PARQUET_COMPRESSION,
+                                  use_deprecated_int96_timestamps=True)
+        write_row_groups(writer, df, table_name)
+        writer.close()
+        return buffer.getvalue().to_pybytes()
+    table = pa.Table.from_pandas(conform_frame(df, table_name), schema=arrow_schema(table_name),
+                                 preserve_index=False)
+    pq.write_table(table, buffer, compression=PARQUET_COMPRESSION,
+                   use_deprecated_int96_timestamps=True)
+    return buffer.getvalue().to_pybytes()
+
+
+def parse_timestamp_column(raw, date_format):
+    """
+    Parse one column with its declared format, values that do not match it
+    go through dayfirst inference
+    Returns:
+      (parsed Series, number of values that needed inference)
+    """
+    import pandas as pd
+
+    parsed = pd.to_datetime(raw, format=date_format, errors="coerce")
+    missed = parsed.isnull() & raw.notnull()
+    count = int(missed.sum())
+    if count:
+        parsed[missed] = pd.to_datetime(raw[missed], dayfirst=True, errors="coerce")
+    return parsed, count
+
+
+def parse_timestamps(df, date_formats, table_name=None):
+    """
+    Parse the timestamp columns of a frame with their declared format in one
+    vectorized pass, only the values that do not match go through dayfirst
+    inference. Misses are added to DATE_FALLBACK_COUNTS.
+    Args:
+      df (DataFrame): the parsed frame, updated in place
+      date_formats (dict): column name -> strptime format
+      table_name (string): table of the frame, used as counter key
+
+    Returns:
+      dict: column name -> number of values that needed inference
+    """
+    fallbacks = {}
+    for column, date_format in date_formats.items():
+        if column not in df.columns:
+            continue
+        df[column], fallbacks[column] = parse_timestamp_column(df[column], date_format)
+
+    record_date_fallbacks(fallbacks, table_name)
+    return fallbacks
+
+
+def record_date_fallbacks(fallbacks, table_name):
+    """
+    Add the per column date format misses of one file to DATE_FALLBACK_COUNTS
+    """
+    missed_columns = {column: count for column, count in fallbacks.items() if count}
+    if missed_columns:
+        with _fallback_lock:
+            for column, count in missed_columns.items():
+                DATE_FALLBACK_COUNTS[(table_name, column)] += count
+        print("Date format fallback in [%s]: %s" % (table_name, missed_columns))
+
+
+def pandas_available():
+    """
+    Check once whether pandas is bundled, without importing it
+    """
+    global _pandas_available
+    if _pandas_available is None:
+        import importlib.util
+        _pandas_available = importlib.util.find_spec("pandas") is not None
+    return _pandas_available
+
+
+def select_engine(size):
+    """
+    Pick the ingest engine of a file
+    Args:
+      size (int): size of the file in bytes
+
+    Returns:
+      "csv" or "pandas"
+    """
+    if OUTPUT_FORMAT == "parquet":
+        return "pandas"
+    engine = INGEST_ENGINE
+    if engine == "auto":
+        engine = "csv" if size <= CSV_ENGINE_MAX_BYTES else "pandas"
+    if engine == "pandas" and not pandas_available():
+        engine = "csv"
+    return engine
+
+
+def normalise_timestamp(value, date_format, output_format):
+    """
+    Reformat one timestamp string like the pandas engine writes it
+    Returns:
+      (formatted value, True when the declared format did not match)
     """
+    value = value.strip()
+    if value == "":
+        return value, False
+    try:
+        return datetime.datetime.strptime(value, date_format).strftime(output_format), False
+    except ValueError:
+        pass
     try:
-        df = pd.read_csv(data, **params)
+        from dateutil.parser import parse
+        return parse(value, dayfirst=True).strftime(output_format), True
+    except (ValueError, OverflowError):
+        return "", True
+
+
+def transform_csv(file_name, data, out, date_formats=None, table_name=None, added_dttm=None, rollup=None,
+                  chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    pandas-free transform of a STTM file: timestamps are normalised row by row
+    and source_file_id/added_dttm appended, output is flushed to out every
+    STREAM_CHUNK_ROWS rows. Like the usecols of read_csv, columns the table
+    does not know are left out
+    Args:
+      file_name (string): name of the source file, stored in source_file_id
+      data (file object): decoded content of the file
+      out (file object): where to write the csv output, a PartitionedOutput to
+        write every partition with its own header
+      date_formats (dict): column name -> strptime format of the timestamp columns
+      table_name (string): table of the file, its registry columns are kept
+        and it is the date fallback counter key
+      added_dttm (string): value of added_dttm, now when None
+      rollup (DailyRollup): gets every row written
+      chunk_rows (int): rows per write to out, and per sort with SORT_OUTPUT,
+        0 writes the whole file at once
+
+    Returns:
+      number of rows written
+    """
+    date_formats = date_formats or {}
+    added_dttm = added_dttm or datetime.datetime.now().strftime(ADDED_DTTM_FORMAT)
+    reader = csv.reader(data)
+    header = next(reader)
+    kept = None
+    if table_name in schema_registry.load_schemas():
+        known = set(column["name"] for column in schema_registry.input_columns(table_name))
+        if not known.issuperset(header):
+            kept = [i for i, name in enumerate(header) if name in known]
+            header = [header[i] for i in kept]
+    date_columns = []
+    for i, name in enumerate(header):
+        if name in date_formats:
+            date_format = date_formats[name]
+            output_format = ADDED_DTTM_FORMAT if "%H" in date_format else "%Y-%m-%d"
+            date_columns.append((i, name, date_format, output_format))
+    fallbacks = collections.Counter()
+    if rollup is not None:
+        rollup.bind(header)
+
+    partitioned = isinstance(out, PartitionedOutput)
+    split_index = None
+    if partitioned and out.split and PARTITION_COLUMN in header:
+        split_index = header.index(PARTITION_COLUMN)
+    sort_key = row_sort_key(header, table_name)
+    # csv buffer, writer and rows waiting to be sorted of every partition, the
+    # only one is None when not partitioned
+    buffers = collections.OrderedDict()
+
+    def buffer_of(partition):
+        if partition not in buffers:
+            buffer = StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(header + ["source_file_id", "added_dttm"])
+            buffers[partition] = (buffer, writer, [])
+        return buffers[partition]
+
+    def flush():
+        for partition, (buffer, writer, pending) in buffers.items():
+            if pending:
+                pending.sort(key=sort_key)
+                writer.writerows(pending)
+                del pending[:]
+            (out.output(partition) if partitioned else out).write(buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+
+    rows = 0
+    for row in reader:
+        if not row:
+            continue
+        if kept is not None:
+            row = [row[i] for i in kept if i < len(row)]
+        for i, name, date_format, output_format in date_columns:
+            if i < len(row):
+                row[i], missed = normalise_timestamp(row[i], date_format, output_format)
+                if missed:
+                    fallbacks[name] += 1
+        if rollup is not None:
+            rollup.add_row(row)
+        partition = None
+        if partitioned:
+            partition = out.partition_of(row[split_index]) if split_index is not None and \
+                split_index < len(row) else out.default
+        _, writer, pending = buffer_of(partition)
+        if sort_key is None:
+            writer.writerow(row + [file_name, added_dttm])
+        else:
+            pending.append(row + [file_name, added_dttm])
+        rows += 1
+        if chunk_rows and rows % chunk_rows == 0:
+            flush()
+    if not buffers:
+        # a file without rows still gets its header
+        buffer_of(out.default if partitioned else None)
+    flush()
+
+    record_date_fallbacks(fallbacks, table_name)
+    return rows
+
+
+def process_file(file_name, data, params, table_name=None, date_formats=None, engine="pandas",
+                 recorder=None, rollup=None, partition=None):
+    """
+    Parse a STTM file and add the source_file_id and added_dttm columns
+    Args:
+      file_name (string): name of the source file, stored in source_file_id
+      data (file object): content of the file
+      params (dict): read_csv parameters of the file type
+      table_name (string): table of the file, needed for the parquet output format
+      date_formats (dict): column name -> strptime format of the timestamp columns
+      engine (string): "pandas", or "csv" for the pandas-free transform_csv
+      recorder (MetricsRecorder): gets the time of every step and the row count
+      rollup (DailyRollup): gets every row of the file
+      partition (tuple): (year, month, day) of the file name, the output is
+        then split by PartitionedOutput
+
+    Returns:
+      the serialised output in OUTPUT_FORMAT, or a list of (partition, output)
+      when partition is given, False on error
+    """
+    recorder = recorder or MetricsRecorder()
+    try:
+        if engine == "csv":
+            out = StringIO() if partition is None else PartitionedOutput(partition)
+            with recorder.stage("transform_csv"):
+                # the output is held anyway, a sorted file is sorted as a whole
+                recorder.count("Rows", transform_csv(file_name, data, out, date_formats, table_name,
+                                                     rollup=rollup,
+                                                     chunk_rows=0 if SORT_OUTPUT else STREAM_CHUNK_ROWS))
+            if partition is None:
+                return out.getvalue()
+            return [(key, output.getvalue()) for key, output in out.outputs.items()]
+
+        import pandas as pd
+
+        with recorder.stage("read_csv"):
+            df = pd.read_csv(data, **params)
+        recorder.count("Rows", len(df))
+        with recorder.stage("parse_timestamps"):
+            parse_timestamps(df, date_formats or {}, table_name)
+        if rollup is not None:
+            with recorder.stage("rollup"):
+                rollup.add_frame(df)
         df["source_file_id"] = file_name
-        df["added_dttm"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        df["added_dttm"] = datetime.datetime.now().strftime(ADDED_DTTM_FORMAT)
+        if SORT_OUTPUT:
+            with recorder.stage("sort"):
+                df = sort_frame(df, table_name)
 
-        return df.to_csv(index=False)
+        with recorder.stage("serialise"):
+            if partition is not None:
+                return [(key, frame_to_parquet(part, table_name) if OUTPUT_FORMAT == "parquet"
+                         else part.to_csv(index=False))
+                        for key, part in PartitionedOutput(partition).split_frame(df)]
+            if OUTPUT_FORMAT == "parquet":
+                return frame_to_parquet(df, table_name)
+            return df.to_csv(index=False)
     except Exception as e:
         print (e)
         return False
 
 
-def handler(event, context):
+def use_streaming(size):
+    """
+    Decide whether a file of the given size goes through stream_process_file
+    """
+    if STREAMING_MODE == "always":
+        return True
+    if STREAMING_MODE == "never":
+        return False
+    return size > STREAM_THRESHOLD_BYTES
+
+
+def stream_process_file(file_name, body, params, bucket, key, table_name=None, date_formats=None,
+                        engine="pandas", recorder=None, rollup=None, partition=None):
+    """
+    Chunked version of process_file: the S3 body is decoded and parsed
+    STREAM_CHUNK_ROWS rows at a time and every chunk goes straight into a
+    multipart upload, so memory stays flat whatever the size of the file
+    Args:
+      file_name (string): name of the source file, stored in source_file_id
+      body (StreamingBody): the Body of the get_object response
+      params (dict): read_csv parameters of the file type
+      bucket (string): destination bucket
+      key (string): destination key
+      table_name (string): table of the file, needed for the parquet output format
+      date_formats (dict): column name -> strptime format of the timestamp columns
+      engine (string): "pandas", or "csv" for the pandas-free transform_csv
+      recorder (MetricsRecorder): gets the time of every step, the row and output byte counts
+      rollup (DailyRollup): gets every row of the file
+      partition (tuple): (year, month, day) of key, with PARTITION_BY "gas_date"
+        the rows of other gas days go to the same name in their own partition
+
+    Returns:
+      list: the partitions written when the output has been written, False on error
+    """
+    recorder = recorder or MetricsRecorder()
+    added_dttm = datetime.datetime.now().strftime(ADDED_DTTM_FORMAT)
+    data = codecs.getreader('utf-8')(body, errors='ignore')
+    name = key.rsplit("/", 1)[-1]
+
+    def open_output(p):
+        return output_writer(bucket, key if p == partition else s3_key_partition(table_name, p[0], p[1], p[2], name))
+
+    upload = PartitionedOutput(partition, open_output, split=None if partition is not None else False)
+    # parquet writer of every partition written to, None for csv
+    writers = {}
+    rows = 0
     try:
-        print("Object added to: [%s]" % (event['Records'][0]['s3']['bucket']['name'],))
-        key = event['Records'][0]['s3']['object']['key']
-        bucket = event['Records'][0]['s3']['bucket']['name']
+        if engine == "csv":
+            with recorder.stage("transform_csv"):
+                rows = transform_csv(file_name, data, upload, date_formats, table_name, added_dttm, rollup)
+            recorder.count("Rows", rows)
+            with recorder.stage("put_file"):
+                upload.close()
+            recorder.count("BytesOut", upload.bytes_written, "Bytes")
+            print("Streamed %s rows (%s bytes) of [%s]" % (rows, upload.bytes_written, file_name))
+            return list(upload.outputs)
 
-        key = urllib.parse.unquote_plus(key, encoding='utf-8', errors='replace')
+        import pandas as pd
 
-        keys = key.split("/")
-        file_name = keys[-1]
-        if file_name == "":
-            return
+        if OUTPUT_FORMAT == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = arrow_schema(table_name)
 
-        file_type = key[-2]
+        chunks = pd.read_csv(data, chunksize=STREAM_CHUNK_ROWS, **params)
+        for i, chunk in enumerate(chunks):
+            with recorder.stage("parse_timestamps"):
+                parse_timestamps(chunk, date_formats or {}, table_name)
+            if rollup is not None:
+                with recorder.stage("rollup"):
+                    rollup.add_frame(chunk)
+            chunk["source_file_id"] = file_name
+            chunk["added_dttm"] = added_dttm
+            if SORT_OUTPUT:
+                with recorder.stage("sort"):
+                    chunk = sort_frame(chunk, table_name)
+            # parts are uploaded as they fill up, serialise includes their upload
+            with recorder.stage("serialise"):
+                for part_key, part in upload.split_frame(chunk):
+                    out = upload.output(part_key)
+                    if OUTPUT_FORMAT == "parquet":
+                        # one row group per chunk and partition, and per hub with SORT_OUTPUT
+                        if part_key not in writers:
+                            writers[part_key] = pq.ParquetWriter(pa.PythonFile(out, mode="w"), schema,
+                                                                 compression=PARQUET_COMPRESSION,
+                                                                 use_deprecated_int96_timestamps=True)
+                        write_row_groups(writers[part_key], part, table_name)
+                    else:
+                        out.write(part.to_csv(index=False, header=part_key not in writers))
+                        writers[part_key] = None
+            rows += len(chunk)
+        for writer in writers.values():
+            if writer is not None:
+                writer.close()
+        if not upload.outputs:
+            # a file without rows still gets its (empty) object
+            upload.output()
+        recorder.count("Rows", rows)
+        with recorder.stage("put_file"):
+            upload.close()
+        recorder.count("BytesOut", upload.bytes_written, "Bytes")
+        print("Streamed %s rows (%s bytes) of [%s]" % (rows, upload.bytes_written, file_name))
+        return list(upload.outputs)
+    except Exception as e:
+        print (e)
+        upload.abort()
+        return False
+
+
+def is_bundle(key):
+    """
+    ZIP bundle of STTM reports, see batch.ingest_bundle
+    """
+    return key.lower().endswith(".zip")
 
-        if file_name[:6].upper() not in FILE_TYPES.keys():
+
+def record_file(record):
+    """
+    Locate the file of an S3 event record
+    Returns:
+      (bucket, unquoted key, file name, table name), the table is None when
+      the file name is not one of FILE_TYPES
+    """
+    bucket = record['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8', errors='replace')
+    keys = key.split("/")
+    file_name = keys[-1]
+    if file_name[:6].upper() not in FILE_TYPES:
+        return bucket, key, file_name, None
+    # the folder of the file names its table, unless it is not a table
+    file_type = keys[-2] if len(keys) > 1 else ""
+    if file_type not in TABLES_NAME:
+        file_type = FILE_TYPES[file_name[:6].upper()]["table_name"]
+    return bucket, key, file_name, file_type
+
+
+def process_record(record):
+    """
+    Run a single S3 event record through move -> get -> parse -> put -> move,
+    or tag -> get -> parse -> put when STATE_TRACKING is "tags"
+    Args:
+      record (dict): one entry of the event's Records list
+
+    Returns:
+      dict: the bucket, key and final status of the record, plus the error if any.
+        With STATE_TRACKING "tags" it also holds the (src_key, dst_key, state)
+        archive entry the handler passes to archive_files
+    """
+    result = {"bucket": None, "key": None, "status": None, "error": None, "archive": None}
+    tracked = STATE_TRACKING == "tags"
+    # one metrics record per file, aggregated per file type and over all of them
+    recorder = MetricsRecorder(dimension_sets=[["FileType"], []], FileType="unknown")
+    recorder.count("Files")
+    try:
+        bucket, key, file_name, file_type = record_file(record)
+        print("Object added to: [%s]" % (bucket,))
+        result["bucket"] = bucket
+        result["key"] = key
+
+        if file_name == "":
+            result["status"] = "skipped"
+            return result
+
+        bundle = is_bundle(file_name)
+        if bundle:
+            file_type = BUNDLE_FOLDER
+        elif file_type is None:
             print ("wrong_format")
             move_file(bucket, key, bucket, bucket+"/wrong_format/"+key)
-            return
-        else:
-            if file_type not in TABLES_NAME:
-                file_type = FILE_TYPES[file_name[:6].upper()]["table_name"]
+            result["status"] = "wrong_format"
+            return result
 
-        params = FILE_TYPES[file_name[:6].upper()]["params"]
+        recorder.set_dimension("FileType", file_type)
+        recorder.set_property("Key", key)
+        if not bundle:
+            file_type_conf = FILE_TYPES[file_name[:6].upper()]
+            params = file_type_conf["params"]
+            date_formats = file_type_conf["date_formats"]
 
         print("Processing: ", key)
 
@@ -163,33 +1314,184 @@ def handler(event, context):
         done_key = get_s3_key(DONE_FOLDER, file_type, file_name)
         error_key = get_s3_key(ERROR_FOLDER, file_type, file_name)
 
-        # move file to processing
-        move_file(bucket, input_key, bucket, processing_key)
+        if tracked:
+            # the file stays where it is, only its state changes
+            processing_key = input_key
+            with recorder.stage("set_state"):
+                set_state(bucket, input_key, "processing")
+        else:
+            # move file to processing
+            with recorder.stage("move_to_processing"):
+                move_file(bucket, input_key, bucket, processing_key)
 
-        # get file from processing bucket
-        obj = get_object(bucket, processing_key)
-        data = obj['Body'].read().decode('utf-8', 'ignore')
-        data = StringIO(data)
+        if not bundle:
+            year, month, day = file_partition(file_name)
+            athena_key = s3_key_partition(file_type, year, month, day, output_file_name(file_name))
 
-        output = process_file(file_name, data, params)
+        # get file from processing bucket
+        with recorder.stage("get_object"):
+            obj = get_object(bucket, processing_key)
 
-        if not output:
-            move_file(bucket, processing_key, bucket, error_key)
-            print ("Error empty output ", (file_name))
-            return
+        size = obj.get('ContentLength', 0)
+        recorder.count("BytesIn", size, "Bytes")
+        if not bundle:
+            engine = select_engine(size)
+            recorder.set_property("Engine", engine)
+        # content hash claimed in the index, released once the output is written or not
+        claimed = []
+        written = False
+        spool = None
+        rollup = None if bundle else new_rollup(file_type)
         try:
-            date_filename = re.findall("\d{14}", file_name)
-            date_found = date_filename[0][:8]
-        except:
-            date_found = ""
-        year, month, day = parse_date(date_found)
+            if use_spool(size):
+                spool = SpooledDownload(bucket, processing_key, size, obj['Body'], obj.get('ETag'))
+                with recorder.stage("spool_download"):
+                    obj['Body'] = spool.download()
+            if bundle:
+                # batch imports handler, it is only needed for bundles
+                import batch
 
-        athena_key = s3_key_partition(file_type, year, month, day, file_name)
+                # zipfile seeks, the archive is read back from the spool file or held in memory
+                body = open(spool.path, "rb") if spool is not None else io.BytesIO(obj['Body'].read())
+                with body, recorder.stage("ingest_bundle"):
+                    members = batch.ingest_bundle(bucket, body, recorder)
+                for status, count in members.items():
+                    recorder.count(status.capitalize() + "Members", count)
+                failed = members["error"] + members["failed"]
+                written = sum(members.values()) > members["skipped"] and not failed
+                if failed:
+                    result["error"] = "%s member(s) not ingested" % (failed,)
+            elif use_streaming(size):
+                print("Streaming: ", processing_key)
+                body = obj['Body']
+                if DEDUPLICATE:
+                    # a duplicate is skipped before anything is parsed or uploaded, the
+                    # body is read twice: once for its hash, then for the transform
+                    with recorder.stage("content_hash"):
+                        digest = stream_content_hash(body)
+                    with recorder.stage("claim_content"):
+                        if claim_content(bucket, file_type, digest):
+                            claimed.append(digest)
+                        else:
+                            written = None
+                    if written is not None:
+                        body = reopen_body(bucket, processing_key, obj, spool is not None)
+                if written is not None:
+                    with recorder.stage("stream_process_file"):
+                        written = stream_process_file(file_name, body, params, bucket, athena_key,
+                                                      file_type, date_formats, engine, recorder,
+                                                      rollup, (year, month, day))
+            else:
+                with recorder.stage("read_body"):
+                    raw = obj['Body'].read()
+                if DEDUPLICATE:
+                    with recorder.stage("content_hash"):
+                        digest = content_hash(raw)
+                    with recorder.stage("claim_content"):
+                        if claim_content(bucket, file_type, digest):
+                            claimed.append(digest)
+                        else:
+                            written = None
+                if written is not None:
+                    data = StringIO(raw.decode('utf-8', 'ignore'))
+                    del raw
 
-        put_file(bucket, athena_key, output)
-        move_file(bucket, processing_key, bucket, done_key)
+                    with recorder.stage("process_file"):
+                        outputs = process_file(file_name, data, params, file_type, date_formats, engine,
+                                               recorder, rollup, (year, month, day))
+                    if outputs:
+                        with recorder.stage("put_file"):
+                            for partition, output in outputs:
+                                output_key = s3_key_partition(file_type, partition[0], partition[1], partition[2],
+                                                              output_file_name(file_name))
+                                recorder.count("BytesOut", put_output(bucket, output_key, output), "Bytes")
+                    # only once every output is in athena/, a failed put must not index the content
+                    written = bool(outputs)
+            if written and rollup is not None and len(rollup):
+                try:
+                    with recorder.stage("put_rollup"):
+                        put_rollup(bucket, rollup, year, month, day, file_name)
+                except Exception:
+                    # the raw output is rewritten when the file is retried, the content claim must not stay
+                    written = False
+                    raise
+        finally:
+            if spool is not None:
+                spool.close()
+            for digest in claimed:
+                release_content(bucket, file_type, digest, file_name, bool(written))
 
-        print ("Finish ", (file_name))
+        if written is None:
+            print ("Duplicate content, skipped ", (file_name))
+            result["status"] = "duplicate"
+        elif not written:
+            print ("Error empty output ", (file_name))
+            result["status"] = "error"
+        else:
+            print ("Finish ", (file_name))
+            result["status"] = "done"
+
+        final_key = error_key if result["status"] == "error" else done_key
+        final_state = "error" if result["status"] == "error" else "done"
+        if tracked:
+            result["archive"] = (processing_key, final_key, final_state)
+        else:
+            with recorder.stage("move_to_" + final_state):
+                move_file(bucket, processing_key, bucket, final_key)
 
     except Exception as e:
         print (e)
+        result["status"] = "failed"
+        result["error"] = str(e)
+        if tracked and result["key"]:
+            try:
+                set_state(result["bucket"], result["key"], "failed")
+            except Exception as tag_error:
+                print (tag_error)
+
+    if result["status"] in ("duplicate", "error", "failed"):
+        recorder.count(result["status"].capitalize() + "Files")
+    recorder.set_property("Status", result["status"])
+    recorder.flush()
+    return result
+
+
+def handler(event, context):
+    """
+    Standard aws lambda handler function, every record of the event is
+    processed on a bounded thread pool so one bad file doesn't stop the others
+
+    Args:
+      event (dict): the aws event that triggered the lambda
+      context (dict): the aws context the lambda runs under
+
+    Returns:
+      list: one result per record, see process_record
+    """
+    records = event.get('Records', [])
+    print("Received %s record(s)" % (len(records),))
+    if not records:
+        return []
+
+    recorder = MetricsRecorder(dimension_sets=[[]])
+    recorder.count("Records", len(records))
+    workers = max(1, min(MAX_WORKERS, len(records)))
+    with recorder.stage("process_records"), ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(process_record, records))
+
+    archives = {}
+    for result in results:
+        if result["archive"]:
+            archives.setdefault(result["bucket"], []).append(result["archive"])
+    for bucket, bucket_archives in archives.items():
+        with recorder.stage("archive_files"):
+            unarchived = set(archive_files(bucket, bucket_archives))
+        for result in results:
+            if result["bucket"] == bucket and result["key"] in unarchived:
+                result["error"] = "not archived"
+
+    for result in results:
+        print("[%s] %s %s" % (result["status"], result["key"], result["error"] or ""))
+    recorder.flush()
+
+    return results
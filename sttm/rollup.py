@@ -0,0 +1,155 @@
+"""
+Daily rollup of the rows of one STTM file, per gas_date and hub.
+
+handler feeds every row, or every parsed chunk, of a file with rollup columns
+(see schema_registry) to a DailyRollup and writes the result next to the raw
+output, under athena/<table>_Daily/. The rollup of a file holds a handful of
+rows per day whatever the size of the file, and combining the rollups of all
+the files is a cheap SUM/MIN/MAX over them.
+"""
+import collections
+import csv
+import datetime
+import sys
+if sys.version_info[0] < 3:
+    from StringIO import StringIO
+else:
+    from io import StringIO
+
+import schema_registry
+
+
+class DailyRollup(object):
+    """
+    Row count, min, max, sum and count of the measures of a table, by
+    (gas_date, hub_identifier, hub_name). gas_date is kept as "%Y-%m-%d".
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.measures = schema_registry.rollup_measures(table_name)
+        self.groups = {}
+        self.indexes = None
+
+    def _group(self, key):
+        group = self.groups.get(key)
+        if group is None:
+            # row count, then [min, max, sum, count] of every measure
+            group = self.groups[key] = [0] + [[None, None, 0.0, 0] for _ in self.measures]
+        return group
+
+    def bind(self, header):
+        """
+        Set the header of the rows given to add_row
+        """
+        position = dict((name, i) for i, name in enumerate(header))
+        self.indexes = ([position.get(name) for name in schema_registry.ROLLUP_KEYS],
+                        [position.get(name) for name in self.measures])
+
+    def add_row(self, row):
+        """
+        Add one row of strings, timestamps already normalised, see bind
+        """
+        keys, measures = self.indexes
+        key = tuple(row[i] if i is not None and i < len(row) else "" for i in keys)
+        # gas_date is written "%Y-%m-%d" or "%Y-%m-%d %H:%M:%S", the day is enough
+        key = (key[0][:10],) + key[1:]
+        group = self._group(key)
+        group[0] += 1
+        for stats, i in zip(group[1:], measures):
+            if i is None or i >= len(row):
+                continue
+            try:
+                value = float(row[i])
+            except ValueError:
+                continue
+            if value != value:
+                continue
+            self._add(stats, value, value, value, 1)
+
+    def add_frame(self, df):
+        """
+        Add a parsed frame, timestamps already parsed
+        """
+        import pandas as pd
+
+        gas_date = df["gas_date"]
+        if hasattr(gas_date, "dt"):
+            gas_date = gas_date.dt.strftime("%Y-%m-%d")
+        # plain object keys: a categorical key would group every combination of categories
+        keys = [gas_date.astype(object).fillna("")] + \
+               [df[name].astype(object).fillna("") for name in schema_registry.ROLLUP_KEYS[1:]]
+        measures = pd.DataFrame({name: pd.to_numeric(df[name], errors="coerce") for name in self.measures},
+                                index=df.index, columns=self.measures)
+        grouped = measures.groupby(keys)
+        sizes = grouped.size()
+        stats = grouped.agg(["min", "max", "sum", "count"]) if self.measures else None
+        for key, size in sizes.items():
+            group = self._group(tuple(str(part) for part in key))
+            group[0] += int(size)
+            for measure_stats, name in zip(group[1:], self.measures):
+                row = stats.loc[key, name]
+                if row["count"]:
+                    self._add(measure_stats, row["min"], row["max"], row["sum"], int(row["count"]))
+
+    def merge(self, other):
+        """
+        Add the groups of the rollup of another file of the same table
+        """
+        for key, other_group in other.groups.items():
+            group = self._group(key)
+            group[0] += other_group[0]
+            for stats, (minimum, maximum, total, count) in zip(group[1:], other_group[1:]):
+                if count:
+                    self._add(stats, minimum, maximum, total, count)
+
+    def split(self, partition_of):
+        """
+        Split the groups by partition
+        Args:
+          partition_of (callable): gas_date "%Y-%m-%d" -> partition
+
+        Returns:
+          OrderedDict: partition -> DailyRollup, in gas_date order
+        """
+        parts = collections.OrderedDict()
+        for key in sorted(self.groups):
+            partition = partition_of(key[0])
+            if partition not in parts:
+                parts[partition] = DailyRollup(self.table_name)
+            parts[partition].groups[key] = self.groups[key]
+        return parts
+
+    @staticmethod
+    def _add(stats, minimum, maximum, total, count):
+        stats[0] = minimum if stats[0] is None else min(stats[0], minimum)
+        stats[1] = maximum if stats[1] is None else max(stats[1], maximum)
+        stats[2] += total
+        stats[3] += count
+
+    def __len__(self):
+        return len(self.groups)
+
+    def to_csv(self, file_name, added_dttm=None):
+        """
+        Serialise the rollup with the columns of its table
+        Args:
+          file_name (string): name of the source file, stored in source_file_id
+          added_dttm (string): value of added_dttm, now when None
+
+        Returns:
+          string: the csv content, header included
+        """
+        added_dttm = added_dttm or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        out = StringIO()
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow([column["name"] for column in schema_registry.rollup_columns(self.table_name)])
+        for key in sorted(self.groups):
+            group = self.groups[key]
+            row = list(key) + [group[0]]
+            for minimum, maximum, total, count in group[1:]:
+                row.extend(["" if minimum is None else repr(float(minimum)),
+                            "" if maximum is None else repr(float(maximum)),
+                            repr(round(float(total), 10)) if count else "", count])
+            writer.writerow(row + [file_name, added_dttm])
+        return out.getvalue()
@@ -0,0 +1,44 @@
+"""
+The lambdas import their shared modules from next to them, as the buildspecs
+copy sttm-common into every bundle. The tests put sttm-common, the lambda
+folders and the local AWS stand-ins of the benchmark on the path instead.
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+for folder in ("sttm", "sttm-common", "sttm-clean-test-files", "benchmark"):
+    sys.path.insert(0, os.path.join(ROOT, folder))
+
+# the csv engine needs no pandas, the metrics are not printed
+os.environ.setdefault("IngestEngine", "csv")
+os.environ.setdefault("Metrics", "false")
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-2")
+
+BUCKET = "sttm-test"
+
+
+# modules holding the S3 client of handler, compaction imports it by name
+S3_MODULES = ("handler", "compaction")
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """
+    LocalS3 in place of the S3 client of handler, with an empty content hash cache
+    """
+    import handler
+    from local_aws import LocalS3
+
+    client = LocalS3()
+    for name in S3_MODULES:
+        monkeypatch.setattr(importlib.import_module(name), "s3", client)
+    handler._known_hashes.clear()
+    handler._inflight_hashes.clear()
+    yield client
+    handler._known_hashes.clear()
+    handler._inflight_hashes.clear()
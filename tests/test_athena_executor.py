@@ -0,0 +1,125 @@
+import pytest
+
+import athena_executor
+from athena_executor import ResultCache, iter_rows, query_rows, run_query
+from local_aws import LocalAthena
+
+
+CONFIG = {'OutputLocation': 's3://sttm-test/athena-results/'}
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(athena_executor.time, "time", clock)
+    monkeypatch.setattr(athena_executor.time, "sleep", lambda seconds: None)
+    return clock
+
+
+def test_rows_are_read_over_every_page(clock):
+    athena = LocalAthena()
+    athena.results["SHOW TABLES"] = [["table_%04d" % n] for n in range(25)]
+
+    outcome = run_query(athena, "SHOW TABLES", CONFIG)
+    rows = list(iter_rows(athena, outcome.query_id, page_size=10))
+
+    assert [row[0] for row in rows] == ["table_%04d" % n for n in range(25)]
+    assert athena.calls['GetQueryResults'] == 3
+
+
+def test_header_is_skipped_on_the_first_page_only(clock):
+    athena = LocalAthena()
+    athena.results["SELECT gas_date FROM int651"] = [["gas_date"], ["2024-01-01"], ["2024-01-02"]]
+
+    rows = list(query_rows(athena, "SELECT gas_date FROM int651", CONFIG, skip_header=True, cache=None))
+
+    assert rows == [["2024-01-01"], ["2024-01-02"]]
+
+
+def test_repeated_query_is_served_from_the_cache(clock):
+    athena = LocalAthena()
+    athena.results["SHOW TABLES"] = [["int651"], ["int652"]]
+    cache = ResultCache(ttl=60)
+
+    first = list(query_rows(athena, "SHOW TABLES", CONFIG, "sttm", cache=cache))
+    again = list(query_rows(athena, "  show   tables; ", CONFIG, "STTM", cache=cache))
+
+    assert first == again == [["int651"], ["int652"]]
+    assert athena.calls['StartQueryExecution'] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_is_keyed_on_the_database(clock):
+    athena = LocalAthena()
+    athena.results["SHOW TABLES"] = [["int651"]]
+    cache = ResultCache(ttl=60)
+
+    list(query_rows(athena, "SHOW TABLES", CONFIG, "sttm", cache=cache))
+    list(query_rows(athena, "SHOW TABLES", CONFIG, "sttm_test", cache=cache))
+
+    assert athena.calls['StartQueryExecution'] == 2
+
+
+def test_expired_entry_runs_the_query_again(clock):
+    athena = LocalAthena()
+    athena.results["SHOW TABLES"] = [["int651"]]
+    cache = ResultCache(ttl=60)
+
+    list(query_rows(athena, "SHOW TABLES", CONFIG, cache=cache))
+    clock.now += 61
+    athena.results["SHOW TABLES"] = [["int651"], ["int652"]]
+    rows = list(query_rows(athena, "SHOW TABLES", CONFIG, cache=cache))
+
+    assert rows == [["int651"], ["int652"]]
+    assert athena.calls['StartQueryExecution'] == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    athena = LocalAthena()
+    cache = ResultCache(ttl=60, max_entries=2)
+
+    for sql in ("SHOW TABLES IN a", "SHOW TABLES IN b"):
+        list(query_rows(athena, sql, CONFIG, cache=cache))
+    list(query_rows(athena, "SHOW TABLES IN a", CONFIG, cache=cache))
+    list(query_rows(athena, "SHOW TABLES IN c", CONFIG, cache=cache))
+
+    assert cache.get("SHOW TABLES IN a") is not None
+    assert cache.get("SHOW TABLES IN b") is None
+    assert len(cache) == 2
+
+
+def test_large_results_and_statements_are_not_kept(clock):
+    athena = LocalAthena()
+    athena.results["SELECT * FROM int651"] = [[str(n)] for n in range(5)]
+    cache = ResultCache(ttl=60, max_rows=4)
+
+    assert len(list(query_rows(athena, "SELECT * FROM int651", CONFIG, cache=cache))) == 5
+    list(query_rows(athena, "MSCK REPAIR TABLE int651", CONFIG, cache=cache))
+
+    assert len(cache) == 0
+
+
+def test_delete_db_bypasses_the_cache(clock, monkeypatch):
+    import sttm_clean_test_files
+
+    athena = LocalAthena()
+    athena.results["SHOW TABLES IN sttm_test"] = [["int651"]]
+    monkeypatch.setattr(sttm_clean_test_files, "athena", athena)
+    # stale tables of an earlier invocation
+    monkeypatch.setattr(athena_executor.RESULT_CACHE, "entries", athena_executor.RESULT_CACHE.entries.copy())
+    athena_executor.RESULT_CACHE.put("SHOW TABLES IN sttm_test", None, [["old_table"]])
+
+    sttm_clean_test_files.delete_db("sttm_test", "sttm-test")
+
+    assert sorted(athena.queries.values()) == ["DROP DATABASE IF EXISTS sttm_test",
+                                               "DROP TABLE sttm_test.int651",
+                                               "SHOW TABLES IN sttm_test"]
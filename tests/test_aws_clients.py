@@ -0,0 +1,74 @@
+import boto3
+import pytest
+
+import aws_clients
+
+
+class Client(object):
+
+    def __init__(self, service_name, config):
+        self.service_name = service_name
+        self.config = config
+
+    def send_message(self, **kwargs):
+        return self.service_name
+
+
+@pytest.fixture
+def created(monkeypatch):
+    """
+    Fresh client registry, boto3.client records the clients it is asked for
+    """
+    monkeypatch.setattr(aws_clients, "_clients", {})
+    monkeypatch.setattr(aws_clients, "_resources", {})
+    monkeypatch.setattr(aws_clients, "_pool_connections", {})
+    created = []
+
+    def client(service_name, config=None):
+        created.append((service_name, config))
+        return Client(service_name, config)
+    monkeypatch.setattr(boto3, "client", client)
+    return created
+
+
+def test_client_is_created_on_first_use(created):
+    sqs = aws_clients.lazy_client("sqs")
+    assert created == []
+
+    assert sqs.send_message(QueueUrl="q", MessageBody="m") == "sqs"
+    assert [service for service, _ in created] == ["sqs"]
+
+
+def test_client_is_reused_across_calls(created):
+    first = aws_clients.lazy_client("sqs")
+    second = aws_clients.lazy_client("sqs")
+
+    assert aws_clients.client("sqs") is aws_clients.client("sqs")
+    first.send_message()
+    second.send_message()
+    assert len(created) == 1
+
+    aws_clients.reset()
+    aws_clients.client("sqs")
+    assert len(created) == 2
+
+
+def test_pool_is_sized_for_the_largest_declaration(created):
+    aws_clients.lazy_client("s3", pool_connections=4)
+    aws_clients.lazy_client("s3", pool_connections=aws_clients.MAX_POOL_CONNECTIONS + 22)
+    aws_clients.lazy_client("s3", pool_connections=8)
+
+    aws_clients.client("s3")
+    aws_clients.client("athena")
+
+    configs = dict(created)
+    assert configs["s3"].max_pool_connections == aws_clients.MAX_POOL_CONNECTIONS + 22
+    assert configs["athena"].max_pool_connections == aws_clients.MAX_POOL_CONNECTIONS
+
+
+def test_clients_retry_adaptively():
+    config = aws_clients.client_config()
+
+    assert config.retries == {"mode": "adaptive", "max_attempts": aws_clients.MAX_ATTEMPTS}
+    assert config.connect_timeout == aws_clients.CONNECT_TIMEOUT_SECONDS
+    assert config.read_timeout == aws_clients.READ_TIMEOUT_SECONDS
@@ -0,0 +1,153 @@
+import pytest
+
+import compaction
+from conftest import BUCKET
+
+PREFIX = "athena/STTM_INT651_ExAnteMarketPrice/year=2018/month=07/day=01/"
+HEADER = b"gas_date,hub_identifier,source_file_id"
+
+
+def put_sources(s3, count=3):
+    for i in range(count):
+        s3.put_object(Bucket=BUCKET, Key="%sfile-%s.csv" % (PREFIX, i),
+                      Body=HEADER + ("\n2018-07-01,SYD,file-%s\n2018-07-01,ADL,file-%s\n" % (i, i)).encode())
+    # settled long ago, see list_candidates
+    for key in list(s3.modified):
+        del s3.modified[key]
+    return compaction.list_candidates(BUCKET, PREFIX)
+
+
+def visible_rows(s3):
+    rows = []
+    for key in s3.keys(BUCKET, PREFIX):
+        if key[len(PREFIX):].startswith("_"):
+            continue
+        header, _, body = s3.objects[(BUCKET, key)].partition(b"\n")
+        assert header == HEADER
+        rows.extend(body.splitlines())
+    return sorted(rows)
+
+
+def test_merge_swaps_the_sources_for_one_object(s3):
+    batch = put_sources(s3)
+    before = visible_rows(s3)
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert result["replaced"] == 3 and result["kept"] == []
+    assert s3.keys(BUCKET, PREFIX) == [result["key"]]
+    assert visible_rows(s3) == before
+
+
+def test_changed_source_rolls_back(s3):
+    batch = put_sources(s3)
+    get_object = s3.get_object
+
+    def rewrite_after_read(Bucket, Key, **kwargs):
+        response = get_object(Bucket=Bucket, Key=Key, **kwargs)
+        if Key.endswith("file-1.csv"):
+            s3.objects[(Bucket, Key)] = HEADER + b"\n2018-07-01,BRI,file-1\n"
+        return response
+    s3.get_object = rewrite_after_read
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert result["key"] is None
+    assert s3.keys(BUCKET, PREFIX) == [obj["Key"] for obj in batch]
+
+
+def test_no_source_deleted_rolls_back(s3, monkeypatch):
+    monkeypatch.setattr(compaction.time, "sleep", lambda seconds: None)
+    batch = put_sources(s3)
+    before = visible_rows(s3)
+    s3.delete_objects = lambda Bucket, Delete, **kwargs: {
+        'Errors': [{'Key': obj['Key'], 'Code': 'AccessDenied', 'Message': 'Access Denied'}
+                   for obj in Delete['Objects']]}
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert result["key"] is None and len(result["kept"]) == 3
+    assert s3.keys(BUCKET, PREFIX) == [obj["Key"] for obj in batch]
+    assert visible_rows(s3) == before
+
+
+def test_source_left_behind_is_not_read_twice(s3, monkeypatch):
+    monkeypatch.setattr(compaction, "COMPACT_DELETE_ATTEMPTS", 2)
+    monkeypatch.setattr(compaction.time, "sleep", lambda seconds: None)
+    batch = put_sources(s3)
+    before = visible_rows(s3)
+    stuck = PREFIX + "file-1.csv"
+    delete_objects = s3.delete_objects
+
+    def delete_but_stuck(Bucket, Delete, **kwargs):
+        delete_objects(Bucket=Bucket, Delete={'Objects': [obj for obj in Delete['Objects'] if obj['Key'] != stuck]})
+        return {'Errors': [{'Key': stuck, 'Code': 'InternalError', 'Message': 'Internal Error'}]}
+    s3.delete_objects = delete_but_stuck
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert result["replaced"] == 2 and result["kept"] == [stuck]
+    assert s3.keys(BUCKET, PREFIX) == sorted([result["key"], stuck])
+    assert visible_rows(s3) == before
+
+
+def failing_copy(s3, failures):
+    copy = s3.copy
+    calls = []
+
+    def flaky(*args, **kwargs):
+        calls.append(args)
+        if len(calls) <= failures:
+            raise IOError("copy refused")
+        return copy(*args, **kwargs)
+    s3.copy = flaky
+    return calls
+
+
+def test_failed_copy_after_delete_is_retried(s3, monkeypatch):
+    monkeypatch.setattr(compaction.time, "sleep", lambda seconds: None)
+    batch = put_sources(s3)
+    before = visible_rows(s3)
+    calls = failing_copy(s3, 1)
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert len(calls) == 2
+    assert result["replaced"] == 3
+    assert s3.keys(BUCKET, PREFIX) == [result["key"]]
+    assert visible_rows(s3) == before
+
+
+def test_failed_copy_after_delete_restores_the_sources(s3, monkeypatch):
+    monkeypatch.setattr(compaction.time, "sleep", lambda seconds: None)
+    batch = put_sources(s3)
+    sources = dict((obj["Key"], s3.objects[(BUCKET, obj["Key"])]) for obj in batch)
+    failing_copy(s3, compaction.COMPACT_PUBLISH_ATTEMPTS)
+
+    result = compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    assert result == {"key": None, "replaced": 0, "kept": []}
+    assert s3.keys(BUCKET, PREFIX) == sorted(sources)
+    for key, content in sources.items():
+        assert s3.objects[(BUCKET, key)] == content
+
+
+def test_failed_restore_keeps_the_staged_object(s3, monkeypatch):
+    monkeypatch.setattr(compaction.time, "sleep", lambda seconds: None)
+    batch = put_sources(s3)
+    before = visible_rows(s3)
+    failing_copy(s3, compaction.COMPACT_PUBLISH_ATTEMPTS)
+    put_object = s3.put_object
+
+    def put_staged_only(Bucket, Key, **kwargs):
+        if not Key[len(PREFIX):].startswith(compaction.STAGING_PREFIX):
+            raise IOError("put refused")
+        return put_object(Bucket=Bucket, Key=Key, **kwargs)
+    s3.put_object = put_staged_only
+
+    with pytest.raises(IOError):
+        compaction.merge_batch(BUCKET, PREFIX, batch)
+
+    staged = s3.keys(BUCKET, PREFIX + compaction.STAGING_PREFIX)
+    assert len(staged) == 1
+    assert sorted(s3.objects[(BUCKET, staged[0])].partition(b"\n")[2].splitlines()) == before
@@ -0,0 +1,34 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+import handler  # noqa: E402
+
+
+TABLE = "STTM_INT651_ExAnteMarketPrice"
+
+
+def test_added_dttm_is_not_read_dayfirst():
+    df = pd.DataFrame({"added_dttm": ["2024-03-04 05:06:07"]})
+
+    out = handler.conform_frame(df, TABLE)
+
+    assert out["added_dttm"][0] == pd.Timestamp(2024, 3, 4, 5, 6, 7)
+
+
+def test_text_timestamps_are_parsed_with_their_declared_format():
+    df = pd.DataFrame({"gas_date": ["04 Mar 2024", "03/04/2024", "junk"]})
+
+    out = handler.conform_frame(df, TABLE)
+
+    assert list(out["gas_date"][:2]) == [pd.Timestamp(2024, 3, 4), pd.Timestamp(2024, 4, 3)]
+    assert pd.isnull(out["gas_date"][2])
+
+
+def test_parsed_timestamps_are_kept():
+    parsed = pd.Series([pd.Timestamp(2024, 1, 2, 3, 4, 5)])
+    df = pd.DataFrame({"approval_datetime": parsed})
+
+    out = handler.conform_frame(df, TABLE)
+
+    assert out["approval_datetime"][0] == pd.Timestamp(2024, 1, 2, 3, 4, 5)
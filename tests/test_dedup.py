@@ -0,0 +1,120 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import generator
+import handler
+from conftest import BUCKET
+
+TABLE = "STTM_INT651_ExAnteMarketPrice"
+
+
+def s3_record(key, size):
+    return {"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "size": size}}}
+
+
+def drop_file(s3, rows=6):
+    file_name, content = generator.generate_files(["INT651"], rows, 1)[0]
+    key = "input/" + file_name
+    s3.objects[(BUCKET, key)] = content
+    return s3_record(key, len(content))
+
+
+def athena_keys(s3):
+    return [key for key in s3.keys(BUCKET, "athena/") if "_Daily" not in key]
+
+
+def test_claim_then_release_indexes_the_content(s3):
+    assert handler.claim_content(BUCKET, TABLE, "abc")
+    handler.release_content(BUCKET, TABLE, "abc", "a.csv", True)
+
+    assert s3.keys(BUCKET, "hash-index/") == ["hash-index/%s/abc" % TABLE]
+    assert not handler.claim_content(BUCKET, TABLE, "abc")
+
+
+def test_release_without_ingest_leaves_the_content_new(s3):
+    assert handler.claim_content(BUCKET, TABLE, "abc")
+    handler.release_content(BUCKET, TABLE, "abc", "a.csv", False)
+
+    assert s3.keys(BUCKET, "hash-index/") == []
+    assert handler.claim_content(BUCKET, TABLE, "abc")
+
+
+def test_index_of_another_container_is_a_duplicate(s3):
+    s3.objects[(BUCKET, handler.hash_index_key(TABLE, "abc"))] = b"a.csv"
+
+    assert not handler.claim_content(BUCKET, TABLE, "abc")
+
+
+def test_content_in_flight_is_not_a_duplicate(s3):
+    assert handler.claim_content(BUCKET, TABLE, "abc")
+    with pytest.raises(RuntimeError):
+        handler.claim_content(BUCKET, TABLE, "abc")
+
+    # the first copy fails, the second one is ingested once retried
+    handler.release_content(BUCKET, TABLE, "abc", "a.csv", False)
+    assert handler.claim_content(BUCKET, TABLE, "abc")
+
+
+def test_index_error_is_not_new_content(s3):
+    def forbidden(**kwargs):
+        raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    s3.head_object = forbidden
+
+    with pytest.raises(ClientError):
+        handler.claim_content(BUCKET, TABLE, "abc")
+    assert (TABLE, "abc") not in handler._inflight_hashes
+
+
+def test_failed_put_is_ingested_on_retry(s3, monkeypatch):
+    record = drop_file(s3)
+    content = s3.objects[(BUCKET, record["s3"]["object"]["key"])]
+    put_object = s3.put_object
+
+    def failing_put(Bucket, Key, **kwargs):
+        if Key.startswith("athena/"):
+            raise IOError("put refused")
+        return put_object(Bucket=Bucket, Key=Key, **kwargs)
+    monkeypatch.setattr(s3, "put_object", failing_put)
+
+    assert handler.process_record(record)["status"] == "failed"
+    assert athena_keys(s3) == []
+    assert s3.keys(BUCKET, "hash-index/") == []
+
+    # the same file dropped again is ingested, not skipped as a duplicate
+    monkeypatch.setattr(s3, "put_object", put_object)
+    s3.objects[(BUCKET, record["s3"]["object"]["key"])] = content
+    assert handler.process_record(record)["status"] == "done"
+    assert len(athena_keys(s3)) == 1
+    assert len(s3.keys(BUCKET, "hash-index/")) == 1
+
+
+def test_streamed_duplicate_is_neither_parsed_nor_written(s3, monkeypatch):
+    monkeypatch.setattr(handler, "STREAMING_MODE", "always")
+    record = drop_file(s3)
+    content = s3.objects[(BUCKET, record["s3"]["object"]["key"])]
+    assert handler.process_record(record)["status"] == "done"
+
+    def parse(*args, **kwargs):
+        raise AssertionError("duplicate content parsed")
+    monkeypatch.setattr(handler, "stream_process_file", parse)
+    s3.objects[(BUCKET, record["s3"]["object"]["key"])] = content
+    uploads = s3.calls["CreateMultipartUpload"] + s3.calls["PutObject"]
+
+    assert handler.process_record(record)["status"] == "duplicate"
+    assert s3.calls["CreateMultipartUpload"] + s3.calls["PutObject"] == uploads
+    assert len(athena_keys(s3)) == 1
+
+
+def test_streamed_claim_error_keeps_the_file_in_processing(s3, monkeypatch):
+    monkeypatch.setattr(handler, "STREAMING_MODE", "always")
+    record = drop_file(s3)
+    file_name = record["s3"]["object"]["key"].rsplit("/", 1)[-1]
+
+    def in_flight(bucket, table_name, digest):
+        raise RuntimeError("Content %s of %s is being ingested by another file" % (digest, table_name))
+    monkeypatch.setattr(handler, "claim_content", in_flight)
+
+    assert handler.process_record(record)["status"] == "failed"
+    assert s3.keys(BUCKET, "processing/") == ["processing/%s/%s" % (TABLE, file_name)]
+    assert s3.keys(BUCKET, "error/") == []
+    assert athena_keys(s3) == []
@@ -0,0 +1,62 @@
+import csv
+from io import StringIO
+
+import handler
+
+TABLE = "STTM_INT651_ExAnteMarketPrice"
+FILE_NAME = "int651_v1_ex_ante_market_price_rpt_1~20180702000000.csv"
+DEFAULT = ("2018", "07", "02")
+CONTENT = ("gas_date,hub_identifier,hub_name,schedule_identifier,ex_ante_market_price\n"
+           "30 Jun 2018,SYD,Sydney,1,2.5\n"
+           "01 Jul 2018,SYD,Sydney,1,3.5\n"
+           ",ADL,Adelaide,1,4.5\n"
+           "30 Jun 2018,ADL,Adelaide,1,1.5\n")
+
+
+class Output(StringIO):
+    """
+    StringIO that keeps its content once closed
+    """
+
+    def close(self):
+        self.content = self.getvalue()
+        StringIO.close(self)
+
+
+def transform(split):
+    out = handler.PartitionedOutput(DEFAULT, lambda partition: Output(), split=split)
+    rows = handler.transform_csv(FILE_NAME, StringIO(CONTENT), out, handler.FILE_TYPES["INT651"]["date_formats"],
+                                 TABLE, "2018-07-02 00:00:00")
+    out.close()
+    return rows, dict((partition, list(csv.reader(StringIO(output.content))))
+                      for partition, output in out.outputs.items())
+
+
+def test_rows_go_to_the_partition_of_their_gas_date():
+    rows, outputs = transform(split=True)
+
+    assert rows == 4
+    assert list(outputs) == [("2018", "06", "30"), ("2018", "07", "01"), DEFAULT]
+    for lines in outputs.values():
+        assert lines[0][-2:] == ["source_file_id", "added_dttm"]
+    assert [line[1] for line in outputs[("2018", "06", "30")][1:]] == ["SYD", "ADL"]
+    assert [line[1] for line in outputs[("2018", "07", "01")][1:]] == ["SYD"]
+    # no gas_date, the partition of the file name
+    assert [line[1] for line in outputs[DEFAULT][1:]] == ["ADL"]
+
+
+def test_rows_stay_in_the_file_partition_without_split():
+    rows, outputs = transform(split=False)
+
+    assert rows == 4
+    assert list(outputs) == [DEFAULT]
+    assert len(outputs[DEFAULT]) == 5
+
+
+def test_partition_of():
+    out = handler.PartitionedOutput(DEFAULT, split=True)
+
+    assert out.partition_of("2018-06-30 00:00:00") == ("2018", "06", "30")
+    assert out.partition_of("2018-06-30") == ("2018", "06", "30")
+    assert out.partition_of("") == DEFAULT
+    assert handler.PartitionedOutput(DEFAULT, split=False).partition_of("2018-06-30") == DEFAULT
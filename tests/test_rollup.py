@@ -0,0 +1,60 @@
+import csv
+from io import StringIO
+
+from rollup import DailyRollup
+
+TABLE = "STTM_INT651_ExAnteMarketPrice"
+HEADER = ["gas_date", "hub_identifier", "hub_name", "schedule_identifier", "ex_ante_market_price"]
+
+
+def rollup_of(rows):
+    rollup = DailyRollup(TABLE)
+    rollup.bind(HEADER)
+    for row in rows:
+        rollup.add_row(row)
+    return rollup
+
+
+def test_rows_are_grouped_by_day_and_hub():
+    rollup = rollup_of([["2018-07-01 00:00:00", "SYD", "Sydney", "1", "2.5"],
+                        ["2018-07-01", "SYD", "Sydney", "2", "1.5"],
+                        ["2018-07-01", "SYD", "Sydney", "3", ""],
+                        ["2018-07-01", "ADL", "Adelaide", "1", "7"]])
+
+    assert rollup.groups[("2018-07-01", "SYD", "Sydney")] == [3, [1.5, 2.5, 4.0, 2]]
+    assert rollup.groups[("2018-07-01", "ADL", "Adelaide")] == [1, [7.0, 7.0, 7.0, 1]]
+
+
+def test_merge_adds_the_groups_of_another_file():
+    rollup = rollup_of([["2018-07-01", "SYD", "Sydney", "1", "2"]])
+    other = rollup_of([["2018-07-01", "SYD", "Sydney", "1", "5"],
+                       ["2018-07-02", "SYD", "Sydney", "1", ""]])
+
+    rollup.merge(other)
+
+    assert rollup.groups[("2018-07-01", "SYD", "Sydney")] == [2, [2.0, 5.0, 7.0, 2]]
+    assert rollup.groups[("2018-07-02", "SYD", "Sydney")] == [1, [None, None, 0.0, 0]]
+
+
+def test_split_gives_a_rollup_per_partition_in_gas_date_order():
+    rollup = rollup_of([["2018-08-01", "SYD", "Sydney", "1", "3"],
+                        ["2018-07-31", "SYD", "Sydney", "1", "1"],
+                        ["2018-07-01", "ADL", "Adelaide", "1", "2"]])
+
+    parts = rollup.split(lambda gas_date: tuple(gas_date.split("-")[:2]))
+
+    assert list(parts) == [("2018", "07"), ("2018", "08")]
+    assert sorted(parts[("2018", "07")].groups) == [("2018-07-01", "ADL", "Adelaide"),
+                                                    ("2018-07-31", "SYD", "Sydney")]
+    assert list(parts[("2018", "08")].groups) == [("2018-08-01", "SYD", "Sydney")]
+
+
+def test_to_csv_writes_the_rollup_columns():
+    rollup = rollup_of([["2018-07-01", "SYD", "Sydney", "1", "2.5"]])
+
+    rows = list(csv.reader(StringIO(rollup.to_csv("int651_v1_20180701.csv", "2018-07-02 00:00:00"))))
+
+    assert rows[0][:4] == ["gas_date", "hub_identifier", "hub_name", "row_count"]
+    assert rows[0][-2:] == ["source_file_id", "added_dttm"]
+    assert rows[1] == ["2018-07-01", "SYD", "Sydney", "1", "2.5", "2.5", "2.5", "1",
+                       "int651_v1_20180701.csv", "2018-07-02 00:00:00"]
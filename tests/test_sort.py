@@ -0,0 +1,20 @@
+import handler
+
+TABLE = "STTM_INT651_ExAnteMarketPrice"
+HEADER = ["gas_date", "hub_identifier", "schedule_identifier", "ex_ante_market_price"]
+
+
+def test_schedule_identifier_sorts_as_a_number(monkeypatch):
+    monkeypatch.setattr(handler, "SORT_OUTPUT", True)
+    rows = [["2018-07-01", "SYD", "10", "1.0"],
+            ["2018-07-01", "SYD", "", "2.0"],
+            ["2018-07-01", "SYD", "9", "3.0"],
+            ["2018-07-01", "ADL", "100", "4.0"]]
+
+    rows.sort(key=handler.row_sort_key(HEADER, TABLE))
+
+    assert [(row[1], row[2]) for row in rows] == [("ADL", "100"), ("SYD", "9"), ("SYD", "10"), ("SYD", "")]
+
+
+def test_rows_are_not_sorted_by_default():
+    assert handler.row_sort_key(HEADER, TABLE) is None